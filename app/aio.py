@@ -0,0 +1,17 @@
+import asyncio, contextvars, functools, os
+from concurrent.futures import ThreadPoolExecutor
+
+# The async request path (ASYNC_IO) keeps Gmail, Vertex and the per-message
+# storage calls on the event loop. What is left blocking (OAuth refreshes,
+# lease and schedule bookkeeping once per host run, the SQLite backend) runs
+# here, on a fixed pool, so the thread count stays flat however many polls
+# and approvals are in flight.
+BLOCKING_THREADS = int(os.getenv("AIO_BLOCKING_THREADS", "8"))
+
+_pool = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="aio-blocking")
+
+async def offload(fn, *args, **kwargs):
+    # Runs fn in the pool with the caller's context (metrics tenant label)
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_pool, call)
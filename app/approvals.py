@@ -1,5 +1,5 @@
 import os, hmac, hashlib, json, base64, time
-from typing import Dict
+from typing import Dict, List
 from fastapi import HTTPException
 
 SECRET = os.getenv("SECRET_KEY", "dev-secret")
@@ -41,3 +41,9 @@ def approval_links(host_id: str, draft_id: str) -> Dict[str, str]:
         "edit":    f"{BASE_URL}/edit?{urlencode({'token': edit_tok})}",
         "reject":  f"{BASE_URL}/reject?{urlencode({'token': reject_tok})}"
     }
+
+def approve_all_link(host_id: str, draft_ids: List[str]) -> str:
+    # One signed link that approves every listed draft in a single pass
+    from urllib.parse import urlencode
+    tok = make_token({"a":"approve_all","h":host_id,"ds":list(draft_ids)})
+    return f"{BASE_URL}/approve/all?{urlencode({'token': tok})}"
@@ -0,0 +1,95 @@
+import threading, time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+MISSING = object()
+
+class TTLCache:
+    # Thread-safe, size-bounded LRU map; entries expire ttl seconds after they
+    # were stored. With sliding=True a read also restarts the clock, so ttl
+    # becomes an idle timeout.
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300.0, sliding: bool = False):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidate/pop; see get_or_load
+        self._generation = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if self.sliding:
+                self._data[key] = (now + self.ttl, item[1])
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is MISSING:
+            generation = self._generation
+            value = loader()
+            with self._lock:
+                # Something was invalidated while loading, so value may have
+                # been read before the write that caused it: return it, but
+                # don't keep it for the next ttl seconds
+                if self._generation == generation:
+                    self._store(key, value)
+        return value
+
+    def update(self, key: Hashable, fn: Callable[[Any], Any]):
+        # Write-through: replace a live entry with fn(old value), keeping its expiry
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._data[key] = (item[0], fn(item[1]))
+
+    def pop(self, key: Hashable) -> Any:
+        with self._lock:
+            self._generation += 1
+            item = self._data.pop(key, None)
+        return MISSING if item is None else item[1]
+
+    def invalidate(self, key: Hashable):
+        self.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,63 @@
+import hashlib, os, re
+from typing import Dict, Optional
+
+# Rolling conversation state per thread, kept on the thread document next to
+# its marker (field "conversation") and updated as messages are logged:
+#   turns    the latest exchanges verbatim, at most CONVERSATION_RECENT_TURNS
+#   summary  one short line per older turn, oldest dropped first
+# Together they stay within CONVERSATION_TOKEN_BUDGET (about 4 characters a
+# token), so the context handed to the LLM is the same size on a thread's
+# 50th message as on its 2nd. Summary lines are the gist of a turn (its
+# first sentence, clipped), not another model call.
+TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "600"))
+RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "6"))
+# The summary gets at most this share of the budget
+SUMMARY_SHARE = 0.3
+GIST_CHARS = 160
+
+ROLES = {"inbound": "Guest", "outbound": "Host"}
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+def _gist(turn: Dict) -> str:
+    first = re.split(r"(?<=[.!?])\s", " ".join(turn["text"].split()), maxsplit=1)[0]
+    if len(first) > GIST_CHARS:
+        first = first[:GIST_CHARS - 1].rstrip() + "…"
+    return f"{turn['role']}: {first}"
+
+def _tokens(lines) -> int:
+    return sum(estimate_tokens(line) for line in lines)
+
+def append_turn(state: Optional[Dict], direction: str, text: str) -> Optional[Dict]:
+    # Returns the new state; drafts and other directions leave it unchanged
+    role = ROLES.get(direction)
+    text = (text or "").strip()
+    if not role or not text:
+        return state
+    turns = list((state or {}).get("turns") or [])
+    summary = list((state or {}).get("summary") or [])
+    # A single turn never takes more than half the budget
+    max_chars = TOKEN_BUDGET * 2
+    turns.append({"role": role, "text": text if len(text) <= max_chars else text[:max_chars - 1] + "…"})
+
+    summary_budget = int(TOKEN_BUDGET * SUMMARY_SHARE)
+    while len(turns) > 1 and (len(turns) > RECENT_TURNS or
+                              _tokens(t["text"] for t in turns) + _tokens(summary) > TOKEN_BUDGET):
+        summary.append(_gist(turns.pop(0)))
+        while summary and _tokens(summary) > summary_budget:
+            summary.pop(0)
+    return {"summary": summary, "turns": turns, "messages": int((state or {}).get("messages", 0)) + 1}
+
+def render_context(state: Optional[Dict]) -> str:
+    if not state:
+        return ""
+    parts = []
+    if state.get("summary"):
+        parts.append("Earlier in this conversation:\n" + "\n".join("- " + s for s in state["summary"]))
+    if state.get("turns"):
+        parts.append("Most recent messages:\n" + "\n\n".join(f"{t['role']}: {t['text']}" for t in state["turns"]))
+    return "\n\n".join(parts)
+
+def context_hash(context: str) -> str:
+    return hashlib.sha256(context.encode()).hexdigest()[:16] if context else ""
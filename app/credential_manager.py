@@ -0,0 +1,135 @@
+import datetime as dt
+import os, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional
+from google.auth.exceptions import RefreshError
+from app.gmail_io import creds_from_dict, creds_version
+from app.token_store import load_gmail_creds, save_gmail_token
+
+# google.oauth2 and its requests transport load on the first credential use
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
+# A token this close to expiry is refreshed before use...
+REFRESH_MARGIN_S = int(os.getenv("OAUTH_REFRESH_MARGIN_S", "60"))
+# ...and one this close is refreshed in the background while still being used.
+REFRESH_AHEAD_S = int(os.getenv("OAUTH_REFRESH_AHEAD_S", "600"))
+
+def _seconds_left(creds: "Credentials") -> float:
+    if not creds.token or creds.expiry is None:
+        return 0.0  # unknown expiry: refresh once to learn it
+    return (creds.expiry - dt.datetime.utcnow()).total_seconds()
+
+class CredentialManager:
+    # One Credentials object per host, shared by every Gmail client built for
+    # it, so a refresh is seen everywhere. Refreshed tokens are written back to
+    # token_store so other instances and restarts reuse them. Concurrent
+    # refreshes for a host are serialised on a per-host lock and the later
+    # callers find the token already fresh.
+    def __init__(self, refresh_workers: int = 4):
+        self._creds: Dict[str, "Credentials"] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+        self._pending: set = set()
+        self._pool = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="oauth-refresh")
+        self.refreshes = self.background_refreshes = self.reloads = 0
+
+    def _lock(self, host_id: str) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(host_id, threading.Lock())
+
+    def _load(self, host_id: str) -> Optional["Credentials"]:
+        d = load_gmail_creds(host_id)
+        if not d:
+            return None
+        self.reloads += 1
+        creds = creds_from_dict(d)
+        self._creds[host_id] = creds
+        return creds
+
+    def _refresh(self, host_id: str, creds: "Credentials") -> "Credentials":
+        from google.auth.transport.requests import Request
+        try:
+            creds.refresh(Request())
+        except RefreshError:
+            # The grant may have been replaced by a reconnect on another
+            # instance; retry once with what is stored now.
+            stored = self._load(host_id)
+            if stored is None or creds_version(stored) == creds_version(creds):
+                raise
+            creds = stored
+            if _seconds_left(creds) > REFRESH_MARGIN_S:
+                return creds
+            creds.refresh(Request())
+        self.refreshes += 1
+        save_gmail_token(host_id, creds.token, creds.expiry)
+        return creds
+
+    def get(self, host_id: str) -> Optional["Credentials"]:
+        creds = self._creds.get(host_id)
+        if creds is not None and _seconds_left(creds) > REFRESH_AHEAD_S:
+            return creds
+
+        with self._lock(host_id):
+            creds = self._creds.get(host_id) or self._load(host_id)
+            if creds is None:
+                return None
+            left = _seconds_left(creds)
+            if left <= REFRESH_MARGIN_S:
+                return self._refresh(host_id, creds)
+
+        if left <= REFRESH_AHEAD_S:
+            self._refresh_in_background(host_id)
+        return creds
+
+    def refresh_rejected(self, host_id: str, token: Optional[str]) -> Optional["Credentials"]:
+        # Gmail turned token down (revoked, or expired before its expiry said):
+        # refresh now, unless another caller already replaced it
+        with self._lock(host_id):
+            creds = self._creds.get(host_id) or self._load(host_id)
+            if creds is None or creds.token != token:
+                return creds
+            return self._refresh(host_id, creds)
+
+    def _refresh_in_background(self, host_id: str):
+        with self._guard:
+            if host_id in self._pending:
+                return
+            self._pending.add(host_id)
+        self._pool.submit(self._background_refresh, host_id)
+
+    def _background_refresh(self, host_id: str):
+        try:
+            with self._lock(host_id):
+                creds = self._creds.get(host_id)
+                if creds is not None and _seconds_left(creds) <= REFRESH_AHEAD_S:
+                    self._refresh(host_id, creds)
+                    self.background_refreshes += 1
+        except Exception as e:
+            print(f"Warning: background token refresh for {host_id} failed: {e}")
+        finally:
+            with self._guard:
+                self._pending.discard(host_id)
+
+    def forget(self, host_id: str):
+        # After a (re)connect: drop the cached object so the new grant is loaded
+        with self._lock(host_id):
+            self._creds.pop(host_id, None)
+
+    def stats(self) -> Dict:
+        return {"name": "oauth_credentials", "hosts": len(self._creds), "reloads": self.reloads,
+                "refreshes": self.refreshes, "backgroundRefreshes": self.background_refreshes}
+
+_manager = CredentialManager()
+
+def get_credentials(host_id: str) -> Optional["Credentials"]:
+    return _manager.get(host_id)
+
+def refresh_rejected_credentials(host_id: str, token: Optional[str]) -> Optional["Credentials"]:
+    return _manager.refresh_rejected(host_id, token)
+
+def forget_credentials(host_id: str):
+    _manager.forget(host_id)
+
+def credential_stats() -> Dict:
+    return _manager.stats()
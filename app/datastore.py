@@ -1,86 +1,149 @@
 import datetime as dt
-from typing import Optional, Dict
-from google.cloud import firestore
-
-_db = None
-def db():
-    global _db
-    if _db is None:
-        try:
-            _db = firestore.Client()
-        except Exception as e:
-            print(f"Warning: Firestore not available: {e}")
-            return None
-    return _db
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple
+from app.storage import storage, Op
+from app.storage_async import astorage
+from app.conversation import ROLES, append_turn
 
-def log_message(host_id: str, thread_id: str, direction: str, body: str, meta: dict):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: log_message({host_id}, {thread_id}, {direction})")
-        return
-    doc = {
+def _message_doc(thread_id: str, direction: str, body: str, meta: dict) -> Dict:
+    return {
         "thread_id": thread_id,
         "direction": direction,  # inbound/outbound/draft
         "body": body[:8000],
         "meta": meta or {},
         "ts": dt.datetime.utcnow()
     }
-    db_client.collection("tenants").document(host_id)\
-      .collection("messages").add(doc)
-
-def upsert_thread_marker(host_id: str, thread_id: str, last_msg_id: str):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: upsert_thread_marker({host_id}, {thread_id}, {last_msg_id})")
-        return
-    db_client.collection("tenants").document(host_id)\
-      .collection("threads").document(thread_id).set({
-        "lastMessageId": last_msg_id,
-        "updatedAt": dt.datetime.utcnow()
-      }, merge=True)
+
+def _marker_doc(last_msg_id: str, last_internal_date: Optional[int] = None) -> Dict:
+    doc = {"lastMessageId": last_msg_id, "updatedAt": dt.datetime.utcnow()}
+    # Gmail internalDate (ms) of that message: anything in the thread up to it is handled
+    if last_internal_date is not None:
+        doc["lastInternalDate"] = int(last_internal_date)
+    return doc
+
+def _draft_doc(data: Dict) -> Dict:
+    return {**data, "status": "pending", "createdAt": dt.datetime.utcnow()}
+
+def _append_turns(turns: List[Tuple[str, str]]):
+    # An "update" op's function: the turns go onto the conversation as stored
+    # when the commit runs, so turns another writer logged meanwhile are kept
+    def fields(doc: Optional[Dict]) -> Dict:
+        state = (doc or {}).get("conversation")
+        for direction, body in turns:
+            state = append_turn(state, direction, body)
+        return {"conversation": state}
+    return fields
+
+def log_message(host_id: str, thread_id: str, direction: str, body: str, meta: dict):
+    ops = [("create", "messages", None, _message_doc(thread_id, direction, body, meta))]
+    if direction in ROLES:
+        ops.append(("update", "threads", thread_id, _append_turns([(direction, body)])))
+    storage().commit(host_id, ops)
+
+def get_conversation(host_id: str, thread_id: str) -> Optional[Dict]:
+    doc = storage().get_doc(host_id, "threads", thread_id)
+    return (doc or {}).get("conversation")
+
+def upsert_thread_marker(host_id: str, thread_id: str, last_msg_id: str, last_internal_date: Optional[int] = None):
+    storage().set_doc(host_id, "threads", thread_id, _marker_doc(last_msg_id, last_internal_date), merge=True)
 
 def last_processed_id(host_id: str, thread_id: str) -> str | None:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: last_processed_id({host_id}, {thread_id})")
-        return None
-    snap = db_client.collection("tenants").document(host_id)\
-             .collection("threads").document(thread_id).get()
-    if snap.exists:
-        return snap.to_dict().get("lastMessageId")
-    return None
+    doc = storage().get_doc(host_id, "threads", thread_id)
+    return doc.get("lastMessageId") if doc else None
+
+def thread_markers(host_id: str, thread_ids: List[str]) -> Dict[str, Dict]:
+    # Marker documents for many threads in one batched read; threads without a
+    # marker are left out of the result.
+    ids = list(dict.fromkeys(t for t in thread_ids if t))
+    return storage().get_docs(host_id, "threads", ids)
 
 # Drafts
 def create_draft(host_id: str, draft_id: str, data: Dict):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: create_draft({host_id}, {draft_id})")
-        return
-    data = {**data, "status": "pending", "createdAt": dt.datetime.utcnow()}
-    db_client.collection("tenants").document(host_id)\
-      .collection("drafts").document(draft_id).set(data, merge=False)
+    storage().set_doc(host_id, "drafts", draft_id, _draft_doc(data))
 
 def get_draft(host_id: str, draft_id: str) -> Optional[Dict]:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: get_draft({host_id}, {draft_id})")
-        return None
-    snap = db_client.collection("tenants").document(host_id)\
-             .collection("drafts").document(draft_id).get()
-    return snap.to_dict() if snap.exists else None
+    return storage().get_doc(host_id, "drafts", draft_id)
+
+def get_drafts(host_id: str, draft_ids: List[str]) -> Dict[str, Dict]:
+    return storage().get_docs(host_id, "drafts", draft_ids)
 
 def set_draft_status(host_id: str, draft_id: str, status: str):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: set_draft_status({host_id}, {draft_id}, {status})")
-        return
-    db_client.collection("tenants").document(host_id)\
-      .collection("drafts").document(draft_id).set({"status": status}, merge=True)
+    storage().set_doc(host_id, "drafts", draft_id, {"status": status}, merge=True)
 
 def delete_draft(host_id: str, draft_id: str):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: delete_draft({host_id}, {draft_id})")
-        return
-    db_client.collection("tenants").document(host_id)\
-      .collection("drafts").document(draft_id).delete()
+    storage().delete_doc(host_id, "drafts", draft_id)
+
+def transition_draft(host_id: str, draft_id: str, from_statuses: List[str], status: str,
+                     fields: Optional[Dict] = None) -> Tuple[bool, Optional[Dict]]:
+    # Moves a draft to status only if it is currently in one of from_statuses;
+    # concurrent callers can't both win. Returns (moved, draft as it now is).
+    update = {**(fields or {}), "status": status, "updatedAt": dt.datetime.utcnow()}
+    return storage().update_if(host_id, "drafts", draft_id, "status", list(from_statuses), update)
+
+# The same reads and transitions for the async request path
+
+async def get_draft_aio(host_id: str, draft_id: str) -> Optional[Dict]:
+    return await astorage().get_doc(host_id, "drafts", draft_id)
+
+async def get_drafts_aio(host_id: str, draft_ids: List[str]) -> Dict[str, Dict]:
+    return await astorage().get_docs(host_id, "drafts", draft_ids)
+
+async def thread_markers_aio(host_id: str, thread_ids: List[str]) -> Dict[str, Dict]:
+    ids = list(dict.fromkeys(t for t in thread_ids if t))
+    return await astorage().get_docs(host_id, "threads", ids)
+
+async def transition_draft_aio(host_id: str, draft_id: str, from_statuses: List[str], status: str,
+                               fields: Optional[Dict] = None) -> Tuple[bool, Optional[Dict]]:
+    update = {**(fields or {}), "status": status, "updatedAt": dt.datetime.utcnow()}
+    return await astorage().update_if(host_id, "drafts", draft_id, "status", list(from_statuses), update)
+
+# Unit of work: the same mutations as above, queued and committed together in
+# one storage commit (one round trip, all-or-nothing).
+
+class UnitOfWork:
+    # Turns logged to a thread's conversation are appended to its state as
+    # read inside the commit, not to a copy taken earlier
+    def __init__(self, host_id: str):
+        self.host_id = host_id
+        self._ops: List[Op] = []
+        self._turns: Dict[str, List[Tuple[str, str]]] = {}
+
+    def __len__(self):
+        return len(self._ops)
+
+    def log_message(self, thread_id: str, direction: str, body: str, meta: dict):
+        self._ops.append(("create", "messages", None, _message_doc(thread_id, direction, body, meta)))
+        if direction in ROLES:
+            self._turns.setdefault(thread_id, []).append((direction, body))
+
+    def upsert_thread_marker(self, thread_id: str, last_msg_id: str, last_internal_date: Optional[int] = None):
+        self._ops.append(("merge", "threads", thread_id, _marker_doc(last_msg_id, last_internal_date)))
+
+    def create_draft(self, draft_id: str, data: Dict):
+        self._ops.append(("set", "drafts", draft_id, _draft_doc(data)))
+
+    def set_draft_status(self, draft_id: str, status: str):
+        self._ops.append(("merge", "drafts", draft_id, {"status": status}))
+
+    def delete_draft(self, draft_id: str):
+        self._ops.append(("delete", "drafts", draft_id, None))
+
+    def _take_ops(self) -> List[Op]:
+        for thread_id, turns in self._turns.items():
+            self._ops.append(("update", "threads", thread_id, _append_turns(turns)))
+        self._turns = {}
+        ops, self._ops = self._ops, []
+        return ops
+
+    def commit(self):
+        storage().commit(self.host_id, self._take_ops())
+
+    async def commit_aio(self):
+        await astorage().commit(self.host_id, self._take_ops())
+
+@contextmanager
+def unit_of_work(host_id: str):
+    # Commits on a clean exit; on an exception nothing queued is written.
+    uow = UnitOfWork(host_id)
+    yield uow
+    uow.commit()
@@ -0,0 +1,138 @@
+import asyncio, os, weakref, zlib
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+import httpx
+from app.aio import offload
+from app.credential_manager import refresh_rejected_credentials
+from app.gmail_io import GUEST_QUERY, HistoryExpired, reply_payload
+from app.gmail_quota import QUOTA_COST, acall, gmail_user
+from app.metrics import backend_call
+
+# Gmail REST over httpx for the async request path: the calls a poll and an
+# approved send make, with gmail_quota's buckets and backoff like gmail_io.
+# Messages are fetched with concurrent GETs (at most
+# GMAIL_ASYNC_FETCH_CONCURRENCY per mailbox) instead of the multipart batch
+# endpoint; Gmail charges the same quota either way.
+API_BASE = os.getenv("GMAIL_API_BASE", "https://gmail.googleapis.com/")
+FETCH_CONCURRENCY = int(os.getenv("GMAIL_ASYNC_FETCH_CONCURRENCY", "10"))
+MAX_CONNECTIONS = int(os.getenv("GMAIL_ASYNC_MAX_CONNECTIONS", "100"))
+TIMEOUT_S = float(os.getenv("GMAIL_ASYNC_TIMEOUT_S", "30"))
+
+def api_base(host_id: str) -> str:
+    return API_BASE
+
+# Connection pools are per event loop, shared by every mailbox; the access
+# token goes on each request. httpcore's pool gets slower per request the more
+# connections it holds, so GMAIL_ASYNC_MAX_CONNECTIONS is split over several
+# small clients, each mailbox always using the same one. Requests wait for a
+# connection on the client's semaphore rather than in httpcore's queue, which
+# is rescanned on every request.
+CLIENT_CONNECTIONS = 20
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[Tuple[httpx.AsyncClient, asyncio.Semaphore]]]" = \
+    weakref.WeakKeyDictionary()
+
+def _http(host_id: str) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    loop = asyncio.get_running_loop()
+    clients = _clients.get(loop)
+    if clients is None:
+        per_client = min(CLIENT_CONNECTIONS, MAX_CONNECTIONS)
+        clients = _clients[loop] = [
+            (httpx.AsyncClient(timeout=TIMEOUT_S, limits=httpx.Limits(max_connections=per_client,
+                                                                      max_keepalive_connections=per_client)),
+             asyncio.Semaphore(per_client))
+            for _ in range(max(1, MAX_CONNECTIONS // per_client))]
+    return clients[zlib.crc32(host_id.encode()) % len(clients)]
+
+class AsyncGmail:
+    def __init__(self, host_id: str, creds):
+        self.host_id = host_id
+        self.creds = creds
+        self.base = urljoin(api_base(host_id), "gmail/v1/users/me/")
+
+    async def _request(self, op: str, method: str, path: str, params=None, body: Optional[Dict] = None) -> Dict:
+        async def _once():
+            client, slots = _http(self.host_id)
+            async with slots:
+                with backend_call("gmail", op):
+                    r = await client.request(method, self.base + path, params=params, json=body,
+                                             headers={"Authorization": f"Bearer {self.creds.token}"})
+                    r.raise_for_status()
+                    return r.json()
+
+        with gmail_user(self.host_id):
+            try:
+                return await acall(op, QUOTA_COST[op], _once)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 401:
+                    raise
+            # The token expired or was revoked mid-run; googleapiclient
+            # refreshes and retries once here, so do the same. The cached
+            # credentials may still look valid, so the refresh is forced.
+            self.creds = await offload(refresh_rejected_credentials, self.host_id, self.creds.token) or self.creds
+            return await acall(op, QUOTA_COST[op], _once)
+
+    async def list_messages(self, q=GUEST_QUERY, max_results=10) -> List[Dict]:
+        res = await self._request("messages.list", "GET", "messages", {"q": q, "maxResults": max_results})
+        return res.get("messages", [])
+
+    async def get_message(self, msg_id: str, fmt="full", metadata_headers=None, missing_ok=False) -> Optional[Dict]:
+        params = [("format", fmt)] + [("metadataHeaders", h) for h in metadata_headers or []]
+        try:
+            return await self._request("messages.get", "GET", f"messages/{msg_id}", params)
+        except httpx.HTTPStatusError as e:
+            # Messages seen through history may have been deleted since
+            if missing_ok and e.response.status_code == 404:
+                return None
+            raise
+
+    async def get_messages(self, msg_ids: List[str], fmt="full", metadata_headers=None) -> Dict[str, Dict]:
+        # Like gmail_io.batch_get_messages: deleted messages are left out
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def _one(msg_id):
+            async with sem:
+                return msg_id, await self.get_message(msg_id, fmt, metadata_headers, missing_ok=True)
+
+        got = await asyncio.gather(*(_one(m) for m in msg_ids))
+        return {msg_id: msg for msg_id, msg in got if msg is not None}
+
+    async def current_history_id(self) -> str:
+        return str((await self._request("getProfile", "GET", "profile"))["historyId"])
+
+    async def list_history(self, start_history_id: str, label_id="INBOX"):
+        refs, seen, page_token = [], set(), None
+        while True:
+            params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded", "labelId": label_id}
+            if page_token:
+                params["pageToken"] = page_token
+            try:
+                res = await self._request("history.list", "GET", "history", params)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    raise HistoryExpired(start_history_id)
+                raise
+            for h in res.get("history", []):
+                for added in h.get("messagesAdded", []):
+                    m = added["message"]
+                    if m["id"] not in seen:
+                        seen.add(m["id"])
+                        refs.append({"id": m["id"], "threadId": m.get("threadId")})
+            page_token = res.get("nextPageToken")
+            if not page_token:
+                return refs, str(res.get("historyId", start_history_id))
+
+    async def sync_messages(self, cursor: Optional[str]):
+        # Same contract as gmail_io.sync_messages
+        if cursor:
+            try:
+                refs, new_cursor = await self.list_history(cursor)
+                return refs, new_cursor, False
+            except HistoryExpired:
+                print(f"Warning: Gmail history cursor {cursor} expired, resyncing")
+        history_id = await self.current_history_id()
+        return await self.list_messages(), history_id, True
+
+    async def send_reply(self, to_addr: str, subject: str, body_text: str, thread_id: Optional[str] = None) -> Dict:
+        return await self._request("messages.send", "POST", "messages/send",
+                                   body=reply_payload(to_addr, subject, body_text, thread_id))
@@ -1,8 +1,18 @@
-import base64, email
-from typing import Dict
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
+import base64, email, hashlib, json, os, threading, time
+import datetime as dt
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, List
+from urllib.parse import urljoin
+from googleapiclient.errors import HttpError
+from app.metrics import backend_call
+from app.gmail_quota import QUOTA_COST, call as quota_call, gmail_user
+
+# The Google client libraries below are imported where they are first used:
+# between them they add most of a second to startup, and /healthz or an
+# approval click never needs them (app.warmup loads them ahead of time)
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
@@ -10,22 +20,267 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
 ]
 
+GUEST_QUERY = 'label:inbox newer_than:1d from:airbnb.com'
+GUEST_SENDER_DOMAIN = "airbnb.com"
+
+# Headers needed to triage a message before downloading its body
+TRIAGE_HEADERS = ["From", "Reply-To", "Subject"]
+# Idle Gmail clients kept per process, and how long one may sit unused
+SERVICE_POOL_MAX = int(os.getenv("GMAIL_SERVICE_POOL_MAX", "256"))
+SERVICE_IDLE_TTL_S = float(os.getenv("GMAIL_SERVICE_IDLE_TTL_S", "600"))
+
+# Gmail accepts up to 100 calls per batch but throttles large ones; 50 is its advice
+BATCH_SIZE = 50
+
+class HistoryExpired(Exception):
+    pass
+
 def oauth_flow(client_json_path: str, redirect_uri: str):
+    from google_auth_oauthlib.flow import Flow
     return Flow.from_client_secrets_file(client_json_path, scopes=SCOPES, redirect_uri=redirect_uri)
 
-def creds_from_dict(d: Dict) -> Credentials:
+def creds_from_dict(d: Dict) -> "Credentials":
+    from google.oauth2.credentials import Credentials
+    d = dict(d)
+    # google-auth wants a naive UTC expiry; Firestore hands back aware datetimes
+    expiry = d.get("expiry")
+    if isinstance(expiry, str):
+        expiry = dt.datetime.fromisoformat(expiry)
+    if expiry is not None and expiry.tzinfo is not None:
+        expiry = expiry.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    d["expiry"] = expiry
     return Credentials(**d)
 
-def gmail_service(creds_dict: Dict):
-    creds = creds_from_dict(creds_dict)
-    return build("gmail", "v1", credentials=creds)
+_discovery_doc = None
+def _gmail_discovery_doc() -> Dict:
+    # The Gmail discovery document ships with google-api-python-client; parse
+    # it once instead of on every build() call.
+    global _discovery_doc
+    if _discovery_doc is None:
+        from googleapiclient import discovery_cache
+        _discovery_doc = json.loads(discovery_cache.get_static_doc("gmail", "v1"))
+    return _discovery_doc
+
+def gmail_service(creds):
+    if isinstance(creds, dict):
+        creds = creds_from_dict(creds)
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(_gmail_discovery_doc(), credentials=creds)
+
+def creds_version(creds) -> str:
+    # Changes when a host reconnects (new grant), not when the access token is refreshed
+    if isinstance(creds, dict):
+        fields = [creds.get("refresh_token"), creds.get("client_id"), creds.get("scopes")]
+    else:
+        fields = [creds.refresh_token, creds.client_id, creds.scopes]
+    fields[2] = sorted(fields[2] or [])
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()[:16]
+
+class ServicePool:
+    # Idle Gmail clients keyed by (host, credential version). A client (and its
+    # HTTP connection) is checked out by one caller at a time because httplib2
+    # transports are not thread-safe; concurrent callers for the same host get
+    # a second client. Clients idle for longer than idle_ttl, beyond max_idle,
+    # or built from superseded credentials are dropped.
+    def __init__(self, max_idle: int = SERVICE_POOL_MAX, idle_ttl: float = SERVICE_IDLE_TTL_S):
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self._idle: "OrderedDict[tuple, List[tuple[float, object]]]" = OrderedDict()
+        self._versions: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.built = self.reused = self.evicted = 0
+
+    def _count_idle(self) -> int:
+        return sum(len(v) for v in self._idle.values())
+
+    def _evict_expired(self, now: float):
+        for key in list(self._idle):
+            fresh = [e for e in self._idle[key] if e[0] > now]
+            self.evicted += len(self._idle[key]) - len(fresh)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def acquire(self, host_id: str, creds):
+        version = creds_version(creds)
+        now = time.monotonic()
+        with self._lock:
+            old = self._versions.get(host_id)
+            if old != version:
+                self.evicted += len(self._idle.pop((host_id, old), []))
+                self._versions[host_id] = version
+            self._evict_expired(now)
+            entries = self._idle.get((host_id, version))
+            if entries:
+                svc = entries.pop()[1]
+                if not entries:
+                    del self._idle[(host_id, version)]
+                self.reused += 1
+                return svc
+            self.built += 1
+        return gmail_service(creds)
+
+    def release(self, host_id: str, creds, svc):
+        version = creds_version(creds)
+        with self._lock:
+            if self._versions.get(host_id) != version:
+                self.evicted += 1
+                return
+            key = (host_id, version)
+            self._idle.setdefault(key, []).append((time.monotonic() + self.idle_ttl, svc))
+            self._idle.move_to_end(key)
+            while self._count_idle() > self.max_idle:
+                oldest = next(iter(self._idle))
+                self._idle[oldest].pop(0)
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+                self.evicted += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            idle = self._count_idle()
+        return {"name": "gmail_services", "idle": idle, "maxIdle": self.max_idle,
+                "built": self.built, "reused": self.reused, "evicted": self.evicted}
+
+_service_pool = ServicePool()
+
+@contextmanager
+def pooled_service(host_id: str, creds):
+    # creds: a Credentials object (shared, see credential_manager) or a stored dict
+    svc = _service_pool.acquire(host_id, creds)
+    with gmail_user(host_id):
+        yield svc
+    # Only clients that finished cleanly go back; a failed call may have left
+    # the connection in a bad state.
+    _service_pool.release(host_id, creds, svc)
+
+def pool_stats() -> Dict:
+    return _service_pool.stats()
 
-def list_messages(svc, q='label:inbox newer_than:1d from:airbnb.com', max_results=10):
-    res = svc.users().messages().list(userId="me", q=q, maxResults=max_results).execute()
+def _execute(op: str, request):
+    # Every single Gmail API call goes through here (see gmail_quota)
+    def _run():
+        with backend_call("gmail", op):
+            return request.execute()
+    return quota_call(op, QUOTA_COST[op], _run)
+
+def list_messages(svc, q=GUEST_QUERY, max_results=10):
+    res = _execute("messages.list", svc.users().messages().list(userId="me", q=q, maxResults=max_results))
     return res.get("messages", [])
 
-def get_message(svc, msg_id):
-    return svc.users().messages().get(userId="me", id=msg_id, format="full").execute()
+def get_message(svc, msg_id, missing_ok=False):
+    try:
+        return _execute("messages.get", svc.users().messages().get(userId="me", id=msg_id, format="full"))
+    except HttpError as e:
+        # Messages seen through history may have been deleted since
+        if missing_ok and e.resp.status == 404:
+            return None
+        raise
+
+def _batch_runner(batch):
+    def _run():
+        with backend_call("gmail", "batch"):
+            batch.execute()
+    return _run
+
+def batch_get_messages(svc, msg_ids: List[str], fmt="full", metadata_headers=None) -> Dict[str, Dict]:
+    # One HTTP round trip per BATCH_SIZE ids against Gmail's batch endpoint.
+    # Deleted messages are left out; other per-message failures (e.g. a 429
+    # inside the batch) are retried one by one so they still raise if persistent.
+    out, retry = {}, []
+
+    def _collect(request_id, response, exception):
+        if exception is None:
+            out[request_id] = response
+        elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+            retry.append(request_id)
+
+    from googleapiclient.http import BatchHttpRequest
+    batch_uri = urljoin(getattr(svc, "_baseUrl", "https://gmail.googleapis.com/"), "batch/gmail/v1")
+    for i in range(0, len(msg_ids), BATCH_SIZE):
+        batch = BatchHttpRequest(callback=_collect, batch_uri=batch_uri)
+        for msg_id in msg_ids[i:i + BATCH_SIZE]:
+            kw = {"userId": "me", "id": msg_id, "format": fmt}
+            if metadata_headers:
+                kw["metadataHeaders"] = metadata_headers
+            batch.add(svc.users().messages().get(**kw), request_id=msg_id)
+        # Charged for every call inside it; a batch Gmail throttles as a whole is retried
+        quota_call("batch", QUOTA_COST["messages.get"] * len(msg_ids[i:i + BATCH_SIZE]), _batch_runner(batch))
+
+    for msg_id in retry:
+        try:
+            out[msg_id] = _execute("messages.get", svc.users().messages().get(
+                userId="me", id=msg_id, format=fmt, metadataHeaders=metadata_headers))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+    return out
+
+def message_headers(msg: Dict) -> Dict[str, str]:
+    return {h["name"].lower(): h["value"] for h in msg.get("payload", {}).get("headers", [])}
+
+def current_history_id(svc) -> str:
+    return str(_execute("getProfile", svc.users().getProfile(userId="me"))["historyId"])
+
+def list_history(svc, start_history_id: str, label_id="INBOX"):
+    # Messages added to the label since start_history_id, oldest first, plus
+    # the mailbox historyId to use as the next cursor.
+    refs, seen, page_token = [], set(), None
+    while True:
+        try:
+            res = _execute("history.list", svc.users().history().list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                labelId=label_id,
+                pageToken=page_token,
+            ))
+        except HttpError as e:
+            # Gmail only keeps about a week of history; older cursors 404
+            if e.resp.status == 404:
+                raise HistoryExpired(start_history_id)
+            raise
+        for h in res.get("history", []):
+            for added in h.get("messagesAdded", []):
+                m = added["message"]
+                if m["id"] not in seen:
+                    seen.add(m["id"])
+                    refs.append({"id": m["id"], "threadId": m.get("threadId")})
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            return refs, str(res.get("historyId", start_history_id))
+
+def sync_messages(svc, cursor: str | None):
+    # Returns (message refs, new cursor, full_resync). Without a usable cursor
+    # fall back to the inbox search; the historyId is read first so nothing
+    # that arrives while listing is missed by the next incremental sync.
+    if cursor:
+        try:
+            refs, new_cursor = list_history(svc, cursor)
+            return refs, new_cursor, False
+        except HistoryExpired:
+            print(f"Warning: Gmail history cursor {cursor} expired, resyncing")
+    history_id = current_history_id(svc)
+    return list_messages(svc), history_id, True
+
+def is_guest_message(headers: Dict[str, str]) -> bool:
+    # History covers the whole inbox, so re-apply the sender part of GUEST_QUERY
+    return GUEST_SENDER_DOMAIN in (headers.get("from") or "").lower()
+
+def watch_inbox(svc, topic_name: str) -> Dict:
+    # Gmail publishes to the topic on INBOX changes; watches lapse after 7 days
+    body = {"topicName": topic_name, "labelIds": ["INBOX"], "labelFilterBehavior": "INCLUDE"}
+    return _execute("watch", svc.users().watch(userId="me", body=body))
+
+def parse_push_notification(envelope: Dict) -> Dict | None:
+    # Pub/Sub push body: {"message": {"data": base64(json), ...}, "subscription": ...}
+    # where the Gmail payload is {"emailAddress": ..., "historyId": ...}
+    try:
+        data = json.loads(base64.b64decode(envelope["message"]["data"]))
+        return {"emailAddress": data.get("emailAddress"), "historyId": str(data["historyId"])}
+    except Exception:
+        return None
 
 def extract_plain(payload):
     mt = payload.get("mimeType")
@@ -39,7 +294,7 @@ def extract_plain(payload):
                 if data: return base64.urlsafe_b64decode(data).decode("utf-8", "ignore")
     return ""
 
-def send_reply(svc, to_addr: str, subject: str, body_text: str, thread_id: str | None = None):
+def reply_payload(to_addr: str, subject: str, body_text: str, thread_id: str | None = None) -> Dict:
     msg = email.message.EmailMessage()
     msg["To"] = to_addr
     msg["Subject"] = f"Re: {subject}"
@@ -48,4 +303,8 @@ def send_reply(svc, to_addr: str, subject: str, body_text: str, thread_id: str |
     payload = {"raw": raw}
     if thread_id:
         payload["threadId"] = thread_id
-    return svc.users().messages().send(userId="me", body=payload).execute()
+    return payload
+
+def send_reply(svc, to_addr: str, subject: str, body_text: str, thread_id: str | None = None):
+    payload = reply_payload(to_addr, subject, body_text, thread_id)
+    return _execute("messages.send", svc.users().messages().send(userId="me", body=payload))
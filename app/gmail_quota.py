@@ -0,0 +1,203 @@
+import asyncio, os, random, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional
+from googleapiclient.errors import HttpError
+from app.cache import TTLCache
+from app.metrics import Counter, current_tenant, register
+
+# Gmail meters every call in quota units, per mailbox (250 units/s) and per
+# Cloud project (1.2M units/min). Calls take their cost from two token buckets
+# first, one for the mailbox and one for the whole process, and wait when
+# either is empty instead of running into 429s. With several instances give
+# each its share of the project quota (GMAIL_PROJECT_QUOTA_PER_S).
+#
+# Calls Gmail still throttles (429, 403 rate-limit reasons) or fails with a
+# server error are retried with jittered exponential backoff, honouring
+# Retry-After, for at most GMAIL_MAX_RETRIES retries and GMAIL_RETRY_BUDGET_S
+# seconds of waiting per call. Sends are only retried on answers that mean
+# Gmail did not take the message (429, 503, rate limits), as in outbox.
+QUOTA_COST = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.send": 100,
+    "history.list": 2,
+    "watch": 100,
+    "getProfile": 1,
+}
+USER_QUOTA_PER_S = float(os.getenv("GMAIL_USER_QUOTA_PER_S", "250"))
+PROJECT_QUOTA_PER_S = float(os.getenv("GMAIL_PROJECT_QUOTA_PER_S", "20000"))
+MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "5"))
+RETRY_BASE_S = float(os.getenv("GMAIL_RETRY_BASE_S", "0.5"))
+RETRY_MAX_S = float(os.getenv("GMAIL_RETRY_MAX_S", "16"))
+RETRY_BUDGET_S = float(os.getenv("GMAIL_RETRY_BUDGET_S", "30"))
+
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# A send that got one of these back was not delivered
+SEND_RETRYABLE_STATUS = {429, 503}
+
+THROTTLES = register(Counter("cohost_gmail_throttle_total",
+                             "Gmail calls held back by the quota buckets or retried after throttling.",
+                             ("tenant", "op", "kind")))
+THROTTLE_SECONDS = register(Counter("cohost_gmail_throttle_seconds_total",
+                                    "Time Gmail calls spent waiting on quota or backoff.",
+                                    ("tenant", "kind")))
+
+class TokenBucket:
+    # Refills at rate tokens/s up to burst. take() reserves its cost right
+    # away, going negative if need be, and returns how long the caller has to
+    # wait for it; later callers queue behind it, so waits are first come
+    # first served and no caller holds the lock while it sleeps.
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, cost: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return max(0.0, -self.tokens / self.rate)
+
+_project_bucket = TokenBucket(PROJECT_QUOTA_PER_S)
+# A mailbox idle for a minute has a full bucket again, so dropping it is free
+_user_buckets = TTLCache("gmail_user_quota", maxsize=8192, ttl=60, sliding=True)
+_user_buckets_lock = threading.Lock()
+_user: ContextVar[str] = ContextVar("gmail_user", default="")
+_counts = {"calls": 0, "quotaWaits": 0, "retries": 0, "gaveUp": 0}
+_counts_lock = threading.Lock()
+
+@contextmanager
+def gmail_user(host_id: str):
+    # Gmail calls made inside are charged to host_id's mailbox bucket
+    token = _user.set(host_id)
+    try:
+        yield
+    finally:
+        _user.reset(token)
+
+def _user_bucket(host_id: str) -> TokenBucket:
+    with _user_buckets_lock:
+        return _user_buckets.get_or_load(host_id, lambda: TokenBucket(USER_QUOTA_PER_S))
+
+def _count(key: str):
+    with _counts_lock:
+        _counts[key] += 1
+
+def _throttled(op: str, kind: str, wait_s: float):
+    tenant = current_tenant()
+    THROTTLES.inc(tenant=tenant, op=op, kind=kind)
+    THROTTLE_SECONDS.inc(wait_s, tenant=tenant, kind=kind)
+
+def _reserve(op: str, cost: float) -> float:
+    # Takes cost from the mailbox and the project bucket; returns how long to
+    # wait before making the call
+    _count("calls")
+    host_id = _user.get()
+    wait_s = _user_bucket(host_id).take(cost) if host_id else 0.0
+    wait_s = max(wait_s, _project_bucket.take(cost))
+    if wait_s > 0:
+        _count("quotaWaits")
+        _throttled(op, "quota_wait", wait_s)
+    return wait_s
+
+def acquire(op: str, cost: float):
+    # Blocks until both the mailbox and the project bucket cover cost
+    wait_s = _reserve(op, cost)
+    if wait_s > 0:
+        time.sleep(wait_s)
+
+# Errors come from googleapiclient (HttpError) or, on the async path, httpx
+# (HTTPStatusError, with .response)
+def http_status(e: Exception) -> Optional[int]:
+    if isinstance(e, HttpError):
+        return e.resp.status
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _error_reason(e: Exception) -> str:
+    if isinstance(e, HttpError):
+        details = e.error_details if isinstance(e.error_details, list) else []
+    else:
+        try:
+            details = e.response.json()["error"].get("errors") or []
+        except Exception:
+            details = []
+    for d in details:
+        if isinstance(d, dict) and d.get("reason"):
+            return d["reason"]
+    return ""
+
+def _retry_after(e: Exception) -> Optional[str]:
+    headers = e.resp if isinstance(e, HttpError) else getattr(getattr(e, "response", None), "headers", None)
+    return headers.get("retry-after") if hasattr(headers, "get") else None
+
+def is_retryable(e: Exception, op: str) -> bool:
+    status = http_status(e)
+    if status is None:
+        return False
+    if status == 403:
+        return _error_reason(e) in RATE_LIMIT_REASONS
+    return status in (SEND_RETRYABLE_STATUS if op == "messages.send" else RETRYABLE_STATUS)
+
+def _backoff_s(e: Exception, attempt: int) -> float:
+    retry_after = _retry_after(e)
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # "Full jitter": anywhere up to the exponential step
+    return random.uniform(0, min(RETRY_MAX_S, RETRY_BASE_S * 2 ** attempt))
+
+def _retry_delay(e: Exception, op: str, attempt: int, waited: float) -> Optional[float]:
+    # How long to back off before trying again, or None to give up and raise
+    if not is_retryable(e, op):
+        return None
+    delay = _backoff_s(e, attempt)
+    if attempt == MAX_RETRIES or waited + delay > RETRY_BUDGET_S:
+        _count("gaveUp")
+        _throttled(op, "gave_up", 0.0)
+        return None
+    _count("retries")
+    _throttled(op, "retry_" + str(http_status(e)), delay)
+    return delay
+
+def call(op: str, cost: float, fn: Callable):
+    waited = 0.0
+    for attempt in range(MAX_RETRIES + 1):
+        acquire(op, cost)
+        try:
+            return fn()
+        except Exception as e:
+            delay = _retry_delay(e, op, attempt, waited)
+            if delay is None:
+                raise
+            waited += delay
+            time.sleep(delay)
+
+async def acall(op: str, cost: float, fn: Callable[[], Awaitable]):
+    # call() for coroutines: fn() makes a fresh request each attempt
+    waited = 0.0
+    for attempt in range(MAX_RETRIES + 1):
+        wait_s = _reserve(op, cost)
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+        try:
+            return await fn()
+        except Exception as e:
+            delay = _retry_delay(e, op, attempt, waited)
+            if delay is None:
+                raise
+            waited += delay
+            await asyncio.sleep(delay)
+
+def quota_stats() -> Dict:
+    with _counts_lock:
+        counts = dict(_counts)
+    return {"name": "gmail_quota", **counts, "userBuckets": len(_user_buckets),
+            "userQuotaPerS": USER_QUOTA_PER_S, "projectQuotaPerS": PROJECT_QUOTA_PER_S}
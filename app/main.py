@@ -1,26 +1,44 @@
-import os
+import hmac, os, time
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI, Request, HTTPException, Form
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, PlainTextResponse
 from pydantic_settings import BaseSettings
+from starlette.concurrency import run_in_threadpool
 
-from app.gmail_io import oauth_flow, gmail_service, send_reply
+from app.aio import offload
+from app.gmail_io import oauth_flow, parse_push_notification, pool_stats
+from app.gmail_quota import quota_stats
 from app.tenants import (
     upsert_tenant,
     set_active,
     get_tenant,
-    list_active_hosts,
+    iter_active_tenants,
     save_listing_config,
     get_listing_config,
+    cache_stats,
 )
-from app.token_store import save_gmail_creds, load_gmail_creds
-from app.poller import process_host
+from app.token_store import save_gmail_creds
+from app.credential_manager import forget_credentials, credential_stats
+from app.poller import poll_active, poll_active_aio, process_host, process_host_aio, renew_watch
+from app.reply_cache import reply_cache_stats
 from app.approvals import verify_token
+from app.outbox import (
+    enqueue_send,
+    enqueue_send_aio,
+    enqueue_sends,
+    enqueue_sends_aio,
+    send_status,
+    send_status_aio,
+    send_queue_stats,
+)
+from app.metrics import render as render_metrics
+from app.warmup import start_warmup, warmup_status
 from app.datastore import (
     get_draft,
-    set_draft_status,
-    delete_draft,
-    log_message,
-    upsert_thread_marker,
+    get_draft_aio,
+    transition_draft,
+    transition_draft_aio,
 )
 
 
@@ -36,6 +54,26 @@ class Settings(BaseSettings):
     SECRET_KEY: str = "local-dev-super-random-string"
     APPROVE_MODE: bool = False
 
+    # Polling: hosts processed in parallel, and the time each one may take
+    POLL_WORKERS: int = 8
+    POLL_HOST_BUDGET_S: float = 120.0
+    # Tenants read per page, and how long one /poll keeps starting new hosts
+    POLL_PAGE_SIZE: int = 200
+    POLL_BUDGET_S: float = 240.0
+
+    # Serve /poll, push and the approval routes on the event loop (httpx
+    # Gmail, async Vertex and Firestore) instead of a thread per request
+    ASYNC_IO: bool = False
+    # Hosts polled at once on the async path
+    POLL_AIO_CONCURRENCY: int = 64
+
+    # Gmail push: topic Gmail publishes to (projects/<id>/topics/<name>) and
+    # the token the Pub/Sub push subscription appends as ?token=... (required:
+    # /push/gmail refuses every request while it is empty)
+    PUBSUB_TOPIC: str = ""
+    PUSH_VERIFICATION_TOKEN: str = ""
+    WATCH_RENEW_BEFORE_S: int = 24 * 3600
+
     # GCP
     GCP_PROJECT_ID: str = ""
     GCP_LOCATION: str = "europe-west2"
@@ -43,13 +81,34 @@ class Settings(BaseSettings):
     # Model (if/when used by poller)
     MODEL: str = "gemini-1.5-pro"
 
+    # Load the Google client libraries in the background as soon as the app
+    # starts, instead of on the first request that needs each one
+    WARMUP_ON_START: bool = True
+
     class Config:
         env_file = ".env"
         extra = "ignore"
 
 
 settings = Settings()
-app = FastAPI(title="AI Cohost (Multi-tenant)")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.WARMUP_ON_START:
+        start_warmup()
+    yield
+
+
+app = FastAPI(title="AI Cohost (Multi-tenant)", lifespan=lifespan)
+
+
+async def _io(aio_fn, sync_fn, *args, **kwargs):
+    # The async path when ASYNC_IO is on; otherwise the blocking one on
+    # Starlette's threadpool, where FastAPI runs sync routes anyway
+    if settings.ASYNC_IO:
+        return await aio_fn(*args, **kwargs)
+    return await run_in_threadpool(sync_fn, *args, **kwargs)
 
 
 @app.get("/")
@@ -132,58 +191,157 @@ def oauth_callback(request: Request):
             "client_id": creds.client_id,
             "client_secret": creds.client_secret,
             "scopes": creds.scopes,
+            "expiry": creds.expiry,
         },
     )
+    forget_credentials(host_id)
     set_active(host_id, True)
     return {"ok": True, "hostId": host_id}
 
 
 # ---------- Poll all active tenants ----------
 @app.post("/poll")
-def poll_all():
+async def poll_all(force: bool = False, cursor: Optional[str] = None):
+    # Only hosts whose adaptive schedule says they are due, unless forced.
+    # Tenants are streamed in pages; a run that hits POLL_BUDGET_S returns
+    # nextCursor and the next /poll resumes there (cursor="" restarts).
+    opts = dict(
+        approve_mode=settings.APPROVE_MODE,
+        host_budget_s=settings.POLL_HOST_BUDGET_S,
+        page_size=settings.POLL_PAGE_SIZE,
+        budget_s=settings.POLL_BUDGET_S,
+        cursor=cursor,
+        force=force,
+    )
+    if settings.ASYNC_IO:
+        out = await poll_active_aio(concurrency=settings.POLL_AIO_CONCURRENCY, **opts)
+    else:
+        out = await run_in_threadpool(poll_active, workers=settings.POLL_WORKERS, **opts)
+    return {"ok": True, **out}
+
+
+# ---------- Gmail push (Pub/Sub) ----------
+@app.post("/push/gmail/{hostId}")
+async def gmail_push(hostId: str, envelope: dict, token: str = ""):
+    # Without a token anyone could make this instance sync any mailbox, so an
+    # unset PUSH_VERIFICATION_TOKEN turns push off rather than the check
+    if not settings.PUSH_VERIFICATION_TOKEN:
+        raise HTTPException(status_code=403, detail="push_not_configured")
+    if not hmac.compare_digest(token, settings.PUSH_VERIFICATION_TOKEN):
+        raise HTTPException(status_code=403, detail="bad_push_token")
+
+    # Anything we can't act on is still acked with a 2xx, otherwise Pub/Sub
+    # keeps redelivering it.
+    note = parse_push_notification(envelope)
+    if not note:
+        return {"ok": True, "ignored": "bad_message"}
+
+    # Cached tenant read; a miss blocks, so it goes off the loop either way
+    tenant = await (offload(get_tenant, hostId) if settings.ASYNC_IO else run_in_threadpool(get_tenant, hostId))
+    if not tenant or not tenant.get("active"):
+        return {"ok": True, "ignored": "inactive_host"}
+
+    cursor = tenant.get("gmailHistoryId")
+    if cursor and int(note["historyId"]) <= int(cursor):
+        return {"ok": True, "skipped": "already_synced"}
+
+    # Wait for an in-flight poll of this host rather than dropping the push
+    result = await _io(process_host_aio, process_host, hostId, approve_mode=settings.APPROVE_MODE, lock_wait_s=30)
+    if result.get("skipped") in ("leased", "busy"):
+        # Another instance (leased) or a run here that outlasted the wait
+        # (busy) is polling this host and may already be past the new message;
+        # a non-2xx makes Pub/Sub redeliver it later.
+        raise HTTPException(status_code=503, detail="host_" + result["skipped"])
+    return {"ok": True, "result": result}
+
+
+@app.post("/watch/renew")
+def watch_renew():
+    if not settings.PUBSUB_TOPIC:
+        raise HTTPException(status_code=400, detail="PUBSUB_TOPIC not set")
+
+    renew_by_ms = int((time.time() + settings.WATCH_RENEW_BEFORE_S) * 1000)
     results = []
-    for host_id in list_active_hosts():
-        results.append(process_host(host_id, approve_mode=settings.APPROVE_MODE))
+    for page in iter_active_tenants(settings.POLL_PAGE_SIZE):
+        for host_id, tenant in page:
+            if int(tenant.get("gmailWatchExpiration") or 0) > renew_by_ms:
+                continue
+            try:
+                results.append(renew_watch(host_id, settings.PUBSUB_TOPIC))
+            except Exception as e:
+                results.append({"hostId": host_id, "error": str(e)})
     return {"ok": True, "results": results}
 
 
 # ---------- Approval routes ----------
+# What a click on an approval link shows, by the draft's send status
+_SEND_PAGES = {
+    "queued": ("<h3>📨 Queued. The reply is on its way to the guest.</h3>", 202),
+    "sending": ("<h3>📨 Already being sent to the guest.</h3>", 200),
+    "sent": ("<h3>✅ Already sent to guest.</h3>", 200),
+    "failed": ("<h3>⚠️ Sending this reply failed part-way. Check your Gmail Sent folder before replying again.</h3>", 409),
+    "rejected": ("<h3>🛑 This draft was rejected.</h3>", 409),
+    "superseded": ("<h3>The guest wrote again; this draft was replaced by a newer one.</h3>", 409),
+    "not_found": ("<h3>Draft not found.</h3>", 404),
+    # Drafts the LLM couldn't answer in time have no text to approve
+    "empty": ("<h3>This draft is empty. Use Edit &amp; Send to write the reply.</h3>", 400),
+}
+
+def _send_page(status: str, token: str) -> HTMLResponse:
+    html, code = _SEND_PAGES.get(status, (f"<h3>Draft is {status}.</h3>", 409))
+    if status in ("queued", "sending"):
+        html += f'<p><a href="/send/status?token={token}">Check status</a></p>'
+    return HTMLResponse(html, status_code=code)
+
 @app.get("/approve", response_class=HTMLResponse)
-def approve(token: str):
+async def approve(token: str):
     data = verify_token(token)
     if data.get("a") != "approve":
         return HTMLResponse("<h3>Invalid action.</h3>", status_code=400)
 
-    host_id, draft_id = data["h"], data["d"]
-    d = get_draft(host_id, draft_id)
-    if not d:
-        return HTMLResponse("<h3>Draft not found.</h3>", status_code=404)
+    return _send_page(await _io(enqueue_send_aio, enqueue_send, data["h"], data["d"]), token)
 
-    creds = load_gmail_creds(host_id)
-    if not creds:
-        return HTMLResponse("<h3>Host not connected.</h3>", status_code=400)
 
-    svc = gmail_service(creds)
-    send_reply(svc, d["to_addr"], d["subject"], d["body"], d["thread_id"])
+@app.get("/approve/all", response_class=HTMLResponse)
+async def approve_all(token: str):
+    data = verify_token(token)
+    if data.get("a") != "approve_all":
+        return HTMLResponse("<h3>Invalid action.</h3>", status_code=400)
 
-    log_message(host_id, d["thread_id"], "outbound", d["body"], {"approved": True})
-    upsert_thread_marker(host_id, d["thread_id"], draft_id)
-    set_draft_status(host_id, draft_id, "sent")
-    delete_draft(host_id, draft_id)
+    items = [(draft_id, None) for draft_id in data.get("ds", [])]
+    statuses = await _io(enqueue_sends_aio, enqueue_sends, data["h"], items)
+    queued = sum(1 for s in statuses.values() if s == "queued")
+    skipped = len(statuses) - queued
+    note = f" {skipped} already handled or empty; use their Edit links." if skipped else ""
+    return HTMLResponse(
+        f"<h3>📨 Queued {queued} of {len(statuses)} replies for sending.{note}</h3>"
+        f'<p><a href="/send/status?token={token}">Check status</a></p>',
+        status_code=202,
+    )
 
-    return HTMLResponse("<h3>✅ Sent to guest.</h3>")
+
+@app.get("/send/status")
+async def get_send_status(token: str):
+    data = verify_token(token)
+    if data.get("a") not in ("approve", "edit", "approve_all"):
+        raise HTTPException(status_code=400, detail="invalid_action")
+    draft_ids = data.get("ds") or [data["d"]]
+    jobs = [await _io(send_status_aio, send_status, data["h"], d) for d in draft_ids]
+    return {"ok": True, "hostId": data["h"], "jobs": jobs}
 
 
 @app.get("/edit", response_class=HTMLResponse)
-def edit(token: str):
+async def edit(token: str):
     data = verify_token(token)
     if data.get("a") != "edit":
         return HTMLResponse("<h3>Invalid action.</h3>", status_code=400)
 
     host_id, draft_id = data["h"], data["d"]
-    d = get_draft(host_id, draft_id)
+    d = await _io(get_draft_aio, get_draft, host_id, draft_id)
     if not d:
         return HTMLResponse("<h3>Draft not found.</h3>", status_code=404)
+    if d.get("status", "pending") != "pending":
+        return _send_page(d["status"], token)
 
     html = f"""
     <html><body style="font-family: system-ui; max-width:700px; margin:2rem auto;">
@@ -203,51 +361,48 @@ def edit(token: str):
 
 
 @app.post("/edit/send", response_class=HTMLResponse)
-def edit_send(token: str = Form(...), body: str = Form(...)):
+async def edit_send(token: str = Form(...), body: str = Form(...)):
     data = verify_token(token)
     if data.get("a") not in ("edit", "approve"):
         return HTMLResponse("<h3>Invalid action.</h3>", status_code=400)
 
-    host_id, draft_id = data["h"], data["d"]
-    d = get_draft(host_id, draft_id)
-    if not d:
-        return HTMLResponse("<h3>Draft not found.</h3>", status_code=404)
-
-    creds = load_gmail_creds(host_id)
-    if not creds:
-        return HTMLResponse("<h3>Host not connected.</h3>", status_code=400)
-
-    svc = gmail_service(creds)
-    send_reply(svc, d["to_addr"], d["subject"], body, d["thread_id"])
-
-    log_message(
-        host_id,
-        d["thread_id"],
-        "outbound",
-        body,
-        {"approved": True, "edited": True},
-    )
-    upsert_thread_marker(host_id, d["thread_id"], draft_id)
-    set_draft_status(host_id, draft_id, "sent")
-    delete_draft(host_id, draft_id)
-
-    return HTMLResponse("<h3>✅ Edited reply sent to guest.</h3>")
+    return _send_page(await _io(enqueue_send_aio, enqueue_send, data["h"], data["d"], body), token)
 
 
 @app.get("/reject", response_class=HTMLResponse)
-def reject(token: str):
+async def reject(token: str):
     data = verify_token(token)
     if data.get("a") != "reject":
         return HTMLResponse("<h3>Invalid action.</h3>", status_code=400)
 
-    host_id, draft_id = data["h"], data["d"]
-    if get_draft(host_id, draft_id):
-        set_draft_status(host_id, draft_id, "rejected")
-        delete_draft(host_id, draft_id)
+    # Only a draft nobody has approved yet can be rejected
+    moved, d = await _io(transition_draft_aio, transition_draft, data["h"], data["d"], ["pending"], "rejected")
+    if d and not moved:
+        return _send_page(d.get("status", "pending"), token)
 
     return HTMLResponse("<h3>🛑 Draft rejected. No message sent.</h3>")
 
 
+@app.get("/cache/stats")
+def get_cache_stats():
+    return {"ok": True, "caches": cache_stats() + [pool_stats(), quota_stats(), credential_stats(), reply_cache_stats(), send_queue_stats()]}
+
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/healthz")
 def healthz():
     return {"ok": True}
+
+
+@app.get("/warmup")
+def warmup(wait: float = 0):
+    # Starts loading the Google client libraries if that isn't already under
+    # way; wait: seconds to block for it to finish (e.g. from a startup probe)
+    thread = start_warmup()
+    if wait > 0:
+        thread.join(timeout=min(wait, 60))
+    return {"ok": True, **warmup_status()}
@@ -0,0 +1,154 @@
+import bisect, os, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple
+
+# In-process metrics in the Prometheus text format, served at /metrics.
+# Kept dependency-free: a counter or histogram update is one lock and a few
+# list operations, cheap enough to leave on everywhere.
+#
+# The tenant label comes from a context variable set around each host's work
+# (tenant_context), so backend calls deep in gmail_io/storage are attributed
+# without passing host ids around. Past METRICS_MAX_TENANTS distinct tenants
+# new ones are reported as "_other"; METRICS_TENANT_LABEL=false drops the
+# label altogether.
+TENANT_LABEL = os.getenv("METRICS_TENANT_LABEL", "true").lower() in ("1", "true", "yes")
+MAX_TENANTS = int(os.getenv("METRICS_MAX_TENANTS", "500"))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_tenant: ContextVar[str] = ContextVar("metrics_tenant", default="")
+_seen_tenants: set = set()
+_seen_lock = threading.Lock()
+
+@contextmanager
+def tenant_context(host_id: str):
+    token = _tenant.set(host_id)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+def current_tenant() -> str:
+    if not TENANT_LABEL:
+        return ""
+    t = _tenant.get()
+    if not t or t in _seen_tenants:
+        return t
+    with _seen_lock:
+        if len(_seen_tenants) >= MAX_TENANTS:
+            return "_other"
+        _seen_tenants.add(t)
+    return t
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values) if v != "" or n != "tenant"]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {v:g}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket (non-cumulative) + overflow, sum]
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][i] += 1
+            s[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(s[0]), s[1]) for k, s in sorted(self._series.items())]
+        for key, counts, total in series:
+            cumulative = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le_s = "+Inf" if le == float("inf") else f"{le:g}"
+                labels = _fmt_labels(self.labelnames, key, 'le="' + le_s + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+STAGE_SECONDS = Histogram("cohost_stage_seconds", "Time spent in each processing stage.",
+                          ("stage", "tenant", "outcome"))
+BACKEND_SECONDS = Histogram("cohost_backend_call_seconds", "Latency of calls to Gmail, storage and Vertex.",
+                            ("backend", "op", "tenant", "outcome"))
+MESSAGES = Counter("cohost_messages_total", "Guest messages processed, by outcome.", ("tenant", "outcome"))
+HOST_RUNS = Counter("cohost_host_runs_total", "process_host runs, by outcome.", ("tenant", "outcome"))
+
+_registry = [STAGE_SECONDS, BACKEND_SECONDS, MESSAGES, HOST_RUNS]
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+@contextmanager
+def stage(name: str):
+    # Times a block of process_host work; an exception marks it "error"
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=name, tenant=current_tenant(), outcome=outcome)
+
+@contextmanager
+def backend_call(backend: str, op: str):
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = (getattr(getattr(e, "resp", None), "status", None)  # HttpError
+                  or getattr(getattr(e, "response", None), "status_code", None))  # httpx
+        outcome = f"http_{status}" if status else "error"
+        raise
+    finally:
+        BACKEND_SECONDS.observe(time.perf_counter() - t0, backend=backend, op=op,
+                                tenant=current_tenant(), outcome=outcome)
+
+def count_message(outcome: str, n: int = 1):
+    MESSAGES.inc(n, tenant=current_tenant(), outcome=outcome)
+
+def count_host_run(outcome: str):
+    HOST_RUNS.inc(tenant=current_tenant(), outcome=outcome)
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
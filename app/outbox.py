@@ -0,0 +1,241 @@
+import asyncio, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from google.auth.exceptions import RefreshError
+import httpx
+from googleapiclient.errors import HttpError
+from app.aio import offload
+from app.gmail_io import pooled_service, send_reply
+from app.gmail_async import AsyncGmail
+from app.gmail_quota import is_retryable
+from app.datastore import (
+    UnitOfWork, get_draft, get_drafts, transition_draft, unit_of_work,
+    get_draft_aio, get_drafts_aio, transition_draft_aio,
+)
+from app.credential_manager import get_credentials
+from app.metrics import stage, tenant_context
+
+# Approved replies go out through a background send queue. A job is keyed by
+# draft id and its state lives on the draft itself:
+#   pending -> queued -> sending -> sent
+# Every move is a compare-and-set in storage, so a double click, a retried
+# link or a second instance can't queue the same draft twice, and only the
+# worker that moves it to "sending" calls Gmail. Sends Gmail refused outright
+# (429/503, retried with backoff in gmail_quota) or a host that isn't
+# connected send the draft back to "pending" so its link works again.
+# Any other error after "sending" may have reached the guest, so the draft is
+# parked as "failed" for the host to check rather than sent again.
+# On the async request path (the *_aio functions) the same jobs run as tasks
+# on the event loop instead of on the worker threads.
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+# A draft left "queued" this long (e.g. the instance restarted) is picked up again
+SEND_REQUEUE_AFTER_S = float(os.getenv("SEND_REQUEUE_AFTER_S", "120"))
+
+class NotSent(Exception):
+    # The reply definitely did not go out
+    pass
+
+def _enqueue_action(d: Optional[Dict], body: Optional[str]) -> str:
+    # What enqueue does with a draft: "claim" it (pending -> queued),
+    # "requeue" a stuck one, or leave it ("duplicate", "not_found", "empty")
+    if not d:
+        return "not_found"
+    status = d.get("status", "pending")
+    if status == "pending":
+        if not (body if body is not None else d.get("body", "")).strip():
+            return "empty"
+        return "claim"
+    if status == "queued" and time.time() - float(d.get("queuedAt") or 0) > SEND_REQUEUE_AFTER_S:
+        # Its worker never ran; the claim in _deliver stops a double send
+        return "requeue"
+    return "duplicate"
+
+def _queue_fields(body: Optional[str]) -> Dict:
+    return {"sendBody": body, "queuedAt": time.time(), "error": None}
+
+def _send_text(d: Dict) -> Tuple[str, bool]:
+    edited = d.get("sendBody") is not None
+    return (d["sendBody"] if edited else d["body"]), edited
+
+def _record_sent(uow, d: Dict, draft_id: str, text: str, edited: bool):
+    # The draft stays behind as "sent": that record is what makes a repeated
+    # approval a no-op.
+    uow.log_message(d["thread_id"], "outbound", text, {"approved": True, "edited": True} if edited else {"approved": True})
+    uow.upsert_thread_marker(d["thread_id"], draft_id)
+    uow.set_draft_status(draft_id, "sent")
+
+class SendQueue:
+    def __init__(self, workers: int = SEND_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="send")
+        self._guard = threading.Lock()
+        self._tasks: set = set()
+        self.counts = {"queued": 0, "duplicate": 0, "requeued": 0, "sent": 0, "returned": 0, "failed": 0}
+
+    def _count(self, key: str):
+        with self._guard:
+            self.counts[key] += 1
+
+    def enqueue(self, host_id: str, items: List[Tuple[str, Optional[str]]]) -> Dict[str, str]:
+        # items: (draft id, edited body or None to send the draft as written).
+        # Returns each draft's status after the call: "queued" for a new job,
+        # otherwise whatever it already was, or "not_found" / "empty".
+        drafts = get_drafts(host_id, [draft_id for draft_id, _ in items])
+        out = {}
+        for draft_id, body in items:
+            d = drafts.get(draft_id)
+            action = _enqueue_action(d, body)
+            if action == "claim":
+                moved, d = transition_draft(host_id, draft_id, ["pending"], "queued", _queue_fields(body))
+                if moved:
+                    self._pool.submit(self._run, host_id, draft_id)
+                action = "queued" if moved else "duplicate"
+            elif action == "requeue":
+                self._pool.submit(self._run, host_id, draft_id)
+            out[draft_id] = self._enqueued(action, d)
+        return out
+
+    async def enqueue_aio(self, host_id: str, items: List[Tuple[str, Optional[str]]]) -> Dict[str, str]:
+        # enqueue for the async path: sends run as tasks on the event loop
+        drafts = await get_drafts_aio(host_id, [draft_id for draft_id, _ in items])
+        out = {}
+        for draft_id, body in items:
+            d = drafts.get(draft_id)
+            action = _enqueue_action(d, body)
+            if action == "claim":
+                moved, d = await transition_draft_aio(host_id, draft_id, ["pending"], "queued", _queue_fields(body))
+                if moved:
+                    self._start_aio(host_id, draft_id)
+                action = "queued" if moved else "duplicate"
+            elif action == "requeue":
+                self._start_aio(host_id, draft_id)
+            out[draft_id] = self._enqueued(action, d)
+        return out
+
+    def _enqueued(self, action: str, d: Optional[Dict]) -> str:
+        if action in ("not_found", "empty"):
+            return action
+        self._count("requeued" if action == "requeue" else action)
+        return d.get("status", "pending") if d else "not_found"
+
+    def _start_aio(self, host_id: str, draft_id: str):
+        # Keep a reference: the loop only holds tasks weakly
+        task = asyncio.ensure_future(self._run_aio(host_id, draft_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _run(self, host_id: str, draft_id: str):
+        with tenant_context(host_id), stage("send"):
+            self._deliver(host_id, draft_id)
+
+    def _deliver(self, host_id: str, draft_id: str):
+        moved, d = transition_draft(host_id, draft_id, ["queued"], "sending", {"sendingAt": time.time()})
+        if not moved:
+            return
+        text, edited = _send_text(d)
+        try:
+            self._send(host_id, d, text)
+        except NotSent as e:
+            self._count("returned")
+            transition_draft(host_id, draft_id, ["sending"], "pending", {"error": str(e)})
+            return
+        except Exception as e:
+            print(f"Warning: sending draft {host_id}/{draft_id} failed: {e}")
+            self._count("failed")
+            transition_draft(host_id, draft_id, ["sending"], "failed", {"error": str(e)})
+            return
+
+        with unit_of_work(host_id) as uow:
+            _record_sent(uow, d, draft_id, text, edited)
+        self._count("sent")
+
+    async def _run_aio(self, host_id: str, draft_id: str):
+        with tenant_context(host_id), stage("send"):
+            try:
+                await self._deliver_aio(host_id, draft_id)
+            except Exception as e:
+                # Nothing awaits this task; a draft left in "sending" shows up in /send/status
+                print(f"Warning: sending draft {host_id}/{draft_id} failed: {e}")
+
+    async def _deliver_aio(self, host_id: str, draft_id: str):
+        moved, d = await transition_draft_aio(host_id, draft_id, ["queued"], "sending", {"sendingAt": time.time()})
+        if not moved:
+            return
+        text, edited = _send_text(d)
+        try:
+            await self._send_aio(host_id, d, text)
+        except NotSent as e:
+            self._count("returned")
+            await transition_draft_aio(host_id, draft_id, ["sending"], "pending", {"error": str(e)})
+            return
+        except Exception as e:
+            print(f"Warning: sending draft {host_id}/{draft_id} failed: {e}")
+            self._count("failed")
+            await transition_draft_aio(host_id, draft_id, ["sending"], "failed", {"error": str(e)})
+            return
+
+        uow = UnitOfWork(host_id)
+        _record_sent(uow, d, draft_id, text, edited)
+        await uow.commit_aio()
+        self._count("sent")
+
+    def _send(self, host_id: str, d: Dict, text: str):
+        try:
+            creds = get_credentials(host_id)
+        except RefreshError as e:
+            raise NotSent(f"host token refresh failed: {e}")
+        if not creds:
+            raise NotSent("host not connected")
+        try:
+            with pooled_service(host_id, creds) as svc:
+                return send_reply(svc, d["to_addr"], d["subject"], text, d["thread_id"])
+        except HttpError as e:
+            # gmail_quota has already backed off and retried these
+            if is_retryable(e, "messages.send"):
+                raise NotSent(f"Gmail returned {e.resp.status}")
+            raise
+
+    async def _send_aio(self, host_id: str, d: Dict, text: str):
+        try:
+            creds = await offload(get_credentials, host_id)
+        except RefreshError as e:
+            raise NotSent(f"host token refresh failed: {e}")
+        if not creds:
+            raise NotSent("host not connected")
+        try:
+            return await AsyncGmail(host_id, creds).send_reply(d["to_addr"], d["subject"], text, d["thread_id"])
+        except httpx.HTTPStatusError as e:
+            if is_retryable(e, "messages.send"):
+                raise NotSent(f"Gmail returned {e.response.status_code}")
+            raise
+
+    def stats(self) -> Dict:
+        with self._guard:
+            return {"name": "send_queue", **self.counts}
+
+_queue = SendQueue()
+
+def enqueue_send(host_id: str, draft_id: str, body: Optional[str] = None) -> str:
+    return _queue.enqueue(host_id, [(draft_id, body)])[draft_id]
+
+def enqueue_sends(host_id: str, items: List[Tuple[str, Optional[str]]]) -> Dict[str, str]:
+    return _queue.enqueue(host_id, items)
+
+async def enqueue_send_aio(host_id: str, draft_id: str, body: Optional[str] = None) -> str:
+    return (await _queue.enqueue_aio(host_id, [(draft_id, body)]))[draft_id]
+
+async def enqueue_sends_aio(host_id: str, items: List[Tuple[str, Optional[str]]]) -> Dict[str, str]:
+    return await _queue.enqueue_aio(host_id, items)
+
+def _status_doc(draft_id: str, d: Optional[Dict]) -> Dict:
+    if not d:
+        return {"draftId": draft_id, "status": "not_found"}
+    return {"draftId": draft_id, "status": d.get("status", "pending"), "error": d.get("error")}
+
+def send_status(host_id: str, draft_id: str) -> Dict:
+    return _status_doc(draft_id, get_draft(host_id, draft_id))
+
+async def send_status_aio(host_id: str, draft_id: str) -> Dict:
+    return _status_doc(draft_id, await get_draft_aio(host_id, draft_id))
+
+def send_queue_stats() -> Dict:
+    return _queue.stats()
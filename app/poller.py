@@ -1,79 +1,876 @@
-from typing import Dict
-from app.gmail_io import gmail_service, list_messages, get_message, extract_plain, send_reply
+import asyncio, os, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+from app.gmail_io import (
+    pooled_service, sync_messages, batch_get_messages, message_headers,
+    extract_plain, send_reply, is_guest_message, watch_inbox, TRIAGE_HEADERS,
+)
 from app.router import propose_template
-from app.vertex_reply import llm_reply
-from app.datastore import log_message, upsert_thread_marker, last_processed_id, create_draft
-from app.tenants import get_listing_config, get_tenant
-from app.token_store import load_gmail_creds
-from app.approvals import approval_links
+from app.reply_cache import cached_llm_reply_async, cached_llm_reply_aio, release_llm_reply
+from app.datastore import (
+    UnitOfWork, get_drafts, get_drafts_aio, thread_markers, thread_markers_aio, transition_draft, transition_draft_aio,
+)
+from app.tenants import (
+    get_listing_config, save_sync_cursor, save_watch,
+    iter_active_tenants, load_poll_cursor, save_poll_cursor,
+    acquire_host_lease, acquire_host_leases, renew_host_leases, release_host_lease,
+    release_host_leases, POLL_LEASE_TTL_S, POLL_LEASE_COOLDOWN_S,
+)
+from app.credential_manager import get_credentials
+from app.aio import offload
+from app.gmail_async import AsyncGmail
+from app.storage import storage
+from app.storage_async import astorage
+from app.approvals import approval_links, approve_all_link
+from app.scheduler import record_poll, due_hosts
+from app.vertex_reply import MAX_CONCURRENCY as LLM_LOOKAHEAD, TIMEOUT_S as LLM_TIMEOUT_S
+from app.conversation import render_context
+from app.metrics import count_host_run, count_message, stage, tenant_context
 
-def _send_host_approval_email(svc, host_email: str, subject: str, preview: str, links: Dict[str,str]):
+NO_DRAFT_NOTE = "(no AI draft; the reply service did not answer in time. Use Edit & Send.)"
+
+def _approval_email(subject: str, preview: str, links: Dict[str,str]) -> Tuple[str, str]:
     body = (
         "Approval needed for a guest reply.\n\n"
         f"Subject: {subject}\n\n"
         "Draft reply:\n"
         "--------------------------------\n"
-        f"{preview}\n"
+        f"{preview or NO_DRAFT_NOTE}\n"
         "--------------------------------\n\n"
         f"Approve: {links['approve']}\n"
         f"Edit & Send: {links['edit']}\n"
         f"Reject: {links['reject']}\n\n"
         "— AI Co-Host"
     )
-    return send_reply(svc, host_email, f"[Approve] {subject}", body_text=body, thread_id=None)
+    return f"[Approve] {subject}", body
+
+def _send_host_approval_email(svc, host_email: str, subject: str, preview: str, links: Dict[str,str]):
+    email_subject, body = _approval_email(subject, preview, links)
+    return send_reply(svc, host_email, email_subject, body_text=body, thread_id=None)
+
+# "digest" (default): one approval email per process_host run listing every
+# new draft; "per_draft": one email per draft as it is created
+APPROVAL_EMAIL_MODE = os.getenv("APPROVAL_EMAIL_MODE", "digest").lower()
+
+def _digest_email(host_id: str, drafts: List[Dict]) -> Tuple[str, str]:
+    # drafts: [{"draft_id", "subject", "text"}] created in this run
+    if len(drafts) == 1:
+        d = drafts[0]
+        return _approval_email(d["subject"], d["text"], approval_links(host_id, d["draft_id"]))
+    parts = [f"{len(drafts)} guest replies need approval.\n"]
+    for n, d in enumerate(drafts, 1):
+        links = approval_links(host_id, d["draft_id"])
+        parts.append(
+            f"{n}. Subject: {d['subject']}\n"
+            "--------------------------------\n"
+            f"{d['text'] or NO_DRAFT_NOTE}\n"
+            "--------------------------------\n"
+            f"Approve: {links['approve']}\n"
+            f"Edit & Send: {links['edit']}\n"
+            f"Reject: {links['reject']}\n"
+        )
+    ready = [d["draft_id"] for d in drafts if d["text"]]
+    if len(ready) > 1:
+        parts.append(f"Approve all {len(ready)} drafted replies: {approve_all_link(host_id, ready)}\n")
+    parts.append("— AI Co-Host")
+    return f"[Approve] {len(drafts)} guest replies", "\n".join(parts)
+
+def _send_host_digest_email(svc, host_email: str, host_id: str, drafts: List[Dict]):
+    email_subject, body = _digest_email(host_id, drafts)
+    return send_reply(svc, host_email, email_subject, body_text=body, thread_id=None)
+
+_host_locks: Dict[str, threading.Lock] = {}
+_host_locks_guard = threading.Lock()
+
+def _host_lock(host_id: str) -> threading.Lock:
+    with _host_locks_guard:
+        return _host_locks.setdefault(host_id, threading.Lock())
+
+class LeaseHeartbeat:
+    # Renews the poll leases of every host this instance is working on, all in
+    # one call every ttl/3, from a single background thread.
+    def __init__(self, ttl_s: float = POLL_LEASE_TTL_S):
+        self.ttl_s = ttl_s
+        self._held: Dict[str, int] = {}
+        self._guard = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.renewals = self.lost = 0
 
-def process_host(host_id: str, approve_mode: bool = False) -> Dict:
-    creds = load_gmail_creds(host_id)
+    def hold(self, host_id: str):
+        with self._guard:
+            self._held[host_id] = self._held.get(host_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+                self._thread.start()
+
+    def drop(self, host_id: str):
+        with self._guard:
+            if self._held.get(host_id, 0) <= 1:
+                self._held.pop(host_id, None)
+            else:
+                self._held[host_id] -= 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl_s / 3)
+            with self._guard:
+                hosts = list(self._held)
+            if not hosts:
+                continue
+            try:
+                kept = set(renew_host_leases(hosts, self.ttl_s))
+            except Exception as e:
+                print(f"Warning: renewing poll leases failed: {e}")
+                continue
+            self.renewals += 1
+            for h in hosts:
+                if h not in kept:
+                    self.lost += 1
+                    print(f"Warning: poll lease for {h} lost; another instance may also be processing it")
+
+_heartbeat = LeaseHeartbeat()
+
+def process_host(host_id: str, approve_mode: bool = False, deadline: Optional[float] = None,
+                 lock_wait_s: float = 0, leased: bool = False) -> Dict:
+    # Polls and push notifications can overlap for the same mailbox; only one
+    # run per host at a time, otherwise both would draft the same messages.
+    # The lock covers this instance, the poll lease every other one (leased:
+    # the caller already holds it).
+    with tenant_context(host_id), stage("process_host"):
+        try:
+            result = _claim_and_process(host_id, approve_mode, deadline, lock_wait_s, leased)
+        except Exception:
+            count_host_run("error")
+            raise
+        _count_run(result)
+        return result
+
+def _count_run(result: Dict):
+    if result.get("skipped"):
+        count_host_run("skipped_" + result["skipped"])
+    else:
+        count_host_run("budget_exhausted" if result.get("budget_exhausted") else "ok")
+
+def _claim_and_process(host_id: str, approve_mode: bool, deadline: Optional[float],
+                       lock_wait_s: float, leased: bool) -> Dict:
+    lock = _host_lock(host_id)
+    acquired = lock.acquire(timeout=lock_wait_s) if lock_wait_s > 0 else lock.acquire(blocking=False)
+    if not acquired:
+        return {"hostId": host_id, "skipped": "busy"}
+    try:
+        if leased:
+            return _process_host(host_id, approve_mode, deadline)
+        if not acquire_host_lease(host_id):
+            return {"hostId": host_id, "skipped": "leased"}
+        _heartbeat.hold(host_id)
+        try:
+            return _process_host(host_id, approve_mode, deadline)
+        finally:
+            _heartbeat.drop(host_id)
+            release_host_lease(host_id)
+    finally:
+        lock.release()
+
+def _process_host(host_id: str, approve_mode: bool, deadline: Optional[float]) -> Dict:
+    creds = get_credentials(host_id)
     if not creds:
         return {"hostId": host_id, "skipped": "no_creds"}
 
-    tenant = get_tenant(host_id) or {}
-    host_email = tenant.get("hostEmail")
-    svc = gmail_service(creds)
-    msgs = list_messages(svc)
-    handled, drafted = 0, 0
+    # Read past the tenant cache: record_poll builds the next schedule from
+    # this document's pollSchedule, which a cached copy may be polls behind
+    tenant = storage().get_tenant(host_id) or {}
+    with pooled_service(host_id, creds) as svc:
+        result = _process_mailbox(host_id, svc, tenant, approve_mode, deadline)
+    record_poll(host_id, tenant, result)
+    return result
 
+def _is_handled(marker: Optional[Dict], msg_id: str, internal_date: int) -> bool:
+    if not marker:
+        return False
+    if marker.get("lastInternalDate") is not None:
+        return internal_date <= int(marker["lastInternalDate"])
+    # Markers written before internal dates were recorded
+    return marker.get("lastMessageId") == msg_id
+
+def _unhandled_threads(msgs: List[Dict], metas: Dict[str, Dict], markers: Dict[str, Dict]) -> List[Tuple[str, List[Tuple[str, int, Dict]]]]:
+    # Guest messages not yet answered, grouped by thread as (thread id,
+    # [(message id, internalDate, headers)]) oldest first; threads ordered by
+    # their latest message.
+    groups: Dict[str, List[Tuple[str, int, Dict]]] = {}
     for m in msgs:
-        full = get_message(svc, m["id"])
-        headers = {h["name"].lower(): h["value"] for h in full["payload"]["headers"]}
-        subject = headers.get("subject","")
-        to_addr = headers.get("reply-to") or headers.get("from")
-        thread_id = full.get("threadId", m["id"])
-        msg_id = full.get("id")
-
-        if last_processed_id(host_id, thread_id) == msg_id:
+        meta = metas.get(m["id"])
+        if not meta:
+            continue
+        headers = message_headers(meta)
+        if not is_guest_message(headers):
             continue
+        thread_id = meta.get("threadId", m["id"])
+        internal_date = int(meta.get("internalDate") or 0)
+        if _is_handled(markers.get(thread_id), m["id"], internal_date):
+            continue
+        groups.setdefault(thread_id, []).append((m["id"], internal_date, headers))
+    for group in groups.values():
+        group.sort(key=lambda g: g[1])
+    return sorted(groups.items(), key=lambda kv: kv[1][-1][1])
+
+def _replaced_draft_ids(threads: List[Tuple[str, List[Tuple[str, int, Dict]]]], markers: Dict[str, Dict]) -> List[str]:
+    # The draft each thread's last reply left behind, if it got one: drafts
+    # are keyed by the message they reply to
+    return [m["lastMessageId"] for m in (markers.get(t) for t, _ in threads) if m and m.get("lastMessageId")]
+
+def _replaced_drafts(threads: List[Tuple[str, List[Tuple[str, int, Dict]]]], markers: Dict[str, Dict],
+                     drafts: Dict[str, Dict]) -> Dict[str, Tuple[str, List[str]]]:
+    # thread id -> (draft id, the message ids it answers) for threads whose
+    # last reply is a draft still pending. The guest wrote again before the
+    # host approved it, so the new reply answers those messages too and
+    # replaces it; a draft in any other state is left alone.
+    out = {}
+    for thread_id, _ in threads:
+        draft_id = (markers.get(thread_id) or {}).get("lastMessageId")
+        d = drafts.get(draft_id) if draft_id else None
+        if d and d.get("status", "pending") == "pending":
+            out[thread_id] = (draft_id, list(d.get("message_ids") or [draft_id]))
+    return out
+
+def _with_replaced(threads: List[Tuple[str, List[Tuple[str, int, Dict]]]], replaced: Dict[str, Tuple[str, List[str]]],
+                   fulls: Dict[str, Dict]) -> List[Tuple[str, List[Tuple[str, int, Dict]]]]:
+    # Puts a replaced draft's messages (fetched with the new ones) back in
+    # front of their thread's group
+    out = []
+    for thread_id, group in threads:
+        if thread_id in replaced:
+            ids = {m for m, _, _ in group}
+            earlier = [(m, int(fulls[m].get("internalDate") or 0), message_headers(fulls[m]))
+                       for m in replaced[thread_id][1] if m in fulls and m not in ids]
+            group = sorted(earlier + group, key=lambda g: g[1])
+        out.append((thread_id, group))
+    return out
+
+def _new_bodies(bodies: List[Tuple[str, str]], replaces: Optional[Tuple[str, List[str]]]) -> List[Tuple[str, str]]:
+    # The bodies not already logged with the draft being replaced
+    return [b for b in bodies if not replaces or b[0] not in replaces[1]]
+
+def _thread_request(thread_id: str, group: List[Tuple[str, int, Dict]], fulls: Dict[str, Dict],
+                    markers: Dict[str, Dict]) -> Optional[Tuple[List[Tuple[str, str]], str, str]]:
+    # What one thread's reply is asked for: ([(message id, body)], the bodies
+    # joined, the conversation before them), or None without any body
+    bodies = [(msg_id, extract_plain(fulls[msg_id]["payload"])) for msg_id, _, _ in group if msg_id in fulls]
+    if not bodies:
+        return None
+    combined = "\n\n".join(b for _, b in bodies if b.strip())
+    # The thread so far (before these messages), bounded in size
+    context = render_context((markers.get(thread_id) or {}).get("conversation"))
+    return bodies, combined, context
+
+def _template_reply(bodies: List[Tuple[str, str]], combined: str, listing_cfg: Dict) -> Tuple[str, bool]:
+    # A template answers only the questions it recognises, so several
+    # messages get one only if each of them would on its own; otherwise the
+    # LLM answers them all rather than one being silently skipped
+    if len(bodies) > 1 and not all(propose_template(b, "there", listing_cfg)[0] for _, b in bodies if b.strip()):
+        return "", False
+    text, auto_ok, _ = propose_template(combined, "there", listing_cfg)
+    return text, auto_ok
+
+def _reply_target(group: List[Tuple[str, int, Dict]]) -> Tuple[str, int, str, str]:
+    # Reply to the latest message; it carries the current subject
+    msg_id, internal_date, headers = group[-1]
+    return msg_id, internal_date, headers.get("subject",""), headers.get("reply-to") or headers.get("from")
+
+def _record_thread(uow, thread_id: str, group: List[Tuple[str, int, Dict]], bodies: List[Tuple[str, str]],
+                   text: str, source: str, auto_ok: bool, sent: bool,
+                   replaces: Optional[Tuple[str, List[str]]] = None):
+    # Queues everything a thread's reply leaves behind in one unit of work, so
+    # a crash can't leave a draft without its thread marker (or the reverse).
+    # The draft, if any, is keyed by the message replied to.
+    msg_id, internal_date, subject, to_addr = _reply_target(group)
+    for _, body in _new_bodies(bodies, replaces):
+        uow.log_message(thread_id, "inbound", body, {"subject": subject})
+    if sent:
+        uow.log_message(thread_id, "outbound", text, {"auto_sent": True, "source": source})
+    else:
+        draft = {
+            "thread_id": thread_id,
+            "to_addr": to_addr,
+            "subject": subject,
+            "body": text,
+            "source": source,
+            "auto_ok": auto_ok
+        }
+        if len(bodies) > 1:
+            draft["message_ids"] = [m for m, _ in bodies]
+        uow.create_draft(msg_id, draft)
+        uow.log_message(thread_id, "draft", text, {"auto_sent": False, "source": source})
+    uow.upsert_thread_marker(thread_id, msg_id, internal_date)
+
+def _past(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() > deadline
+
+def _llm_text(host_id: str, thread_id: str, fut: Future, deadline: Optional[float]) -> Optional[Tuple[str, str]]:
+    # (text, source) for a thread's LLM reply, waiting at most VERTEX_TIMEOUT_S
+    # from when Vertex took the call: time queued behind other calls doesn't
+    # count. None if the host's deadline passes before the call starts.
+    started = getattr(fut, "started", None)  # cache hits come back finished
+    if started is not None and not fut.done():
+        if not started.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+            return None
+    try:
+        started_at = getattr(fut, "started_at", None)
+        limit = started_at + LLM_TIMEOUT_S if started_at is not None else time.monotonic()
+        return fut.result(timeout=max(0.0, limit - time.monotonic())), "llm"
+    except FutureTimeout:
+        # Leave it to the host rather than hold up the rest of the mailbox
+        return "", "llm_timeout"
+    except Exception as e:
+        print(f"Warning: LLM reply for {host_id}/{thread_id} failed: {e}")
+        return "", "llm_error"
+
+def _process_mailbox(host_id: str, svc, tenant: Dict, approve_mode: bool, deadline: Optional[float]) -> Dict:
+    host_email = tenant.get("hostEmail")
+    cursor = tenant.get("gmailHistoryId")
+    with stage("sync"):
+        msgs, new_cursor, resynced = sync_messages(svc, cursor)
+    handled, drafted, merged = 0, 0, 0
+
+    # Triage on headers only, then download bodies just for what is left
+    with stage("triage_fetch"):
+        metas = batch_get_messages(svc, [m["id"] for m in msgs], fmt="metadata", metadata_headers=TRIAGE_HEADERS)
+    # All thread markers for the listing in one read
+    with stage("markers"):
+        markers = thread_markers(host_id, [v.get("threadId") for v in metas.values()])
+        threads = _unhandled_threads(msgs, metas, markers)
+        draft_ids = _replaced_draft_ids(threads, markers)
+        replaced = _replaced_drafts(threads, markers, get_drafts(host_id, draft_ids) if draft_ids else {})
+    with stage("body_fetch"):
+        fulls = batch_get_messages(svc, [m[0] for _, group in threads for m in group] +
+                                   [m for _, ids in replaced.values() for m in ids])
+        listing_cfg = get_listing_config(host_id) if threads else {}
+    threads = _with_replaced(threads, replaced, fulls)
+
+    # One reply per thread: a guest who sent several messages since the last
+    # reply gets a single answer to all of them. Template answers are worked
+    # out for every thread up front; LLM calls are submitted LLM_LOOKAHEAD
+    # threads ahead of the one being handled, so they overlap without
+    # queueing calls for threads the budget won't reach.
+    proposals = {}
+    with stage("propose"):
+        for thread_id, group in threads:
+            request = _thread_request(thread_id, group, fulls, markers)
+            if not request:
+                continue
+            bodies, combined, context = request
+            text, auto_ok = _template_reply(bodies, combined, listing_cfg)
+            proposals[thread_id] = (bodies, text, auto_ok, None if text else (combined, context))
+    llm_queue = [t for t, p in proposals.items() if p[3]]
+    pending: Dict[str, Future] = {}
+
+    def _submit_ahead():
+        while llm_queue and len(pending) < LLM_LOOKAHEAD and not _past(deadline):
+            t = llm_queue.pop(0)
+            combined, context = proposals[t][3]
+            pending[t] = cached_llm_reply_async(host_id, combined, listing_cfg, "there", context)
+
+    # Drafts committed in this run; in digest mode the host gets one email for
+    # all of them once the run ends, however it ends.
+    digest = []
+    try:
+        for thread_id, group in threads:
+            # Stop between threads once the per-host budget is spent; the thread
+            # markers mean the remaining messages are picked up on the next poll.
+            if _past(deadline):
+                return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged,
+                        "budget_exhausted": True}
+
+            if thread_id not in proposals:
+                continue
+            bodies, text, auto_ok, wants_llm = proposals[thread_id]
+            msg_id, _, subject, to_addr = _reply_target(group)
+
+            source = "template"
+            if wants_llm:
+                auto_ok = False
+                _submit_ahead()
+                fut = pending.pop(thread_id, None)  # None: the deadline passed since the check above
+                got = None
+                if fut is not None:
+                    with stage("llm_wait"):
+                        got = _llm_text(host_id, thread_id, fut, deadline)
+                    release_llm_reply(fut)
+                if got is None:
+                    # Out of budget before Vertex even took the call
+                    return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged,
+                            "budget_exhausted": True}
+                text, source = got
+
+            sent = approve_mode and auto_ok
+            # A send that fails leaves the thread unrecorded, for the next poll
+            if sent:
+                with stage("send"):
+                    send_reply(svc, to_addr, subject, text, thread_id)
+            elif host_email and APPROVAL_EMAIL_MODE == "per_draft":
+                with stage("approval_email"):
+                    _send_host_approval_email(svc, host_email, subject, text, approval_links(host_id, msg_id))
+            uow = UnitOfWork(host_id)
+            replaces = replaced.get(thread_id)
+            _record_thread(uow, thread_id, group, bodies, text, source, auto_ok, sent, replaces)
+            with stage("commit"):
+                uow.commit()
+                # After the commit, and only from pending: a draft the host
+                # is approving right now keeps its claim
+                if replaces:
+                    transition_draft(host_id, replaces[0], ["pending"], "superseded", {"supersededBy": msg_id})
+            if sent:
+                handled += 1
+            else:
+                drafted += 1
+                digest.append({"draft_id": msg_id, "subject": subject, "text": text})
+            merged += len(_new_bodies(bodies, replaces))
+            count_message("auto_sent" if sent else "draft_" + source, len(_new_bodies(bodies, replaces)))
+    finally:
+        # Calls for threads not reached: dropped if Vertex hasn't started them
+        for fut in pending.values():
+            release_llm_reply(fut)
+        if digest and host_email and APPROVAL_EMAIL_MODE != "per_draft":
+            try:
+                with stage("approval_email"):
+                    _send_host_digest_email(svc, host_email, host_id, digest)
+            except Exception as e:
+                print(f"Warning: approval digest for {host_id} not sent: {e}")
+
+    # Only advance the cursor once every message up to it has been handled
+    if new_cursor != cursor:
+        save_sync_cursor(host_id, new_cursor)
+
+    return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged, "resynced": resynced}
+
+def renew_watch(host_id: str, topic_name: str) -> Dict:
+    creds = get_credentials(host_id)
+    if not creds:
+        return {"hostId": host_id, "skipped": "no_creds"}
+    with pooled_service(host_id, creds) as svc:
+        res = watch_inbox(svc, topic_name)
+    save_watch(host_id, int(res["expiration"]))
+    return {"hostId": host_id, "expiration": int(res["expiration"])}
+
+def _run_host(host_id: str, approve_mode: bool, budget_s: float, started: Dict[str, float]) -> Dict:
+    started[host_id] = time.monotonic()
+    try:
+        return process_host(host_id, approve_mode=approve_mode, deadline=started[host_id] + budget_s, leased=True)
+    except Exception as e:
+        print(f"Error: process_host({host_id}) failed: {e}")
+        return {"hostId": host_id, "error": str(e)}
+
+def _release_when_done(host_id: str):
+    def _done(_):
+        _heartbeat.drop(host_id)
+        release_host_leases([host_id], POLL_LEASE_COOLDOWN_S)
+    return _done
+
+def poll_hosts(host_ids: List[str], approve_mode: bool = False, workers: int = 8,
+               host_budget_s: float = 120.0, grace_s: float = 15.0, stop_at: Optional[float] = None) -> Dict:
+    # Hosts are claimed in batches as workers free up, each under a poll lease
+    # kept for the whole call, so instances polling at the same time split the
+    # list between them instead of each working through all of it. Hosts
+    # another instance holds (or polled moments ago) are reported as skipped.
+    # process_host stops between messages once its budget is spent; a host still
+    # running grace_s after that (e.g. stuck in a Gmail call) is reported as
+    # timed out and left to finish in the background, keeping its lease.
+    # No new host is started after stop_at (monotonic); those are returned as
+    # deferred.
+    t0 = time.monotonic()
+    workers = max(1, workers)
+    started: Dict[str, float] = {}
+    results: Dict[str, Dict] = {}
+    timings: Dict[str, int] = {}
+    timed_out: List[str] = []
+    claimed: List[str] = []
+    queue = list(dict.fromkeys(host_ids))
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poll")
+    pending = {}
+    try:
+        while queue or pending:
+            if queue and stop_at is not None and time.monotonic() >= stop_at:
+                if not pending:
+                    break
+            elif queue and len(pending) < workers:
+                batch, queue = queue[:workers], queue[workers:]
+                got = acquire_host_leases(batch)
+                held = set(got)
+                for h in batch:
+                    if h not in held:
+                        results[h] = {"hostId": h, "skipped": "leased"}
+                for h in got:
+                    claimed.append(h)
+                    _heartbeat.hold(h)
+                    pending[pool.submit(_run_host, h, approve_mode, host_budget_s, started)] = h
+                continue
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for f in done:
+                h = pending.pop(f)
+                results[h] = f.result()
+                timings[h] = int((now - started.get(h, now)) * 1000)
+            for f, h in list(pending.items()):
+                if h in started and now - started[h] > host_budget_s + grace_s:
+                    del pending[f]
+                    timed_out.append(h)
+                    results[h] = {"hostId": h, "error": "timeout"}
+                    timings[h] = int((now - started[h]) * 1000)
+                    f.add_done_callback(_release_when_done(h))
+    finally:
+        pool.shutdown(wait=False)
+        for f, h in pending.items():  # only left over if the loop raised
+            f.add_done_callback(_release_when_done(h))
+        finished = [h for h in claimed if h not in timed_out and h not in pending.values()]
+        for h in finished:
+            _heartbeat.drop(h)
+        release_host_leases(finished, POLL_LEASE_COOLDOWN_S)
+
+    return {
+        "results": [results[h] for h in host_ids if h in results],
+        "timings": timings,
+        "timedOut": timed_out,
+        "deferred": queue,
+        "elapsedMs": int((time.monotonic() - t0) * 1000),
+    }
+
+def poll_active(approve_mode: bool = False, workers: int = 8, host_budget_s: float = 120.0,
+                page_size: int = 200, budget_s: float = 240.0, cursor: Optional[str] = None,
+                force: bool = False) -> Dict:
+    # Streams active tenants a page at a time and polls the due ones, until
+    # every page is done or budget_s runs out. The cursor is the last host id
+    # of the last fully handled page; a run that stops early saves it and the
+    # next run carries on after it (cursor=None: the saved one). A page cut
+    # short is redone, which is cheap: hosts polled in it are no longer due.
+    t0 = time.monotonic()
+    stop_at = t0 + budget_s
+    start = load_poll_cursor() if cursor is None else (cursor or None)
+    first = start
+    out = {"results": [], "timings": {}, "timedOut": [], "pages": 0, "due": 0, "notDue": 0, "deferred": 0}
+    done = True
+    for page in iter_active_tenants(page_size, start):
+        hosts = [h for h, _ in page] if force else due_hosts(page)
+        out["due"] += len(hosts)
+        out["notDue"] += len(page) - len(hosts)
+        res = poll_hosts(hosts, approve_mode, workers, host_budget_s, stop_at=stop_at)
+        out["results"] += res["results"]
+        out["timings"].update(res["timings"])
+        out["timedOut"] += res["timedOut"]
+        out["pages"] += 1
+        if res["deferred"]:
+            out["deferred"] = len(res["deferred"])
+            done = False
+            break
+        start = page[-1][0]
+        if time.monotonic() >= stop_at:
+            done = False
+            break
+    next_cursor = None if done else start
+    save_poll_cursor(next_cursor)
+    return {**out, "startCursor": first, "nextCursor": next_cursor, "complete": done,
+            "elapsedMs": int((time.monotonic() - t0) * 1000)}
+
+# ---------- Async path (ASYNC_IO) ----------
+# The same pipeline on the event loop: Gmail over httpx (gmail_async),
+# Vertex via generate_content_async, thread markers and commits through the
+# async storage. Triage, grouping, replies and what gets recorded are the
+# functions above; only the I/O differs. Hosts run as tasks, up to
+# `concurrency` at once, rather than one per thread. Bookkeeping done once
+# per host run (credentials, leases, schedule, sync cursor) goes to the aio
+# pool.
+
+async def process_host_aio(host_id: str, approve_mode: bool = False, deadline: Optional[float] = None,
+                           lock_wait_s: float = 0, leased: bool = False) -> Dict:
+    with tenant_context(host_id), stage("process_host"):
+        try:
+            result = await _claim_and_process_aio(host_id, approve_mode, deadline, lock_wait_s, leased)
+        except Exception:
+            count_host_run("error")
+            raise
+        _count_run(result)
+        return result
+
+async def _acquire_host_lock_aio(lock: threading.Lock, wait_s: float) -> bool:
+    # Shares process_host's per-host lock without blocking the loop
+    give_up = time.monotonic() + wait_s
+    while not lock.acquire(blocking=False):
+        if time.monotonic() >= give_up:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+async def _claim_and_process_aio(host_id: str, approve_mode: bool, deadline: Optional[float],
+                                 lock_wait_s: float, leased: bool) -> Dict:
+    lock = _host_lock(host_id)
+    if not await _acquire_host_lock_aio(lock, lock_wait_s):
+        return {"hostId": host_id, "skipped": "busy"}
+    try:
+        if leased:
+            return await _process_host_aio(host_id, approve_mode, deadline)
+        if not await offload(acquire_host_lease, host_id):
+            return {"hostId": host_id, "skipped": "leased"}
+        _heartbeat.hold(host_id)
+        try:
+            return await _process_host_aio(host_id, approve_mode, deadline)
+        finally:
+            _heartbeat.drop(host_id)
+            await offload(release_host_lease, host_id)
+    finally:
+        lock.release()
+
+async def _process_host_aio(host_id: str, approve_mode: bool, deadline: Optional[float]) -> Dict:
+    creds = await offload(get_credentials, host_id)
+    if not creds:
+        return {"hostId": host_id, "skipped": "no_creds"}
+
+    tenant = await astorage().get_tenant(host_id) or {}  # uncached, as in _process_host
+    result = await _process_mailbox_aio(host_id, AsyncGmail(host_id, creds), tenant, approve_mode, deadline)
+    await offload(record_poll, host_id, tenant, result)
+    return result
+
+async def _outlive_cancel(task: "asyncio.Future"):
+    # Awaits task to the end even if this coroutine is cancelled meanwhile,
+    # then re-raises the cancellation: what the caller releases on the way
+    # out (the host lock and lease) stays held until the task is done
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        while not task.done():
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                pass
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Warning: {task.exception()!r} after the caller was cancelled")
+        raise
+
+async def _llm_text_aio(host_id: str, thread_id: str, task: "asyncio.Future") -> Tuple[str, str]:
+    # llm_reply_aio times the call from when it gets a Vertex slot
+    try:
+        return await task, "llm"
+    except asyncio.TimeoutError:
+        return "", "llm_timeout"
+    except Exception as e:
+        print(f"Warning: LLM reply for {host_id}/{thread_id} failed: {e}")
+        return "", "llm_error"
+
+async def _commit_thread_aio(gmail: AsyncGmail, uow: UnitOfWork, host_email: Optional[str], host_id: str,
+                             thread_id: str, group: List[Tuple[str, int, Dict]], bodies: List[Tuple[str, str]],
+                             text: str, source: str, auto_ok: bool, sent: bool,
+                             replaces: Optional[Tuple[str, List[str]]]):
+    msg_id, _, subject, to_addr = _reply_target(group)
+    if sent:
+        with stage("send"):
+            await gmail.send_reply(to_addr, subject, text, thread_id)
+    elif host_email and APPROVAL_EMAIL_MODE == "per_draft":
+        with stage("approval_email"):
+            await gmail.send_reply(host_email, *_approval_email(subject, text, approval_links(host_id, msg_id)))
+    _record_thread(uow, thread_id, group, bodies, text, source, auto_ok, sent, replaces)
+    with stage("commit"):
+        await uow.commit_aio()
+        if replaces:
+            await transition_draft_aio(host_id, replaces[0], ["pending"], "superseded", {"supersededBy": msg_id})
+
+async def _process_mailbox_aio(host_id: str, gmail: AsyncGmail, tenant: Dict, approve_mode: bool,
+                               deadline: Optional[float]) -> Dict:
+    host_email = tenant.get("hostEmail")
+    cursor = tenant.get("gmailHistoryId")
+    with stage("sync"):
+        msgs, new_cursor, resynced = await gmail.sync_messages(cursor)
+    handled, drafted, merged = 0, 0, 0
+
+    with stage("triage_fetch"):
+        metas = await gmail.get_messages([m["id"] for m in msgs], fmt="metadata", metadata_headers=TRIAGE_HEADERS)
+    with stage("markers"):
+        markers = await thread_markers_aio(host_id, [v.get("threadId") for v in metas.values()])
+        threads = _unhandled_threads(msgs, metas, markers)
+        draft_ids = _replaced_draft_ids(threads, markers)
+        replaced = _replaced_drafts(threads, markers, await get_drafts_aio(host_id, draft_ids) if draft_ids else {})
+    with stage("body_fetch"):
+        fulls = await gmail.get_messages([m[0] for _, group in threads for m in group] +
+                                         [m for _, ids in replaced.values() for m in ids])
+        listing_cfg = await offload(get_listing_config, host_id) if threads else {}
+    threads = _with_replaced(threads, replaced, fulls)
+
+    proposals = {}
+    with stage("propose"):
+        for thread_id, group in threads:
+            request = _thread_request(thread_id, group, fulls, markers)
+            if not request:
+                continue
+            bodies, combined, context = request
+            text, auto_ok = _template_reply(bodies, combined, listing_cfg)
+            proposals[thread_id] = (bodies, text, auto_ok, None if text else (combined, context))
+    llm_queue = [t for t, p in proposals.items() if p[3]]
+    pending: Dict[str, "asyncio.Future"] = {}
+
+    def _submit_ahead():
+        while llm_queue and len(pending) < LLM_LOOKAHEAD and not _past(deadline):
+            t = llm_queue.pop(0)
+            combined, context = proposals[t][3]
+            pending[t] = asyncio.ensure_future(cached_llm_reply_aio(host_id, combined, listing_cfg, "there", context))
+
+    digest = []
+    try:
+        for thread_id, group in threads:
+            if _past(deadline):
+                return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged,
+                        "budget_exhausted": True}
+
+            if thread_id not in proposals:
+                continue
+            bodies, text, auto_ok, wants_llm = proposals[thread_id]
+            msg_id, _, subject, _ = _reply_target(group)
+
+            source = "template"
+            if wants_llm:
+                auto_ok = False
+                _submit_ahead()
+                task = pending.pop(thread_id, None)
+                if task is None:
+                    # The deadline passed since the check above
+                    return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged,
+                            "budget_exhausted": True}
+                with stage("llm_wait"):
+                    text, source = await _llm_text_aio(host_id, thread_id, task)
+
+            sent = approve_mode and auto_ok
+            uow = UnitOfWork(host_id)
+            # A host cancelled for running over its budget must not stop
+            # between sending a reply and recording it
+            commit = asyncio.ensure_future(_commit_thread_aio(
+                gmail, uow, host_email, host_id, thread_id, group, bodies, text, source, auto_ok, sent,
+                replaced.get(thread_id)))
+            try:
+                await _outlive_cancel(commit)
+            finally:
+                # Counted (and in the digest) even if the host was cancelled
+                # while it committed
+                if commit.done() and not commit.cancelled() and commit.exception() is None:
+                    if sent:
+                        handled += 1
+                    else:
+                        drafted += 1
+                        digest.append({"draft_id": msg_id, "subject": subject, "text": text})
+                    merged += len(_new_bodies(bodies, replaced.get(thread_id)))
+                    count_message("auto_sent" if sent else "draft_" + source,
+                                  len(_new_bodies(bodies, replaced.get(thread_id))))
+    finally:
+        # Cancelling a caller's task cancels the Vertex call once no other
+        # caller is waiting on it
+        for task in pending.values():
+            task.cancel()
+        if digest and host_email and APPROVAL_EMAIL_MODE != "per_draft":
+            try:
+                with stage("approval_email"):
+                    await _outlive_cancel(asyncio.ensure_future(
+                        gmail.send_reply(host_email, *_digest_email(host_id, digest))))
+            except Exception as e:
+                print(f"Warning: approval digest for {host_id} not sent: {e}")
+
+    if new_cursor != cursor:
+        await offload(save_sync_cursor, host_id, new_cursor)
+
+    return {"hostId": host_id, "handled": handled, "drafted": drafted, "messages": merged, "resynced": resynced}
+
+async def poll_hosts_aio(host_ids: List[str], approve_mode: bool = False, concurrency: int = 64,
+                         host_budget_s: float = 120.0, grace_s: float = 15.0, stop_at: Optional[float] = None) -> Dict:
+    # poll_hosts with tasks: same lease batches, budgets and result shape. A
+    # host still running grace_s past its budget is cancelled (its send and
+    # commit in progress finish first) and reported as timed out.
+    t0 = time.monotonic()
+    concurrency = max(1, concurrency)
+    results: Dict[str, Dict] = {}
+    timings: Dict[str, int] = {}
+    timed_out: List[str] = []
+    claimed: List[str] = []
+    queue = list(dict.fromkeys(host_ids))
+
+    async def _run(h: str) -> Dict:
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(
+                process_host_aio(h, approve_mode=approve_mode, deadline=started + host_budget_s, leased=True),
+                host_budget_s + grace_s)
+        except asyncio.TimeoutError:
+            timed_out.append(h)
+            return {"hostId": h, "error": "timeout"}
+        except Exception as e:
+            print(f"Error: process_host({h}) failed: {e}")
+            return {"hostId": h, "error": str(e)}
+        finally:
+            timings[h] = int((time.monotonic() - started) * 1000)
+
+    running: Dict["asyncio.Task", str] = {}
+    try:
+        while queue or running:
+            if queue and stop_at is not None and time.monotonic() >= stop_at:
+                if not running:
+                    break
+            elif queue and len(running) < concurrency:
+                free = concurrency - len(running)
+                batch, queue = queue[:free], queue[free:]
+                got = await offload(acquire_host_leases, batch)
+                held = set(got)
+                for h in batch:
+                    if h not in held:
+                        results[h] = {"hostId": h, "skipped": "leased"}
+                for h in got:
+                    claimed.append(h)
+                    _heartbeat.hold(h)
+                    running[asyncio.ensure_future(_run(h))] = h
+                continue
+            done, _ = await asyncio.wait(running, timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[running.pop(task)] = task.result()
+    finally:
+        for task in running:  # only left over if the loop raised or was cancelled
+            task.cancel()
+        for h in claimed:
+            _heartbeat.drop(h)
+        await asyncio.shield(offload(release_host_leases, claimed, POLL_LEASE_COOLDOWN_S))
+
+    return {
+        "results": [results[h] for h in host_ids if h in results],
+        "timings": timings,
+        "timedOut": timed_out,
+        "deferred": queue,
+        "elapsedMs": int((time.monotonic() - t0) * 1000),
+    }
 
-        body = extract_plain(full["payload"])
-        log_message(host_id, thread_id, "inbound", body, {"subject": subject})
-
-        listing_cfg = get_listing_config(host_id)
-        text, auto_ok, _ = propose_template(body, "there")
-        source = "template"
-        if not text:
-            text = llm_reply(body, listing_cfg, "there")
-            auto_ok, source = False, "llm"
-
-        if approve_mode and auto_ok:
-            send_reply(svc, to_addr, subject, text, thread_id)
-            log_message(host_id, thread_id, "outbound", text, {"auto_sent": True, "source": source})
-            handled += 1
-        else:
-            draft_id = msg_id
-            create_draft(host_id, draft_id, {
-                "thread_id": thread_id,
-                "to_addr": to_addr,
-                "subject": subject,
-                "body": text,
-                "source": source,
-                "auto_ok": auto_ok
-            })
-            if host_email:
-                links = approval_links(host_id, draft_id)
-                _send_host_approval_email(svc, host_email, subject, text, links)
-            log_message(host_id, thread_id, "draft", text, {"auto_sent": False, "source": source})
-            drafted += 1
-
-        upsert_thread_marker(host_id, thread_id, msg_id)
-
-    return {"hostId": host_id, "handled": handled, "drafted": drafted}
+async def poll_active_aio(approve_mode: bool = False, concurrency: int = 64, host_budget_s: float = 120.0,
+                          page_size: int = 200, budget_s: float = 240.0, cursor: Optional[str] = None,
+                          force: bool = False) -> Dict:
+    # poll_active on the event loop, with the same cursor handling
+    t0 = time.monotonic()
+    stop_at = t0 + budget_s
+    start = await offload(load_poll_cursor) if cursor is None else (cursor or None)
+    first = start
+    out = {"results": [], "timings": {}, "timedOut": [], "pages": 0, "due": 0, "notDue": 0, "deferred": 0}
+    done = True
+    while True:
+        page = await astorage().list_active_tenants(page_size, start)
+        if not page:
+            break
+        hosts = [h for h, _ in page] if force else due_hosts(page)
+        out["due"] += len(hosts)
+        out["notDue"] += len(page) - len(hosts)
+        res = await poll_hosts_aio(hosts, approve_mode, concurrency, host_budget_s, stop_at=stop_at)
+        out["results"] += res["results"]
+        out["timings"].update(res["timings"])
+        out["timedOut"] += res["timedOut"]
+        out["pages"] += 1
+        if res["deferred"]:
+            out["deferred"] = len(res["deferred"])
+            done = False
+            break
+        start = page[-1][0]
+        if len(page) < page_size:
+            break
+        if time.monotonic() >= stop_at:
+            done = False
+            break
+    next_cursor = None if done else start
+    await offload(save_poll_cursor, next_cursor)
+    return {**out, "startCursor": first, "nextCursor": next_cursor, "complete": done,
+            "elapsedMs": int((time.monotonic() - t0) * 1000)}
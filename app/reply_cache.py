@@ -0,0 +1,205 @@
+import asyncio, hashlib, os, re, threading, time, unicodedata
+from concurrent.futures import Future
+from typing import Dict, Optional
+from app.cache import TTLCache, MISSING
+from app.storage import storage
+from app.conversation import context_hash
+from app.aio import offload
+from app.vertex_reply import build_system_prompt, llm_reply, llm_reply_async, llm_reply_aio
+
+# Cache in front of llm_reply. Guests ask the same few questions in slightly
+# different words, so the key is a normalised form of the question plus a
+# hash of the system prompt the listing config produces; a config change
+# therefore never serves a stale answer. Questions asked with conversation
+# context also key on a hash of that context. Optionally backed by a per-tenant
+# "reply_cache" collection so answers survive restarts and are shared
+# between instances.
+TTL_S = float(os.getenv("REPLY_CACHE_TTL_S", str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "4096"))
+PERSIST = os.getenv("REPLY_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+
+_GREETING = {"hi", "hello", "hey", "hiya", "dear", "good", "morning", "afternoon", "evening", "there", "team", "host"}
+_SIGN_OFF = re.compile(r"\b(thanks|thank you|thx|cheers|regards|best wishes|kind regards|many thanks|best)\b(?!.*\b(thanks|thank you|thx|cheers|regards|best)\b)")
+_QUOTED_FROM = re.compile(r"^\s*(>|on .+ wrote:)", re.I)
+
+def normalize_question(text: str) -> str:
+    lines = []
+    for line in (text or "").splitlines():
+        if _QUOTED_FROM.match(line):
+            break  # quoted history from the email client
+        lines.append(line)
+    t = unicodedata.normalize("NFKC", " ".join(lines)).lower()
+    t = re.sub(r"['’`]", "", t)  # what's -> whats
+    t = re.sub(r"[^\w]+", " ", t).strip()
+    # Drop a trailing sign-off (and the name after it) when it is near the end
+    m = _SIGN_OFF.search(t)
+    if m and len(t) - m.start() <= 40 and m.start() > 0:
+        t = t[:m.start()].strip()
+    words = t.split()
+    while words and words[0] in _GREETING:
+        words.pop(0)
+    return " ".join(words)
+
+def prompt_hash(listing_cfg: dict) -> str:
+    return hashlib.sha256(build_system_prompt(listing_cfg).encode()).hexdigest()[:16]
+
+def cache_key(message_text: str, listing_cfg: dict, guest_name: str = "there", context: str = "") -> str:
+    parts = [prompt_hash(listing_cfg), guest_name, normalize_question(message_text)]
+    if context:
+        parts.append(context_hash(context))
+    raw = "\n".join(parts)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class ReplyCache:
+    def __init__(self, maxsize: int = MAX_ENTRIES, ttl: float = TTL_S, persist: bool = PERSIST):
+        self.memory = TTLCache("llm_replies", maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.persist = persist
+        self.persistent_hits = self.calls = self.coalesced = 0
+        self._inflight: Dict[str, Future] = {}
+        # Callers still interested in each in-flight call; see release()
+        self._waiters: Dict[Future, int] = {}
+        # Event-loop tasks for reply_aio and their waiters (only ever touched
+        # from the loop)
+        self._inflight_aio: Dict[str, "asyncio.Task"] = {}
+        self._waiters_aio: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host_id: str, key: str) -> Optional[str]:
+        hit = self.memory.get(key)
+        if hit is not MISSING:
+            return hit
+        if self.persist:
+            doc = storage().get_doc(host_id, "reply_cache", key)
+            if doc and doc.get("expiresAt", 0) > time.time():
+                self.persistent_hits += 1
+                self.memory.set(key, doc["text"])
+                return doc["text"]
+        return None
+
+    def put(self, host_id: str, key: str, text: str):
+        self.memory.set(key, text)
+        if self.persist:
+            storage().set_doc(host_id, "reply_cache", key, {"text": text, "expiresAt": time.time() + self.ttl})
+
+    def reply(self, host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+              context: str = "") -> str:
+        key = cache_key(message_text, listing_cfg, guest_name, context)
+        text = self.get(host_id, key)
+        if text is None:
+            self.calls += 1
+            text = llm_reply(message_text, listing_cfg, guest_name, context)
+            if text:
+                self.put(host_id, key, text)
+        return text
+
+    def reply_async(self, host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+                    context: str = "") -> Future:
+        # A hit comes back as a finished future; identical questions already
+        # waiting on Vertex share that call instead of starting another.
+        # Callers release() what they no longer wait for.
+        key = cache_key(message_text, listing_cfg, guest_name, context)
+        text = self.get(host_id, key)
+        if text is not None:
+            done = Future()
+            done.set_result(text)
+            return done
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                self._waiters[fut] = self._waiters.get(fut, 0) + 1
+                return fut
+            self.calls += 1
+            fut = self._inflight[key] = llm_reply_async(message_text, listing_cfg, guest_name, context)
+            self._waiters[fut] = 1
+
+        def _store(f: Future):
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._waiters.pop(f, None)
+            if not f.cancelled() and f.exception() is None and f.result():
+                self.put(host_id, key, f.result())
+        fut.add_done_callback(_store)
+        return fut
+
+    def release(self, fut: Future):
+        # The caller no longer needs fut (answered, timed out, or out of
+        # budget). Once no caller does, a call still queued for Vertex is
+        # dropped before it is made; one already running finishes and is cached.
+        with self._lock:
+            left = self._waiters.get(fut, 0) - 1
+            if left > 0:
+                self._waiters[fut] = left
+                return
+            self._waiters.pop(fut, None)
+        fut.cancel()
+
+    async def reply_aio(self, host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+                        context: str = "") -> str:
+        # reply_async for the event loop; identical questions in flight share
+        # one Vertex call here too
+        key = cache_key(message_text, listing_cfg, guest_name, context)
+        text = await offload(self.get, host_id, key) if self.persist else self.get(host_id, key)
+        if text is not None:
+            return text
+        # The shared task is shielded from any one caller being cancelled and
+        # cancelled itself when the last one is
+        task = self._inflight_aio.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = self._inflight_aio[key] = asyncio.ensure_future(
+                llm_reply_aio(message_text, listing_cfg, guest_name, context))
+
+            def _done(_):
+                self._inflight_aio.pop(key, None)
+                self._waiters_aio.pop(key, None)
+            task.add_done_callback(_done)
+        self._waiters_aio[key] = self._waiters_aio.get(key, 0) + 1
+        try:
+            text = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                self._waiters_aio[key] -= 1
+                if self._waiters_aio[key] <= 0:
+                    # Later callers start a fresh call rather than join this one
+                    if self._inflight_aio.get(key) is task:
+                        del self._inflight_aio[key]
+                    task.cancel()
+            raise
+        if text:
+            if self.persist:
+                await offload(self.put, host_id, key, text)
+            else:
+                self.put(host_id, key, text)
+        return text
+
+    def stats(self) -> Dict:
+        s = self.memory.stats()
+        lookups = s["hits"] + s["misses"]
+        hits = s["hits"] + self.persistent_hits
+        return {**s, "persistentHits": self.persistent_hits, "llmCalls": self.calls,
+                "coalesced": self.coalesced, "inFlight": len(self._inflight) + len(self._inflight_aio),
+                "hitRate": round(hits / lookups, 4) if lookups else 0.0}
+
+_reply_cache = ReplyCache()
+
+def cached_llm_reply(host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+                     context: str = "") -> str:
+    return _reply_cache.reply(host_id, message_text, listing_cfg, guest_name, context)
+
+def cached_llm_reply_async(host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+                           context: str = "") -> Future:
+    return _reply_cache.reply_async(host_id, message_text, listing_cfg, guest_name, context)
+
+def release_llm_reply(fut: Future):
+    _reply_cache.release(fut)
+
+async def cached_llm_reply_aio(host_id: str, message_text: str, listing_cfg: dict, guest_name: str = "there",
+                              context: str = "") -> str:
+    return await _reply_cache.reply_aio(host_id, message_text, listing_cfg, guest_name, context)
+
+def reply_cache_stats() -> Dict:
+    return _reply_cache.stats()
@@ -1,27 +1,100 @@
-import re
-from typing import Tuple
-
-SAFE_RULES = [
-    (re.compile(r'\bcheck[\s-]?in|arrival|access\b', re.I),
-     "Check-in is after 3pm. Smart-lock code arrives at 9am on arrival day."),
-    (re.compile(r'\bcheck[\s-]?out|departure\b', re.I),
-     "Check-out is 11am. Need extra time? I’ll check availability."),
-    (re.compile(r'\bwi[-\s]?fi|internet\b', re.I),
-     "Wi-Fi: Network “Home-Guest”, Password “StayHappy2025”."),
-    (re.compile(r'\bparking|car park\b', re.I),
-     "Free on-street after 6pm; nearest paid car park is 2 min away on King St.")
+import hashlib, json, re
+from typing import Dict, List, Optional, Tuple
+from app.cache import TTLCache
+
+# Intents the router can answer on its own: the terms that signal each one
+# (matched from the start of a word) and the listing config fields its answer
+# needs. An intent whose fields are missing from the listing is left to the LLM.
+INTENTS = [
+    ("check_in", [r'check[\s-]?in', r'arrival', r'access\b'], ["check_in_after"]),
+    ("check_out", [r'check[\s-]?out', r'departure\b'], ["check_out_before"]),
+    ("wifi", [r'wi[-\s]?fi', r'internet\b'], ["wifi_ssid", "wifi_password"]),
+    ("parking", [r'parking', r'car park\b'], ["parking_notes"]),
 ]
 
-SENSITIVE_RX = re.compile(
-    r'\b(refund|discount|compensat|damage|exception|special offer|price match)\b',
-    re.I
-)
-
-def propose_template(text: str, guest_name: str = "there") -> Tuple[str, bool, float]:
-    m = text or ""
-    for rx, templ in SAFE_RULES:
-        if rx.search(m):
-            return f"Hi {guest_name}! {templ}", True, 0.95
-    if SENSITIVE_RX.search(m):
-        return "Thanks for reaching out! I’ve flagged this for a quick review and will get back shortly.", False, 0.8
+TEMPLATES = {
+    "check_in": "Check-in is after {check_in_after}.{check_in_notes}",
+    "check_out": "Check-out is {check_out_before}. Need extra time? I’ll check availability.",
+    "wifi": "Wi-Fi: Network “{wifi_ssid}”, Password “{wifi_password}”.",
+    "parking": "{parking_notes}",
+}
+
+# Always blocked from auto-send, on top of blocked_auto_send_keywords
+SENSITIVE_TERMS = [r'refund(?:s|ed)?', r'discount(?:s|ed)?', r'compensat\w*', r'damage[sd]?',
+                   r'exceptions?', r'special offers?', r'price match(?:es|ing)?']
+
+HOLDING_REPLY = "Thanks for reaching out! I’ve flagged this for a quick review and will get back shortly."
+
+def _fmt_time(v) -> str:
+    # "15:00" -> "3pm", "09:30" -> "9:30am"; anything else is used as written
+    m = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*', str(v))
+    if not m:
+        return str(v)
+    h, mins = int(m.group(1)), m.group(2)
+    suffix = "am" if h < 12 else "pm"
+    h = h % 12 or 12
+    return f"{h}{suffix}" if mins == "00" else f"{h}:{mins}{suffix}"
+
+class CompiledRouter:
+    # Every intent for one listing folded into a single alternation, so one
+    # finditer() pass over a message finds all of them, and the blocked
+    # keywords into a second one. Blocked terms get their own pass: in a shared
+    # alternation an intent term matching at the same position (or starting
+    # earlier and overlapping) would hide "parking fine" or "check-in late fee".
+    # Terms only match at the start of a word and begin with a character from
+    # a known set; the (?<!\w)(?=[...]) prefix lets the regex engine skip every
+    # other position without trying each alternative there.
+    def __init__(self, listing_cfg: Dict):
+        cfg = listing_cfg or {}
+        values = {
+            "check_in_after": _fmt_time(cfg.get("check_in_after", "")),
+            "check_out_before": _fmt_time(cfg.get("check_out_before", "")),
+            "check_in_notes": f" {cfg['check_in_notes']}" if cfg.get("check_in_notes") else "",
+            "wifi_ssid": cfg.get("wifi_ssid", ""),
+            "wifi_password": cfg.get("wifi_password", ""),
+            "parking_notes": cfg.get("parking_notes", ""),
+        }
+        self.answers: Dict[str, str] = {}
+        parts, first_chars = [], set()
+        for name, terms, needs in INTENTS:
+            if all(cfg.get(f) for f in needs):
+                self.answers[name] = TEMPLATES[name].format(**values)
+                parts.append(f"(?P<i_{name}>" + "|".join(terms) + ")")
+                first_chars.update(t[0] for t in terms)
+        self.rx = _word_start_rx(parts, first_chars) if parts else None
+        keywords = [k.strip() for k in cfg.get("blocked_auto_send_keywords") or [] if k.strip()]
+        self.blocked_rx = _word_start_rx(
+            [r"(?:" + "|".join(SENSITIVE_TERMS + [re.escape(k) for k in keywords]) + r")(?!\w)"],
+            {t[0] for t in SENSITIVE_TERMS + keywords})
+
+    def scan(self, text: str) -> Tuple[List[str], List[str]]:
+        # (intents in order of first mention, blocked terms found)
+        text = text or ""
+        intents = []
+        for m in self.rx.finditer(text) if self.rx else ():
+            if m.lastgroup[2:] not in intents:
+                intents.append(m.lastgroup[2:])
+        return intents, [m.group().lower() for m in self.blocked_rx.finditer(text)]
+
+def _word_start_rx(parts: List[str], first_chars) -> "re.Pattern":
+    chars = "".join(sorted({re.escape(c.lower()) for c in first_chars}))
+    return re.compile(rf"(?<!\w)(?=[{chars}])(?:" + "|".join(parts) + ")", re.I)
+
+def config_version(listing_cfg: Optional[Dict]) -> str:
+    raw = json.dumps(listing_cfg or {}, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+_routers = TTLCache("routers", maxsize=1024, ttl=3600)
+
+def compiled_router(listing_cfg: Optional[Dict]) -> CompiledRouter:
+    # Compiled once per distinct listing config; a saved change is a new version
+    return _routers.get_or_load(config_version(listing_cfg), lambda: CompiledRouter(listing_cfg))
+
+def propose_template(text: str, guest_name: str = "there", listing_cfg: Optional[Dict] = None) -> Tuple[str, bool, float]:
+    router = compiled_router(listing_cfg)
+    intents, blocked = router.scan(text)
+    if blocked:
+        return HOLDING_REPLY, False, 0.8
+    if intents:
+        return f"Hi {guest_name}! " + " ".join(router.answers[i] for i in intents), True, 0.95
     return "", False, 0.0  # empty → let LLM handle
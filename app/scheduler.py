@@ -0,0 +1,65 @@
+import os, random, time
+from typing import Dict, List, Optional, Tuple
+from app.tenants import save_poll_schedule
+
+# Adaptive poll cadence per tenant. After every run the tenant's activity is
+# recorded on its document (pollSchedule) along with when it is next due:
+#   - guest mail in this run, or a guest message within POLL_ACTIVE_WINDOW_S
+#     (an open conversation): poll again after POLL_MIN_INTERVAL_S
+#   - otherwise the interval doubles with each quiet run, up to
+#     POLL_MAX_INTERVAL_S
+#   - errors and runs cut short by their budget are retried at the minimum
+# Due times get +/-10% jitter so tenants that went quiet together drift apart.
+# Push notifications still process a host immediately, whatever its schedule.
+MIN_INTERVAL_S = float(os.getenv("POLL_MIN_INTERVAL_S", "60"))
+MAX_INTERVAL_S = float(os.getenv("POLL_MAX_INTERVAL_S", "3600"))
+ACTIVE_WINDOW_S = float(os.getenv("POLL_ACTIVE_WINDOW_S", str(6 * 3600)))
+BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "2"))
+
+def _jitter(interval: float) -> float:
+    return interval * random.uniform(0.9, 1.1)
+
+def next_schedule(prev: Optional[Dict], result: Dict, now: Optional[float] = None) -> Dict:
+    now = time.time() if now is None else now
+    s = dict(prev or {})
+    new_messages = int(result.get("handled", 0)) + int(result.get("drafted", 0))
+    s["lastPolledAt"] = now
+    s["newMessagesLastPoll"] = new_messages
+    s["polls"] = int(s.get("polls", 0)) + 1
+    if new_messages:
+        s["lastGuestMessageAt"] = now
+        s["messagesSeen"] = int(s.get("messagesSeen", 0)) + new_messages
+
+    if "error" in result or result.get("budget_exhausted"):
+        interval = MIN_INTERVAL_S
+    elif new_messages:
+        s["quietPolls"] = 0
+        interval = MIN_INTERVAL_S
+    else:
+        s["quietPolls"] = int(s.get("quietPolls", 0)) + 1
+        if now - float(s.get("lastGuestMessageAt") or 0) < ACTIVE_WINDOW_S:
+            interval = MIN_INTERVAL_S
+        else:
+            interval = min(MAX_INTERVAL_S, max(MIN_INTERVAL_S, float(s.get("intervalS") or MIN_INTERVAL_S) * BACKOFF_FACTOR))
+    s["intervalS"] = interval
+    s["nextDueAt"] = now + _jitter(interval)
+    return s
+
+def record_poll(host_id: str, tenant: Optional[Dict], result: Dict) -> Optional[Dict]:
+    # Skipped runs (busy, leased, not connected) say nothing about the mailbox
+    if result.get("skipped"):
+        return None
+    schedule = next_schedule((tenant or {}).get("pollSchedule"), result)
+    save_poll_schedule(host_id, schedule)
+    return schedule
+
+def is_due(tenant: Optional[Dict], now: Optional[float] = None) -> bool:
+    # Tenants never polled have no schedule yet and are due
+    due_at = ((tenant or {}).get("pollSchedule") or {}).get("nextDueAt")
+    return due_at is None or float(due_at) <= (time.time() if now is None else now)
+
+def due_hosts(tenants: List[Tuple[str, Dict]], now: Optional[float] = None) -> List[str]:
+    # Most overdue first, so a poll cut short still reaches the neediest
+    now = time.time() if now is None else now
+    due = [(float((t.get("pollSchedule") or {}).get("nextDueAt") or 0), h) for h, t in tenants if is_due(t, now)]
+    return [h for _, h in sorted(due)]
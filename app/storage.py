@@ -0,0 +1,555 @@
+import datetime as dt
+import json, os, sqlite3, threading, time, uuid
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from app.metrics import backend_call
+
+# One storage interface for everything the app persists. Documents live in
+# per-tenant collections (tenants/{host}/{collection}/{doc id}), mirroring the
+# Firestore layout:
+#   listings/{listing id}, oauth/gmail, threads/{thread id},
+#   drafts/{draft id}, messages/{auto id}
+# Selected with STORAGE_BACKEND=firestore (default) or sqlite; the SQLite
+# backend keeps its database at SQLITE_PATH (":memory:" for a throwaway one).
+
+# A queued write: (op, collection, doc id, data) with op one of
+# "create" (auto id), "set", "merge", "delete" or "update". An update's data
+# is a function from the document as stored (None if missing) to the fields
+# to merge into it; the read and the write happen in one transaction, so
+# nothing written to the document meanwhile is lost.
+Op = Tuple[str, str, Optional[str], Union[None, Dict, Callable[[Optional[Dict]], Dict]]]
+
+def _queue_writes(writer, tenant, ops: List[Op], current: Dict[Tuple[str, str], Optional[Dict]]):
+    # Onto a Firestore batch or transaction; current holds the documents the
+    # update ops were read as
+    for op, coll, doc_id, data in ops:
+        ref = tenant.collection(coll).document(doc_id)  # None -> auto id
+        if op == "delete":
+            writer.delete(ref)
+        elif op == "create":
+            writer.create(ref, data)
+        elif op == "update":
+            writer.set(ref, data(current[(coll, doc_id)]), merge=True)
+        else:
+            writer.set(ref, data, merge=(op == "merge"))
+
+class Storage(ABC):
+    # Backends implement every abstract method; one missing fails when the
+    # backend is constructed rather than on its first call
+    name = "base"
+
+    # Tenants
+    @abstractmethod
+    def get_tenant(self, host_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def set_tenant(self, host_id: str, fields: Dict):
+        # Always a merge into the tenant document
+        ...
+
+    @abstractmethod
+    def list_active_tenants(self, limit: int, start_after: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        # One page of (host id, tenant document) for active tenants in host id
+        # order, starting after the host id given as the cursor
+        ...
+
+    # Per-tenant documents
+    @abstractmethod
+    def get_doc(self, host_id: str, collection: str, doc_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def get_docs(self, host_id: str, collection: str, doc_ids: List[str]) -> Dict[str, Dict]:
+        ...
+
+    @abstractmethod
+    def commit(self, host_id: str, ops: List[Op]):
+        # Applies all ops atomically
+        ...
+
+    @abstractmethod
+    def update_if(self, host_id: str, collection: str, doc_id: str, field: str,
+                  allowed: List, fields: Dict) -> Tuple[bool, Optional[Dict]]:
+        # Compare-and-set: merges fields into the document only if it exists and
+        # doc[field] is one of allowed, atomically. Returns (applied, document
+        # after the update, or as found when not applied).
+        ...
+
+    # Leases: a named, expiring claim on one tenant held by one owner (e.g.
+    # the instance polling it). Times are epoch seconds.
+    @abstractmethod
+    def acquire_lease(self, host_id: str, name: str, owner: str, ttl_s: float) -> bool:
+        # Takes the lease if it is free, expired or already ours (extending it)
+        ...
+
+    def acquire_leases(self, name: str, host_ids: List[str], owner: str, ttl_s: float) -> List[str]:
+        # acquire_lease for a batch of hosts; returns the ones now held
+        return [h for h in host_ids if self.acquire_lease(h, name, owner, ttl_s)]
+
+    @abstractmethod
+    def renew_leases(self, name: str, host_ids: List[str], owner: str, ttl_s: float) -> List[str]:
+        # Extends the leases still held by owner (a lost one is not taken
+        # back); returns those hosts
+        ...
+
+    @abstractmethod
+    def release_lease(self, host_id: str, name: str, owner: str, hold_s: float = 0):
+        # hold_s > 0 keeps the lease (still ours, so we can re-take it) for
+        # that long instead of freeing it now
+        ...
+
+    def release_leases(self, name: str, host_ids: List[str], owner: str, hold_s: float = 0):
+        for h in host_ids:
+            self.release_lease(h, name, owner, hold_s)
+
+    def set_doc(self, host_id: str, collection: str, doc_id: str, data: Dict, merge: bool = False):
+        self.commit(host_id, [("merge" if merge else "set", collection, doc_id, data)])
+
+    def delete_doc(self, host_id: str, collection: str, doc_id: str):
+        self.commit(host_id, [("delete", collection, doc_id, None)])
+
+    def add_doc(self, host_id: str, collection: str, data: Dict):
+        self.commit(host_id, [("create", collection, None, data)])
+
+
+class FirestoreStorage(Storage):
+    name = "firestore"
+    BATCH_LIMIT = 500
+
+    def __init__(self):
+        self._db = None
+
+    def db(self):
+        if self._db is None:
+            try:
+                # Imported on first use (about half a second); the SQLite
+                # backend and requests served from caches never need it
+                from google.cloud import firestore
+                self._db = firestore.Client()
+            except Exception as e:
+                print(f"Warning: Firestore not available: {e}")
+                return None
+        return self._db
+
+    def _tenant(self, db_client, host_id: str):
+        return db_client.collection("tenants").document(host_id)
+
+    def get_tenant(self, host_id: str) -> Optional[Dict]:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: get_tenant({host_id})")
+            return {"hostEmail": "test@example.com", "active": True}
+        snap = self._tenant(db_client, host_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    def set_tenant(self, host_id: str, fields: Dict):
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: set_tenant({host_id}, {sorted(fields)})")
+            return
+        self._tenant(db_client, host_id).set(fields, merge=True)
+
+    def list_active_tenants(self, limit: int, start_after: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: list_active_tenants(start_after={start_after})")
+            return [] if start_after else [("host-you", {"hostEmail": "test@example.com", "active": True})]
+        q = db_client.collection("tenants").where("active", "==", True).order_by("__name__")
+        if start_after:
+            q = q.start_after({"__name__": start_after})
+        return [(d.id, d.to_dict()) for d in q.limit(limit).stream()]
+
+    def get_doc(self, host_id: str, collection: str, doc_id: str) -> Optional[Dict]:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: get_doc({host_id}, {collection}, {doc_id})")
+            return None
+        snap = self._tenant(db_client, host_id).collection(collection).document(doc_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    def get_docs(self, host_id: str, collection: str, doc_ids: List[str]) -> Dict[str, Dict]:
+        if not doc_ids:
+            return {}
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: get_docs({host_id}, {collection}, {len(doc_ids)} docs)")
+            return {}
+        coll = self._tenant(db_client, host_id).collection(collection)
+        return {s.id: s.to_dict() for s in db_client.get_all([coll.document(d) for d in doc_ids]) if s.exists}
+
+    def commit(self, host_id: str, ops: List[Op]):
+        if not ops:
+            return
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: commit({host_id}, {[f'{op}:{coll}' for op, coll, _, _ in ops]})")
+            return
+        if len(ops) > self.BATCH_LIMIT:
+            raise ValueError(f"{len(ops)} writes in one commit; Firestore allows {self.BATCH_LIMIT}")
+        tenant = self._tenant(db_client, host_id)
+        reads = list(dict.fromkeys((coll, doc_id) for op, coll, doc_id, _ in ops if op == "update"))
+        if not reads:
+            batch = db_client.batch()
+            _queue_writes(batch, tenant, ops, {})
+            batch.commit()
+            return
+
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _commit(transaction):
+            current = {}
+            for coll, doc_id in reads:
+                snap = tenant.collection(coll).document(doc_id).get(transaction=transaction)
+                current[(coll, doc_id)] = snap.to_dict() if snap.exists else None
+            _queue_writes(transaction, tenant, ops, current)
+
+        _commit(db_client.transaction())
+
+    def update_if(self, host_id: str, collection: str, doc_id: str, field: str,
+                  allowed: List, fields: Dict) -> Tuple[bool, Optional[Dict]]:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: update_if({host_id}, {collection}, {doc_id}, {field} in {allowed})")
+            return False, None
+        ref = self._tenant(db_client, host_id).collection(collection).document(doc_id)
+
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _update(transaction):
+            snap = ref.get(transaction=transaction)
+            doc = snap.to_dict() if snap.exists else None
+            if doc is None or doc.get(field) not in allowed:
+                return False, doc
+            transaction.set(ref, fields, merge=True)
+            return True, {**doc, **fields}
+
+        return _update(db_client.transaction())
+
+    def acquire_lease(self, host_id: str, name: str, owner: str, ttl_s: float) -> bool:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: acquire_lease({host_id}, {name}, {owner})")
+            return True
+        ref = self._tenant(db_client, host_id).collection("leases").document(name)
+
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _acquire(transaction):
+            now = time.time()
+            snap = ref.get(transaction=transaction)
+            cur = snap.to_dict() if snap.exists else None
+            if cur and cur.get("owner") != owner and cur.get("expiresAt", 0) > now:
+                return False
+            transaction.set(ref, {"owner": owner, "expiresAt": now + ttl_s})
+            return True
+
+        return _acquire(db_client.transaction())
+
+    def renew_leases(self, name: str, host_ids: List[str], owner: str, ttl_s: float) -> List[str]:
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: renew_leases({name}, {len(host_ids)} hosts, {owner})")
+            return list(host_ids)
+
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _renew(transaction, ref):
+            snap = ref.get(transaction=transaction)
+            if not snap.exists or snap.to_dict().get("owner") != owner:
+                return False
+            transaction.update(ref, {"expiresAt": time.time() + ttl_s})
+            return True
+
+        refs = {h: self._tenant(db_client, h).collection("leases").document(name) for h in host_ids}
+        return [h for h, ref in refs.items() if _renew(db_client.transaction(), ref)]
+
+    def release_lease(self, host_id: str, name: str, owner: str, hold_s: float = 0):
+        db_client = self.db()
+        if db_client is None:
+            print(f"Mock: release_lease({host_id}, {name}, {owner})")
+            return
+        ref = self._tenant(db_client, host_id).collection("leases").document(name)
+
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def _release(transaction):
+            snap = ref.get(transaction=transaction)
+            if not snap.exists or snap.to_dict().get("owner") != owner:
+                return
+            if hold_s > 0:
+                transaction.update(ref, {"expiresAt": time.time() + hold_s})
+            else:
+                transaction.delete(ref)
+
+        _release(db_client.transaction())
+
+
+def _json_default(v):
+    if isinstance(v, (dt.datetime, dt.date)):
+        return v.isoformat()
+    raise TypeError(f"not JSON serialisable: {type(v).__name__}")
+
+def _dumps(d: Dict) -> str:
+    return json.dumps(d, default=_json_default, separators=(",", ":"))
+
+class SQLiteStorage(Storage):
+    # Embedded backend for local runs, benchmarks and small deployments.
+    # Documents are JSON; the fields queries filter on get their own indexed
+    # columns. One connection shared across threads behind a lock.
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tenants (
+        host_id TEXT PRIMARY KEY,
+        active INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS tenants_active ON tenants (active, host_id);
+
+    CREATE TABLE IF NOT EXISTS docs (
+        host_id TEXT NOT NULL,
+        collection TEXT NOT NULL,
+        doc_id TEXT NOT NULL,
+        status TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (host_id, collection, doc_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS docs_status ON docs (host_id, collection, status);
+
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        host_id TEXT NOT NULL,
+        thread_id TEXT,
+        direction TEXT,
+        ts TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS messages_thread ON messages (host_id, thread_id, id);
+
+    CREATE TABLE IF NOT EXISTS leases (
+        host_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (host_id, name)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def _one(self, sql: str, args: Iterable) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, tuple(args)).fetchone()
+
+    def get_tenant(self, host_id: str) -> Optional[Dict]:
+        row = self._one("SELECT data FROM tenants WHERE host_id = ?", (host_id,))
+        return json.loads(row[0]) if row else None
+
+    def set_tenant(self, host_id: str, fields: Dict):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._merge_tenant(host_id, fields)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _merge_tenant(self, host_id: str, fields: Dict):
+        row = self._conn.execute("SELECT data FROM tenants WHERE host_id = ?", (host_id,)).fetchone()
+        doc = {**(json.loads(row[0]) if row else {}), **json.loads(_dumps(fields))}
+        self._conn.execute(
+            "INSERT INTO tenants (host_id, active, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (host_id) DO UPDATE SET active = excluded.active, data = excluded.data",
+            (host_id, 1 if doc.get("active") else 0, _dumps(doc)),
+        )
+
+    def list_active_tenants(self, limit: int, start_after: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT host_id, data FROM tenants WHERE active = 1 AND host_id > ? ORDER BY host_id LIMIT ?",
+                (start_after or "", limit)).fetchall()
+        return [(r[0], json.loads(r[1])) for r in rows]
+
+    def get_doc(self, host_id: str, collection: str, doc_id: str) -> Optional[Dict]:
+        row = self._one("SELECT data FROM docs WHERE host_id = ? AND collection = ? AND doc_id = ?",
+                        (host_id, collection, doc_id))
+        return json.loads(row[0]) if row else None
+
+    def get_docs(self, host_id: str, collection: str, doc_ids: List[str]) -> Dict[str, Dict]:
+        out = {}
+        ids = list(dict.fromkeys(doc_ids))
+        with self._lock:
+            for i in range(0, len(ids), 500):  # stay under SQLite's bound-parameter limit
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT doc_id, data FROM docs WHERE host_id = ? AND collection = ? "
+                    f"AND doc_id IN ({','.join('?' * len(chunk))})",
+                    (host_id, collection, *chunk)).fetchall()
+                out.update((r[0], json.loads(r[1])) for r in rows)
+        return out
+
+    def _write_doc(self, host_id: str, collection: str, doc_id: str, doc: Dict):
+        self._conn.execute(
+            "INSERT INTO docs (host_id, collection, doc_id, status, data) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (host_id, collection, doc_id) DO UPDATE SET status = excluded.status, data = excluded.data",
+            (host_id, collection, doc_id, doc.get("status"), _dumps(doc)),
+        )
+
+    def _apply(self, host_id: str, op: str, collection: str, doc_id: Optional[str], data: Optional[Dict]):
+        if op == "create" and collection == "messages":
+            self._conn.execute(
+                "INSERT INTO messages (host_id, thread_id, direction, ts, data) VALUES (?, ?, ?, ?, ?)",
+                (host_id, data.get("thread_id"), data.get("direction"),
+                 _json_default(data["ts"]) if "ts" in data else None, _dumps(data)),
+            )
+        elif op == "create":
+            self._write_doc(host_id, collection, uuid.uuid4().hex, data)
+        elif op == "delete":
+            self._conn.execute("DELETE FROM docs WHERE host_id = ? AND collection = ? AND doc_id = ?",
+                               (host_id, collection, doc_id))
+        elif op in ("merge", "update"):
+            row = self._conn.execute("SELECT data FROM docs WHERE host_id = ? AND collection = ? AND doc_id = ?",
+                                     (host_id, collection, doc_id)).fetchone()
+            doc = json.loads(row[0]) if row else None
+            fields = data(doc) if op == "update" else data
+            self._write_doc(host_id, collection, doc_id, {**(doc or {}), **fields})
+        else:
+            self._write_doc(host_id, collection, doc_id, data)
+
+    def commit(self, host_id: str, ops: List[Op]):
+        if not ops:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for op in ops:
+                    self._apply(host_id, *op)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def update_if(self, host_id: str, collection: str, doc_id: str, field: str,
+                  allowed: List, fields: Dict) -> Tuple[bool, Optional[Dict]]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM docs WHERE host_id = ? AND collection = ? AND doc_id = ?",
+                                         (host_id, collection, doc_id)).fetchone()
+                doc = json.loads(row[0]) if row else None
+                if doc is None or doc.get(field) not in allowed:
+                    self._conn.execute("ROLLBACK")
+                    return False, doc
+                doc = {**doc, **json.loads(_dumps(fields))}
+                self._write_doc(host_id, collection, doc_id, doc)
+                self._conn.execute("COMMIT")
+                return True, doc
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # Taking a lease is one conditional upsert: the update only applies when
+    # the current holder is us or has expired.
+    _LEASE_UPSERT = (
+        "INSERT INTO leases (host_id, name, owner, expires_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (host_id, name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+        "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?"
+    )
+
+    def acquire_lease(self, host_id: str, name: str, owner: str, ttl_s: float) -> bool:
+        return bool(self.acquire_leases(name, [host_id], owner, ttl_s))
+
+    def acquire_leases(self, name: str, host_ids: List[str], owner: str, ttl_s: float) -> List[str]:
+        now = time.time()
+        held = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for h in host_ids:
+                    if self._conn.execute(self._LEASE_UPSERT, (h, name, owner, now + ttl_s, now)).rowcount > 0:
+                        held.append(h)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return held
+
+    def renew_leases(self, name: str, host_ids: List[str], owner: str, ttl_s: float) -> List[str]:
+        # Only extends; a lease that was lost is not taken back here
+        if not host_ids:
+            return []
+        now = time.time()
+        held = []
+        with self._lock:
+            for h in host_ids:
+                cur = self._conn.execute(
+                    "UPDATE leases SET expires_at = ? WHERE host_id = ? AND name = ? AND owner = ?",
+                    (now + ttl_s, h, name, owner))
+                if cur.rowcount > 0:
+                    held.append(h)
+        return held
+
+    def release_lease(self, host_id: str, name: str, owner: str, hold_s: float = 0):
+        self.release_leases(name, [host_id], owner, hold_s)
+
+    def release_leases(self, name: str, host_ids: List[str], owner: str, hold_s: float = 0):
+        with self._lock:
+            if hold_s > 0:
+                self._conn.executemany(
+                    "UPDATE leases SET expires_at = ? WHERE host_id = ? AND name = ? AND owner = ?",
+                    [(time.time() + hold_s, h, name, owner) for h in host_ids])
+            else:
+                self._conn.executemany("DELETE FROM leases WHERE host_id = ? AND name = ? AND owner = ?",
+                                       [(h, name, owner) for h in host_ids])
+
+
+class TimedStorage:
+    # Times each public backend call into the cohost_backend_call_seconds metric
+    def __init__(self, inner: Storage):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            with backend_call("storage", name):
+                return attr(*args, **kwargs)
+        return timed
+
+
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+def storage() -> Storage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                backend = os.getenv("STORAGE_BACKEND", "firestore").lower()
+                if backend == "sqlite":
+                    _storage = TimedStorage(SQLiteStorage(os.getenv("SQLITE_PATH", "cohost.db")))
+                elif backend == "firestore":
+                    _storage = TimedStorage(FirestoreStorage())
+                else:
+                    raise ValueError(f"unknown STORAGE_BACKEND {backend!r}")
+    return _storage
+
+def set_storage(backend: Storage):
+    # For tests and benchmarks: swap the process-wide backend
+    global _storage
+    _storage = TimedStorage(backend)
@@ -0,0 +1,157 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+from app.aio import offload
+from app.metrics import backend_call
+from app.storage import FirestoreStorage, Op, Storage, TimedStorage, storage, _queue_writes
+
+# Awaitable face of the storage backend for the async request path, with the
+# same methods and semantics as Storage. Firestore serves the calls made per
+# message and per approval (documents, commits, compare-and-set, tenant
+# pages) through its AsyncClient; anything else, and every SQLite call,
+# goes to the blocking backend on the aio pool.
+
+class AsyncStorage:
+    def __init__(self, backend: Storage):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        async def offloaded(*args, **kwargs):
+            return await offload(attr, *args, **kwargs)
+        return offloaded
+
+
+class AsyncFirestoreStorage(AsyncStorage):
+    BATCH_LIMIT = FirestoreStorage.BATCH_LIMIT
+
+    def __init__(self, backend: Storage):
+        super().__init__(backend)
+        self._db = None
+
+    def db(self):
+        if self._db is None:
+            try:
+                from google.cloud import firestore
+                self._db = firestore.AsyncClient()
+            except Exception as e:
+                print(f"Warning: Firestore not available: {e}")
+                return None
+        return self._db
+
+    def _tenant(self, db_client, host_id: str):
+        return db_client.collection("tenants").document(host_id)
+
+    async def get_tenant(self, host_id: str) -> Optional[Dict]:
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.get_tenant, host_id)
+        with backend_call("storage", "get_tenant"):
+            snap = await self._tenant(db_client, host_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    async def set_tenant(self, host_id: str, fields: Dict):
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.set_tenant, host_id, fields)
+        with backend_call("storage", "set_tenant"):
+            await self._tenant(db_client, host_id).set(fields, merge=True)
+
+    async def list_active_tenants(self, limit: int, start_after: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.list_active_tenants, limit, start_after)
+        q = db_client.collection("tenants").where("active", "==", True).order_by("__name__")
+        if start_after:
+            q = q.start_after({"__name__": start_after})
+        with backend_call("storage", "list_active_tenants"):
+            return [(d.id, d.to_dict()) async for d in q.limit(limit).stream()]
+
+    async def get_doc(self, host_id: str, collection: str, doc_id: str) -> Optional[Dict]:
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.get_doc, host_id, collection, doc_id)
+        with backend_call("storage", "get_doc"):
+            snap = await self._tenant(db_client, host_id).collection(collection).document(doc_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    async def get_docs(self, host_id: str, collection: str, doc_ids: List[str]) -> Dict[str, Dict]:
+        if not doc_ids:
+            return {}
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.get_docs, host_id, collection, doc_ids)
+        coll = self._tenant(db_client, host_id).collection(collection)
+        with backend_call("storage", "get_docs"):
+            return {s.id: s.to_dict() async for s in db_client.get_all([coll.document(d) for d in doc_ids]) if s.exists}
+
+    async def commit(self, host_id: str, ops: List[Op]):
+        if not ops:
+            return
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.commit, host_id, ops)
+        if len(ops) > self.BATCH_LIMIT:
+            raise ValueError(f"{len(ops)} writes in one commit; Firestore allows {self.BATCH_LIMIT}")
+        tenant = self._tenant(db_client, host_id)
+        reads = list(dict.fromkeys((coll, doc_id) for op, coll, doc_id, _ in ops if op == "update"))
+        if not reads:
+            batch = db_client.batch()
+            _queue_writes(batch, tenant, ops, {})
+            with backend_call("storage", "commit"):
+                await batch.commit()
+            return
+
+        from google.cloud import firestore
+
+        @firestore.async_transactional
+        async def _commit(transaction):
+            current = {}
+            for coll, doc_id in reads:
+                snap = await tenant.collection(coll).document(doc_id).get(transaction=transaction)
+                current[(coll, doc_id)] = snap.to_dict() if snap.exists else None
+            _queue_writes(transaction, tenant, ops, current)
+
+        with backend_call("storage", "commit"):
+            await _commit(db_client.transaction())
+
+    async def update_if(self, host_id: str, collection: str, doc_id: str, field: str,
+                        allowed: List, fields: Dict) -> Tuple[bool, Optional[Dict]]:
+        db_client = self.db()
+        if db_client is None:
+            return await offload(self.backend.update_if, host_id, collection, doc_id, field, allowed, fields)
+        ref = self._tenant(db_client, host_id).collection(collection).document(doc_id)
+
+        from google.cloud import firestore
+
+        @firestore.async_transactional
+        async def _update(transaction):
+            snap = await ref.get(transaction=transaction)
+            doc = snap.to_dict() if snap.exists else None
+            if doc is None or doc.get(field) not in allowed:
+                return False, doc
+            transaction.set(ref, fields, merge=True)
+            return True, {**doc, **fields}
+
+        with backend_call("storage", "update_if"):
+            return await _update(db_client.transaction())
+
+    async def set_doc(self, host_id: str, collection: str, doc_id: str, data: Dict, merge: bool = False):
+        await self.commit(host_id, [("merge" if merge else "set", collection, doc_id, data)])
+
+
+_astorage: Optional[AsyncStorage] = None
+_astorage_lock = threading.Lock()
+
+def astorage() -> AsyncStorage:
+    # Follows storage(), including a backend swapped in with set_storage
+    global _astorage
+    backend = storage()
+    if _astorage is None or _astorage.backend is not backend:
+        with _astorage_lock:
+            if _astorage is None or _astorage.backend is not backend:
+                inner = backend.inner if isinstance(backend, TimedStorage) else backend
+                _astorage = AsyncFirestoreStorage(backend) if isinstance(inner, FirestoreStorage) else AsyncStorage(backend)
+    return _astorage
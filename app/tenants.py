@@ -1,89 +1,124 @@
+import copy, os, socket, uuid
 import datetime as dt
-from typing import Dict, List, Optional
-from google.cloud import firestore
-
-_db = None
-def db():
-    global _db
-    if _db is None:
-        try:
-            _db = firestore.Client()
-        except Exception as e:
-            print(f"Warning: Firestore not available: {e}")
-            # Return a mock client for local development
-            return None
-    return _db
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.cache import TTLCache
+from app.storage import storage
 
+# Tenant and listing documents change rarely but are read on every poll and
+# message; keep them per process for a short while.
+CACHE_TTL_S = float(os.getenv("TENANT_CACHE_TTL_S", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("TENANT_CACHE_MAX_ENTRIES", "2048"))
+_tenant_cache = TTLCache("tenants", maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+_listing_cache = TTLCache("listings", maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+
+# Poll leases: several instances can poll at once; each host is worked on by
+# whichever instance holds its "poll" lease, renewed while the work runs and
+# released after. A lease left by a crashed instance expires after the TTL.
+# After a poll round the lease is kept for POLL_LEASE_COOLDOWN_S more, so an
+# instance still working through the same round doesn't poll the host again.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+POLL_LEASE_TTL_S = float(os.getenv("POLL_LEASE_TTL_S", "90"))
+POLL_LEASE_COOLDOWN_S = float(os.getenv("POLL_LEASE_COOLDOWN_S", "30"))
+
+def cache_stats() -> List[Dict]:
+    return [_tenant_cache.stats(), _listing_cache.stats()]
+
+def _merge_cached_tenant(host_id: str, fields: Dict):
+    _tenant_cache.update(host_id, lambda t: {**t, **fields} if t else t)
+
+DEFAULT_LISTING_CONFIG = {
+    "check_in_after": "15:00",
+    "check_in_notes": "Smart-lock code arrives at 9am on arrival day.",
+    "check_out_before": "11:00",
+    "wifi_ssid": "Home-Guest",
+    "wifi_password": "StayHappy2025",
+    "parking_notes": "Free on-street after 18:00; nearest paid car park on King St.",
+    "tone": "friendly, concise, professional",
+    "blocked_auto_send_keywords": [
+        "refund","discount","damage","compensation","price match","exception"
+    ]
+}
+
+# Writes invalidate the cache after storage has the new document; before it,
+# a concurrent read could cache the old one again for the full TTL
 def upsert_tenant(host_id: str, email: str):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: upsert_tenant({host_id}, {email})")
-        return
-    doc = db_client.collection("tenants").document(host_id)
-    doc.set({
+    storage().set_tenant(host_id, {
         "hostEmail": email,
         "active": False,
         "createdAt": dt.datetime.utcnow()
-    }, merge=True)
+    })
+    _tenant_cache.invalidate(host_id)
 
 def set_active(host_id: str, active: bool):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: set_active({host_id}, {active})")
-        return
-    db_client.collection("tenants").document(host_id).set({"active": active}, merge=True)
+    storage().set_tenant(host_id, {"active": active})
+    _tenant_cache.invalidate(host_id)
+
+def save_sync_cursor(host_id: str, history_id: str):
+    fields = {"gmailHistoryId": history_id, "syncedAt": dt.datetime.utcnow()}
+    storage().set_tenant(host_id, fields)
+    _merge_cached_tenant(host_id, fields)
+
+def save_watch(host_id: str, expiration_ms: int):
+    fields = {"gmailWatchExpiration": int(expiration_ms)}
+    storage().set_tenant(host_id, fields)
+    _merge_cached_tenant(host_id, fields)
+
+def save_poll_schedule(host_id: str, schedule: Dict):
+    fields = {"pollSchedule": schedule}
+    storage().set_tenant(host_id, fields)
+    _merge_cached_tenant(host_id, fields)
 
 def get_tenant(host_id: str) -> Optional[Dict]:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: get_tenant({host_id})")
-        return {"hostEmail": "test@example.com", "active": True}
-    snap = db_client.collection("tenants").document(host_id).get()
-    return snap.to_dict() if snap.exists else None
-
-def list_active_hosts(limit: int = 200) -> List[str]:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: list_active_hosts()")
-        return ["host-you"]
-    q = db_client.collection("tenants").where("active", "==", True).limit(limit)
-    return [d.id for d in q.stream()]
+    # Unknown tenants are cached too (as None); registering invalidates them
+    return copy.deepcopy(_tenant_cache.get_or_load(host_id, lambda: storage().get_tenant(host_id)))
+
+def iter_active_tenants(page_size: int = 200, start_after: Optional[str] = None) -> Iterator[List[Tuple[str, Dict]]]:
+    # Pages of (host id, tenant document) in host id order, one storage query
+    # per page, so only one page is held at a time however many tenants there
+    # are. Read straight from storage: the poll schedule other instances wrote
+    # matters here.
+    while True:
+        page = storage().list_active_tenants(page_size, start_after)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        start_after = page[-1][0]
+
+# Where an interrupted /poll stopped, so the next one carries on from there.
+# Kept under a reserved id next to the tenants, shared by every instance.
+SYSTEM_ID = "_system"
+
+def load_poll_cursor() -> Optional[str]:
+    doc = storage().get_doc(SYSTEM_ID, "state", "poll")
+    return (doc or {}).get("cursor")
+
+def save_poll_cursor(cursor: Optional[str]):
+    storage().set_doc(SYSTEM_ID, "state", "poll", {"cursor": cursor, "updatedAt": dt.datetime.utcnow()})
 
 def save_listing_config(host_id: str, listing_id: str, cfg: Dict):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: save_listing_config({host_id}, {listing_id})")
-        return
-    db_client.collection("tenants").document(host_id)\
-      .collection("listings").document(listing_id).set(cfg, merge=True)
+    storage().set_doc(host_id, "listings", listing_id, cfg, merge=True)
+    _listing_cache.invalidate((host_id, listing_id))
 
 def get_listing_config(host_id: str, listing_id: str = "default") -> Dict:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: get_listing_config({host_id}, {listing_id})")
-        return {
-            "check_in_after": "15:00",
-            "check_out_before": "11:00",
-            "wifi_ssid": "Home-Guest",
-            "wifi_password": "StayHappy2025",
-            "parking_notes": "Free on-street after 18:00; nearest paid car park on King St.",
-            "tone": "friendly, concise, professional",
-            "blocked_auto_send_keywords": [
-                "refund","discount","damage","compensation","price match","exception"
-            ]
-        }
-    snap = db_client.collection("tenants").document(host_id)\
-             .collection("listings").document(listing_id).get()
-    if snap.exists:
-        return snap.to_dict()
-    return {
-        "check_in_after": "15:00",
-        "check_out_before": "11:00",
-        "wifi_ssid": "Home-Guest",
-        "wifi_password": "StayHappy2025",
-        "parking_notes": "Free on-street after 18:00; nearest paid car park on King St.",
-        "tone": "friendly, concise, professional",
-        "blocked_auto_send_keywords": [
-            "refund","discount","damage","compensation","price match","exception"
-        ]
-    }
+    return copy.deepcopy(_listing_cache.get_or_load(
+        (host_id, listing_id), lambda: _load_listing_config(host_id, listing_id)))
+
+def _load_listing_config(host_id: str, listing_id: str) -> Dict:
+    return storage().get_doc(host_id, "listings", listing_id) or DEFAULT_LISTING_CONFIG
+
+def acquire_host_lease(host_id: str, ttl_s: float = POLL_LEASE_TTL_S) -> bool:
+    return storage().acquire_lease(host_id, "poll", INSTANCE_ID, ttl_s)
+
+def acquire_host_leases(host_ids: List[str], ttl_s: float = POLL_LEASE_TTL_S) -> List[str]:
+    return storage().acquire_leases("poll", host_ids, INSTANCE_ID, ttl_s)
+
+def renew_host_leases(host_ids: List[str], ttl_s: float = POLL_LEASE_TTL_S) -> List[str]:
+    return storage().renew_leases("poll", host_ids, INSTANCE_ID, ttl_s)
+
+def release_host_lease(host_id: str):
+    storage().release_lease(host_id, "poll", INSTANCE_ID)
+
+def release_host_leases(host_ids: List[str], hold_s: float = 0):
+    storage().release_leases("poll", host_ids, INSTANCE_ID, hold_s)
@@ -1,30 +1,12 @@
 from typing import Optional, Dict
-from google.cloud import firestore
-
-_db = None
-def db():
-    global _db
-    if _db is None:
-        try:
-            _db = firestore.Client()
-        except Exception as e:
-            print(f"Warning: Firestore not available: {e}")
-            return None
-    return _db
+from app.storage import storage
 
 def save_gmail_creds(host_id: str, creds: Dict):
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: save_gmail_creds({host_id})")
-        return
-    db_client.collection("tenants").document(host_id)\
-      .collection("oauth").document("gmail").set(creds, merge=True)
+    storage().set_doc(host_id, "oauth", "gmail", creds, merge=True)
+
+def save_gmail_token(host_id: str, token: str, expiry):
+    # Refreshed access token only; the grant itself is left as stored
+    storage().set_doc(host_id, "oauth", "gmail", {"token": token, "expiry": expiry}, merge=True)
 
 def load_gmail_creds(host_id: str) -> Optional[Dict]:
-    db_client = db()
-    if db_client is None:
-        print(f"Mock: load_gmail_creds({host_id})")
-        return None
-    snap = db_client.collection("tenants").document(host_id)\
-              .collection("oauth").document("gmail").get()
-    return snap.to_dict() if snap.exists else None
+    return storage().get_doc(host_id, "oauth", "gmail")
@@ -1,14 +1,26 @@
-import os
-from google.cloud import aiplatform
+import asyncio, contextvars, os, threading, time, weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+from app.aio import offload
+from app.cache import TTLCache
+from app.metrics import backend_call
 
 PROJECT = os.getenv("GCP_PROJECT_ID")
 LOCATION = os.getenv("GCP_LOCATION", "europe-west2")
 MODEL = os.getenv("MODEL", "gemini-1.5-pro")
+# Replies in flight at once across the process, and how long a caller waits for one
+MAX_CONCURRENCY = int(os.getenv("VERTEX_MAX_CONCURRENCY", "8"))
+TIMEOUT_S = float(os.getenv("VERTEX_TIMEOUT_S", "20"))
+MAX_OUTPUT_TOKENS = 256
+TEMPERATURE = 0.4
 
 _client_inited = False
 def _init():
     global _client_inited
     if not _client_inited:
+        # google.cloud.aiplatform takes seconds to import; only requests that
+        # reach Vertex pay for it (or app.warmup, ahead of them)
+        from google.cloud import aiplatform
         aiplatform.init(project=PROJECT, location=LOCATION)
         _client_inited = True
 
@@ -24,19 +36,100 @@ def build_system_prompt(listing_cfg: dict):
     parts.append(f"Parking: {listing_cfg.get('parking_notes')}")
     return "\n".join(parts)
 
-def llm_reply(message_text: str, listing_cfg: dict, guest_name="there") -> str:
-    _init()
-    from vertexai.generative_models import GenerativeModel, GenerationConfig, SafetySetting, HarmCategory
+_models = TTLCache("vertex_models", maxsize=256, ttl=3600, sliding=True)
+_models_lock = threading.Lock()
 
-    sys_prompt = build_system_prompt(listing_cfg)
-    model = GenerativeModel(MODEL, system_instruction=sys_prompt)
-    config = GenerationConfig(max_output_tokens=256, temperature=0.4)
-    safety = [
-        SafetySetting(HarmCategory.HARM_CATEGORY_HATE_SPEECH, SafetySetting.BlockThreshold.BLOCK_NONE),
-        SafetySetting(HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, SafetySetting.BlockThreshold.BLOCK_NONE),
-        SafetySetting(HarmCategory.HARM_CATEGORY_HARASSMENT, SafetySetting.BlockThreshold.BLOCK_NONE),
-        SafetySetting(HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, SafetySetting.BlockThreshold.BLOCK_NONE),
-    ]
+def _model_key(sys_prompt: str):
+    return (MODEL, sys_prompt, MAX_OUTPUT_TOKENS, TEMPERATURE)
+
+def _model(sys_prompt: str):
+    # One GenerativeModel per (model, system prompt, generation settings), with
+    # the generation config and safety settings bound at construction.
+    key = _model_key(sys_prompt)
+    model = _models.get(key, None)
+    if model is not None:
+        return model
+    with _models_lock:
+        model = _models.get(key, None)
+        if model is None:
+            _init()
+            from vertexai.generative_models import GenerativeModel, GenerationConfig, SafetySetting, HarmCategory
+            safety = [
+                SafetySetting(HarmCategory.HARM_CATEGORY_HATE_SPEECH, SafetySetting.BlockThreshold.BLOCK_NONE),
+                SafetySetting(HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, SafetySetting.BlockThreshold.BLOCK_NONE),
+                SafetySetting(HarmCategory.HARM_CATEGORY_HARASSMENT, SafetySetting.BlockThreshold.BLOCK_NONE),
+                SafetySetting(HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, SafetySetting.BlockThreshold.BLOCK_NONE),
+            ]
+            model = GenerativeModel(
+                MODEL,
+                system_instruction=sys_prompt,
+                generation_config=GenerationConfig(max_output_tokens=MAX_OUTPUT_TOKENS, temperature=TEMPERATURE),
+                safety_settings=safety,
+            )
+            _models.set(key, model)
+    return model
+
+def _prompt(message_text: str, guest_name: str, context: str) -> str:
+    # context: the thread so far (app.conversation.render_context), already size-bounded
     prompt = f"Guest ({guest_name}) asked:\n{message_text}\n\nReply in 1–4 concise sentences."
-    out = model.generate_content([prompt], generation_config=config, safety_settings=safety)
+    return f"{context}\n\n{prompt}" if context else prompt
+
+def llm_reply(message_text: str, listing_cfg: dict, guest_name="there", context: str = "") -> str:
+    model = _model(build_system_prompt(listing_cfg))
+    with backend_call("vertex", "generate_content"):
+        out = model.generate_content([_prompt(message_text, guest_name, context)])
+    return out.text.strip() if hasattr(out, "text") else ""
+
+_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="vertex")
+
+class VertexCall(Future):
+    # A reply queued on the Vertex pool. started is set (and started_at, in
+    # monotonic time) when a worker takes it, so callers can time their wait
+    # from when Vertex was actually asked rather than from when the call was
+    # queued; cancel() succeeds until then and the call is never made.
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.started_at: Optional[float] = None
+
+def llm_reply_async(message_text: str, listing_cfg: dict, guest_name="there", context: str = "") -> VertexCall:
+    # Runs on a pool capped at VERTEX_MAX_CONCURRENCY; extra calls queue.
+    # generate_content has no timeout, so callers bound their wait with
+    # Future.result(timeout=...) and treat a timeout as "no AI reply".
+    # The call runs in a copy of the caller's context (metrics tenant label).
+    ctx = contextvars.copy_context()
+    call = VertexCall()
+
+    def _run():
+        if not call.set_running_or_notify_cancel():
+            return
+        call.started_at = time.monotonic()
+        call.started.set()
+        try:
+            call.set_result(ctx.run(llm_reply, message_text, listing_cfg, guest_name, context))
+        except BaseException as e:
+            call.set_exception(e)
+
+    _pool.submit(_run)
+    return call
+
+# The async request path awaits Vertex on the event loop instead; the same
+# VERTEX_MAX_CONCURRENCY cap applies, per loop, and VERTEX_TIMEOUT_S counts
+# from when a call gets a slot. A call that runs out of time (or whose caller
+# is cancelled) is cancelled on the wire, not left running.
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+async def llm_reply_aio(message_text: str, listing_cfg: dict, guest_name="there", context: str = "") -> str:
+    loop = asyncio.get_running_loop()
+    sem = _semaphores.get(loop)
+    if sem is None:
+        sem = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY)
+    sys_prompt = build_system_prompt(listing_cfg)
+    # A model not built yet may mean importing and initialising the Vertex
+    # SDK first (seconds), so that happens off the loop
+    model = _models.get(_model_key(sys_prompt), None) or await offload(_model, sys_prompt)
+    async with sem:
+        with backend_call("vertex", "generate_content"):
+            out = await asyncio.wait_for(
+                model.generate_content_async([_prompt(message_text, guest_name, context)]), TIMEOUT_S)
     return out.text.strip() if hasattr(out, "text") else ""
@@ -0,0 +1,65 @@
+import importlib, os, threading, time
+from typing import Callable, Dict, List, Tuple
+
+# Loads what the Google client libraries would otherwise load on the first
+# request that needs them (app.main itself imports none of them), in one
+# background thread so the instance serves /healthz and approval clicks
+# meanwhile. Started by /warmup or, with WARMUP_ON_START, at startup.
+# Cheapest and most often needed first; Vertex, seconds on its own, last.
+
+def _storage():
+    if os.getenv("STORAGE_BACKEND", "firestore").lower() == "firestore":
+        importlib.import_module("google.cloud.firestore")
+
+def _gmail():
+    for module in ("google.oauth2.credentials", "google.auth.transport.requests",
+                   "googleapiclient.discovery", "googleapiclient.http"):
+        importlib.import_module(module)
+    from app.gmail_io import _gmail_discovery_doc
+    _gmail_discovery_doc()
+
+def _oauth():
+    importlib.import_module("google_auth_oauthlib.flow")
+
+def _vertex():
+    from app.vertex_reply import _init
+    _init()
+    importlib.import_module("vertexai.generative_models")
+
+STEPS: List[Tuple[str, Callable]] = [
+    ("storage", _storage),
+    ("gmail", _gmail),
+    ("oauth", _oauth),
+    ("vertex", _vertex),
+]
+
+_state = {"state": "idle", "steps": {}}
+_lock = threading.Lock()
+_thread = None
+
+def run_warmup() -> Dict:
+    # Every step, in this thread; a step that fails is reported and skipped
+    _state["state"] = "running"
+    for name, step in STEPS:
+        t0 = time.perf_counter()
+        try:
+            step()
+            _state["steps"][name] = {"ms": int((time.perf_counter() - t0) * 1000)}
+        except Exception as e:
+            print(f"Warning: warm-up step {name} failed: {e}")
+            _state["steps"][name] = {"ms": int((time.perf_counter() - t0) * 1000), "error": str(e)}
+    _state["state"] = "done"
+    return warmup_status()
+
+def start_warmup() -> threading.Thread:
+    # At most once per process; later calls get the running (or finished) thread
+    global _thread
+    with _lock:
+        if _thread is None:
+            _state["state"] = "running"
+            _thread = threading.Thread(target=run_warmup, name="warmup", daemon=True)
+            _thread.start()
+        return _thread
+
+def warmup_status() -> Dict:
+    return {"state": _state["state"], "steps": dict(_state["steps"])}
@@ -0,0 +1,93 @@
+import argparse, asyncio, datetime as dt
+
+# A guest who writes again before the host has approved the pending draft:
+# the new draft has to answer both messages and replace the old one, while a
+# draft the host already acted on is left alone. Runs the poller (thread and
+# event-loop paths) against the fake Gmail server with SQLite storage and an
+# LLM stand-in that echoes what it was asked. Exits 1 on a failed check.
+#   python -m bench.draft_replace
+
+GUEST = "Guest via Airbnb <express@airbnb.com>"
+
+def echo_llm(message_text: str, listing_cfg: dict, guest_name: str = "there", context: str = "") -> str:
+    return "Answering: " + " / ".join(line for line in message_text.splitlines() if line.strip())
+
+async def echo_llm_aio(message_text: str, listing_cfg: dict, guest_name: str = "there", context: str = "") -> str:
+    return echo_llm(message_text, listing_cfg, guest_name, context)
+
+def run_checks(aio: bool) -> list:
+    import app.gmail_async as gmail_async
+    import app.gmail_io as gmail_io
+    import app.reply_cache as reply_cache
+    import app.vertex_reply as vertex_reply
+    from app.credential_manager import forget_credentials
+    from app.datastore import get_conversation, get_drafts, transition_draft
+    from app.poller import process_host, process_host_aio
+    from app.storage import SQLiteStorage, set_storage
+    from app.token_store import save_gmail_creds
+    from bench.fake_gmail import FakeGmailServer, make_message
+    from googleapiclient.discovery import build_from_document
+
+    store = SQLiteStorage(":memory:")
+    set_storage(store)
+    vertex_reply.llm_reply = reply_cache.llm_reply = echo_llm
+    vertex_reply.llm_reply_aio = reply_cache.llm_reply_aio = echo_llm_aio
+    failures = []
+
+    def check(ok: bool, what: str):
+        if not ok:
+            failures.append(("aio: " if aio else "sync: ") + what)
+
+    with FakeGmailServer() as server:
+        gmail_io.gmail_service = lambda creds: build_from_document(
+            gmail_io._gmail_discovery_doc(), credentials=creds, client_options={"api_endpoint": server.endpoint("h")})
+        gmail_async.api_base = server.endpoint
+        mailbox = server.mailbox_for("h")
+        store.set_tenant("h", {"hostEmail": "h@example.com", "active": True, "gmailHistoryId": str(mailbox.history_id)})
+        forget_credentials("h")
+        save_gmail_creds("h", {"token": "bench", "refresh_token": "bench:h", "client_id": "bench",
+                               "client_secret": "bench", "token_uri": "https://oauth2.googleapis.com/token",
+                               "scopes": gmail_io.SCOPES, "expiry": dt.datetime.utcnow() + dt.timedelta(days=1)})
+
+        def poll(msg_id: str, thread_id: str, text: str, at: int):
+            mailbox.add(make_message(msg_id, thread_id, GUEST, "Reservation", text, internal_date=at))
+            return asyncio.run(process_host_aio("h")) if aio else process_host("h")
+
+        # Still pending: replaced by one draft answering both
+        poll("a1", "ta", "What time is check-in?", 1)
+        poll("a2", "ta", "Also, do you allow dogs?", 2)
+        drafts = get_drafts("h", ["a1", "a2"])
+        check(drafts.get("a1", {}).get("status") == "superseded", f"a1 is {drafts.get('a1', {}).get('status')}")
+        body = drafts.get("a2", {}).get("body", "")
+        check(drafts.get("a2", {}).get("status") == "pending", "a2 not pending")
+        check("check-in" in body.lower() and "dogs" in body.lower(), f"a2 does not answer both: {body!r}")
+        check(drafts.get("a2", {}).get("message_ids") == ["a1", "a2"], f"a2 answers {drafts.get('a2', {}).get('message_ids')}")
+        turns = (get_conversation("h", "ta") or {}).get("turns", [])
+        check(len(turns) == 2, f"{len(turns)} conversation turns for 2 guest messages")
+
+        # And again: the replacement carries everything it answered
+        poll("a3", "ta", "Is there a cot for our baby?", 3)
+        d3 = get_drafts("h", ["a3"]).get("a3", {})
+        check(d3.get("message_ids") == ["a1", "a2", "a3"], f"a3 answers {d3.get('message_ids')}")
+
+        # Rejected by the host: left alone, the new draft answers only what's new
+        poll("b1", "tb", "What time is check-in?", 4)
+        transition_draft("h", "b1", ["pending"], "rejected")
+        poll("b2", "tb", "Do you allow dogs?", 5)
+        drafts = get_drafts("h", ["b1", "b2"])
+        check(drafts.get("b1", {}).get("status") == "rejected", f"b1 is {drafts.get('b1', {}).get('status')}")
+        check("check-in" not in drafts.get("b2", {}).get("body", "").lower(), "b2 answers the rejected draft too")
+    return failures
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.parse_args()
+    failures = run_checks(aio=False) + run_checks(aio=True)
+    for f in failures:
+        print("FAIL " + f)
+    if failures:
+        raise SystemExit(1)
+    print("ok: pending drafts are replaced by one answering every message; handled drafts are left alone")
+
+if __name__ == "__main__":
+    main()
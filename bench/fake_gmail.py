@@ -0,0 +1,257 @@
+import base64, json, re, threading, time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for the slice of the Gmail REST API that app.gmail_io uses,
+# including the multipart batch endpoint. Every HTTP request is counted so
+# callers can check how many round trips a code path makes. One server can
+# hold many mailboxes: service(name) talks to mailbox_for(name) under /h/<name>/.
+# With user_quota_per_s set, a mailbox spending more quota units than that in
+# any one second gets 429 userRateLimitExceeded, as Gmail does.
+
+QUOTA_COST = {"messages.list": 5, "messages.get": 5, "messages.send": 100, "history.list": 2, "getProfile": 1}
+
+def make_message(msg_id: str, thread_id: str, sender: str, subject: str, text: str,
+                 internal_date: int = 0, attachment_bytes: int = 0) -> Dict:
+    parts = [{
+        "mimeType": "text/plain",
+        "body": {"data": base64.urlsafe_b64encode(text.encode()).decode()},
+    }]
+    if attachment_bytes:
+        parts.append({
+            "mimeType": "application/pdf",
+            "filename": "house-rules.pdf",
+            "body": {"data": base64.urlsafe_b64encode(b"x" * attachment_bytes).decode()},
+        })
+    return {
+        "id": msg_id,
+        "threadId": thread_id,
+        "labelIds": ["INBOX"],
+        "internalDate": str(internal_date),
+        "payload": {
+            "mimeType": "multipart/mixed",
+            "headers": [
+                {"name": "From", "value": sender},
+                {"name": "Subject", "value": subject},
+                {"name": "Date", "value": "Mon, 1 Sep 2025 10:00:00 +0000"},
+            ],
+            "parts": parts,
+        },
+    }
+
+
+class FakeMailbox:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages: Dict[str, Dict] = {}
+        self.order: List[str] = []
+        self.history: List[Dict] = []
+        self.history_id = 1000
+        self.sent: List[Dict] = []
+        self.spent: List[tuple] = []  # (time, quota units) over the last second
+
+    def add(self, msg: Dict):
+        with self.lock:
+            self.messages[msg["id"]] = msg
+            self.order.append(msg["id"])
+            self.history_id += 1
+            self.history.append({
+                "id": str(self.history_id),
+                "messagesAdded": [{"message": {"id": msg["id"], "threadId": msg["threadId"]}}],
+            })
+
+    def view(self, msg_id: str, fmt: str, headers: List[str]) -> Dict | None:
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            return None
+        if fmt == "full":
+            return msg
+        wanted = {h.lower() for h in headers}
+        return {
+            "id": msg["id"],
+            "threadId": msg["threadId"],
+            "labelIds": msg["labelIds"],
+            "internalDate": msg["internalDate"],
+            "payload": {
+                "mimeType": msg["payload"]["mimeType"],
+                "headers": [h for h in msg["payload"]["headers"] if not wanted or h["name"].lower() in wanted],
+            },
+        }
+
+
+class FakeGmailServer:
+    def __init__(self, mailbox: FakeMailbox | None = None, user_quota_per_s: float = 0, latency_s: float = 0):
+        self.mailbox = mailbox or FakeMailbox()
+        self.user_quota_per_s = user_quota_per_s
+        # Added to every HTTP request, standing in for the round trip to Google
+        self.latency_s = latency_s
+        self.mailboxes: Dict[str, FakeMailbox] = {}
+        self.round_trips = 0
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like Gmail; every reply carries Content-Length. Headers
+            # and body go out in separate writes, so without TCP_NODELAY each
+            # reply waits on the client's delayed ACK
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes, ctype="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server._count("http")
+                time.sleep(server.latency_s)
+                status, doc = server.dispatch("GET", self.path, b"")
+                self._reply(status, json.dumps(doc).encode())
+
+            def do_POST(self):
+                server._count("http")
+                time.sleep(server.latency_s)
+                data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if "/batch/" in urlparse(self.path).path:
+                    boundary, body = server.dispatch_batch(self.headers["Content-Type"], data)
+                    self._reply(200, body, f"multipart/mixed; boundary={boundary}")
+                    return
+                status, doc = server.dispatch("POST", self.path, data)
+                self._reply(status, json.dumps(doc).encode())
+
+        class Server(ThreadingHTTPServer):
+            # The default backlog of 5 drops connects from concurrent clients
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, name: str):
+        with self._lock:
+            if name == "http":
+                self.round_trips += 1
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.round_trips = 0
+            self.calls = {}
+
+    def mailbox_for(self, name: str) -> FakeMailbox:
+        with self._lock:
+            return self.mailboxes.setdefault(name, FakeMailbox())
+
+    def endpoint(self, name: str | None = None) -> str:
+        return self.url if name is None else f"{self.url}h/{name}/"
+
+    def service(self, name: str | None = None, credentials=None):
+        from google.auth.credentials import AnonymousCredentials
+        from googleapiclient.discovery import build
+        return build("gmail", "v1", credentials=credentials or AnonymousCredentials(),
+                     client_options={"api_endpoint": self.endpoint(name)}, static_discovery=True)
+
+    def dispatch(self, method: str, path: str, body: bytes):
+        url = urlparse(path)
+        qs = parse_qs(url.query)
+        mb = self.mailbox
+        prefixed = re.fullmatch(r"/h/([^/]+)(/.*)", url.path)
+        if prefixed:
+            mb = self.mailbox_for(prefixed.group(1))
+            url = url._replace(path=prefixed.group(2))
+        m = re.fullmatch(r"/gmail/v1/users/me/(.*)", url.path)
+        route = m.group(1) if m else ""
+        with mb.lock:
+            if self.user_quota_per_s and not self._charge(mb, method, route):
+                self._count("throttled")
+                return 429, {"error": {"code": 429, "message": "User-rate limit exceeded",
+                                       "errors": [{"reason": "userRateLimitExceeded"}]}}
+            if method == "GET" and route == "messages":
+                self._count("messages.list")
+                limit = int(qs.get("maxResults", ["100"])[0])
+                ids = list(reversed(mb.order))[:limit]
+                return 200, {"messages": [{"id": i, "threadId": mb.messages[i]["threadId"]} for i in ids]}
+            if method == "GET" and route.startswith("messages/"):
+                self._count("messages.get")
+                msg = mb.view(route.split("/", 1)[1], qs.get("format", ["full"])[0], qs.get("metadataHeaders", []))
+                if msg is None:
+                    return 404, {"error": {"code": 404, "message": "Not Found"}}
+                return 200, msg
+            if method == "GET" and route == "history":
+                self._count("history.list")
+                start = int(qs["startHistoryId"][0])
+                if mb.history and start < int(mb.history[0]["id"]) - 1:
+                    return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+                return 200, {"history": [h for h in mb.history if int(h["id"]) > start],
+                             "historyId": str(mb.history_id)}
+            if method == "GET" and route == "profile":
+                self._count("getProfile")
+                return 200, {"emailAddress": "host@example.com", "historyId": str(mb.history_id)}
+            if method == "POST" and route == "messages/send":
+                self._count("messages.send")
+                doc = json.loads(body or b"{}")
+                mb.sent.append(doc)
+                return 200, {"id": f"sent-{len(mb.sent)}", "threadId": doc.get("threadId") or f"sent-{len(mb.sent)}"}
+        return 404, {"error": {"code": 404, "message": f"no fake for {method} {url.path}"}}
+
+    def _charge(self, mb: FakeMailbox, method: str, route: str) -> bool:
+        if method == "POST":
+            op = "messages.send"
+        elif route == "messages":
+            op = "messages.list"
+        elif route == "history":
+            op = "history.list"
+        elif route == "profile":
+            op = "getProfile"
+        else:
+            op = "messages.get"
+        now = time.monotonic()
+        mb.spent = [(t, c) for t, c in mb.spent if t > now - 1]
+        if sum(c for _, c in mb.spent) + QUOTA_COST[op] > self.user_quota_per_s:
+            return False
+        mb.spent.append((now, QUOTA_COST[op]))
+        return True
+
+    def dispatch_batch(self, content_type: str, data: bytes):
+        self._count("batch")
+        envelope = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + data)
+        out_boundary = "fake_gmail_batch"
+        chunks = []
+        for part in envelope.iter_parts():
+            content_id = part["Content-ID"].strip("<>")
+            raw = part.get_payload(decode=True)
+            request_line, _, rest = raw.partition(b"\r\n" if b"\r\n" in raw else b"\n")
+            method, path, _ = request_line.decode().split(" ", 2)
+            _, _, inner_body = rest.partition(b"\r\n\r\n")
+            status, doc = self.dispatch(method, path, inner_body)
+            payload = json.dumps(doc)
+            chunks.append(
+                f"--{out_boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+                f"{payload}\r\n"
+            )
+        chunks.append(f"--{out_boundary}--\r\n")
+        return out_boundary, "".join(chunks).encode()
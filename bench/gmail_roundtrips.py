@@ -0,0 +1,52 @@
+import argparse
+
+from app.gmail_io import (
+    batch_get_messages, get_message, list_messages, message_headers, TRIAGE_HEADERS, BATCH_SIZE,
+)
+from bench.fake_gmail import FakeGmailServer, make_message
+
+# Counts Gmail HTTP round trips for one listing: the old per-message
+# format=full fetch against header triage plus batched body fetches.
+#   python -m bench.gmail_roundtrips --messages 40 --handled 30
+
+def seed(server: FakeGmailServer, n: int):
+    for i in range(n):
+        server.mailbox.add(make_message(
+            f"m{i:04d}", f"t{i // 2:04d}", "Guest via Airbnb <express@airbnb.com>",
+            f"Reservation {i}", f"Hello, question number {i}", internal_date=i,
+            attachment_bytes=20_000,
+        ))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=40)
+    ap.add_argument("--handled", type=int, default=30, help="messages already processed (skipped after triage)")
+    args = ap.parse_args()
+
+    with FakeGmailServer() as server:
+        seed(server, args.messages)
+        svc = server.service()
+
+        server.reset_counts()
+        refs = list_messages(svc, max_results=args.messages)
+        for m in refs:
+            get_message(svc, m["id"])
+        per_message = server.round_trips
+
+        server.reset_counts()
+        refs = list_messages(svc, max_results=args.messages)
+        metas = batch_get_messages(svc, [m["id"] for m in refs], fmt="metadata", metadata_headers=TRIAGE_HEADERS)
+        assert all("from" in message_headers(v) for v in metas.values())
+        todo = [m["id"] for m in refs][:max(0, args.messages - args.handled)]
+        fulls = batch_get_messages(svc, todo)
+        batched = server.round_trips
+
+    assert len(metas) == len(refs) and len(fulls) == len(todo)
+    expected = 1 + -(-len(refs) // BATCH_SIZE) + -(-len(todo) // BATCH_SIZE)
+    assert batched == expected, (batched, expected)
+    print(f"listed={len(refs)} full_fetches={len(todo)}")
+    print(f"per-message round trips: {per_message}")
+    print(f"batched round trips:     {batched}")
+
+if __name__ == "__main__":
+    main()
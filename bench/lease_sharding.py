@@ -0,0 +1,67 @@
+import argparse, multiprocessing as mp, os, sqlite3, tempfile, threading, time
+from collections import Counter
+
+# Several instances polling the same tenants at once, as separate processes
+# sharing one SQLite database (the local storage backend). Mailbox work is
+# replaced by a short sleep that records which instance handled which host.
+# Checks every host is processed exactly once per round and shows how the
+# hosts were split.
+#   python -m bench.lease_sharding --instances 4 --hosts 200
+
+def _instance(db_path: str, name: str, hosts: list, work_s: float, workers: int, start_at: float):
+    os.environ.update({"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": db_path, "INSTANCE_ID": name})
+    import app.poller as poller
+
+    # One connection for every poll worker, so writes to it take turns
+    log = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+    log_lock = threading.Lock()
+
+    def fake_process_host(host_id, approve_mode, deadline):
+        t0 = time.time()
+        time.sleep(work_s)
+        with log_lock:
+            log.execute("INSERT INTO work_log VALUES (?, ?, ?, ?)", (host_id, name, t0, time.time()))
+        return {"hostId": host_id, "handled": 0, "drafted": 0}
+
+    poller._process_host = fake_process_host
+    time.sleep(max(0.0, start_at - time.time()))
+    out = poller.poll_hosts(hosts, workers=workers)
+    skipped = sum(1 for r in out["results"] if r.get("skipped") == "leased")
+    print(f"{name}: processed {len(out['timings'])}, skipped {skipped}, {out['elapsedMs']} ms")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--instances", type=int, default=4)
+    ap.add_argument("--hosts", type=int, default=200)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--work-ms", type=float, default=20)
+    args = ap.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "leases.db")
+    os.environ.update({"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": db_path})
+    from app.storage import SQLiteStorage
+    SQLiteStorage(db_path)  # create the schema
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE work_log (host_id TEXT, instance TEXT, started REAL, ended REAL)")
+    hosts = [f"host-{i:04d}" for i in range(args.hosts)]
+
+    ctx = mp.get_context("spawn")
+    start_at = time.time() + 3  # let every process finish importing first
+    procs = [ctx.Process(target=_instance, args=(db_path, f"inst-{n}", hosts, args.work_ms / 1000, args.workers, start_at))
+             for n in range(args.instances)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT host_id, instance, started, ended FROM work_log").fetchall()
+    per_host = Counter(r[0] for r in rows)
+    dupes = [h for h, n in per_host.items() if n > 1]
+    print(f"hosts: {len(hosts)}, processed: {len(per_host)}, processed twice: {len(dupes)}")
+    print("per instance:", dict(sorted(Counter(r[1] for r in rows).items())))
+    assert not dupes, dupes[:10]
+    assert len(per_host) == len(hosts)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import argparse, asyncio, datetime as dt, json, random, threading, time
+from collections import Counter
+from typing import Dict
+
+from app.storage import SQLiteStorage, set_storage
+from bench.fake_gmail import FakeGmailServer, make_message
+
+# End-to-end poll throughput with every Google service replaced in-process:
+#   Gmail     bench.fake_gmail (one local server, a mailbox per tenant)
+#   Firestore the SQLite storage backend in memory, wrapped to count calls
+#   Vertex    llm_reply swapped for a sleep of --llm-ms (+/-50%)
+# Seeds --tenants mailboxes with --messages guest emails each, runs a full
+# poll, then adds --new messages per mailbox and polls again (the incremental
+# steady state). Reports messages/s, p50/p99 per-host poll latency and calls
+# per backend; --json prints the same as one JSON object per round.
+# --gmail-quota makes the fake Gmail throttle each mailbox like the real one,
+# --gmail-ms adds a network round trip to each of its requests.
+# --aio polls through the async path (poll_active_aio, httpx Gmail, awaited
+# Vertex) with --concurrency hosts at once instead of --workers threads.
+#   python -m bench.poll_bench --tenants 50 --messages 20 --llm-ms 300
+
+TEMPLATE_QUESTIONS = [
+    "Hi! What time can we check in on Friday?",
+    "Is there parking near the flat?",
+    "What's the wifi password please?",
+    "When is check-out on Sunday?",
+]
+LLM_QUESTIONS = [
+    "Do you allow dogs? We have a small spaniel.",
+    "Any recommendations for dinner nearby?",
+    "Is there a cot we could use for our baby?",
+    "Can we store luggage after we leave?",
+    "How far is the nearest supermarket?",
+    "Is the flat suitable for someone who uses a wheelchair?",
+]
+SENSITIVE_QUESTIONS = [
+    "Could we get a discount if we stay two more nights?",
+    "The kettle is broken, can we get a refund?",
+]
+
+class CountingStorage:
+    # Delegates to a real backend and counts each public call by name
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+class FakeLLM:
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, message_text: str, listing_cfg: dict, guest_name: str = "there", context: str = "") -> str:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency_s * random.uniform(0.5, 1.5))
+        return f"Thanks for asking! ({len(message_text)} chars)"
+
+    async def aio(self, message_text: str, listing_cfg: dict, guest_name: str = "there", context: str = "") -> str:
+        with self._lock:
+            self.calls += 1
+        await asyncio.sleep(self.latency_s * random.uniform(0.5, 1.5))
+        return f"Thanks for asking! ({len(message_text)} chars)"
+
+def seed_mailbox(mailbox, host_id: str, start: int, n: int, rnd: random.Random, llm_share: float, burst: int = 1):
+    # burst: consecutive emails land in the same thread, like a guest sending several in a row
+    for i in range(start, start + n):
+        r = rnd.random()
+        if r < 0.1:
+            sender, text = "Deals <news@shop.example>", "Our summer sale starts today."
+        elif r < 0.1 + llm_share:
+            sender, text = "Guest via Airbnb <express@airbnb.com>", rnd.choice(LLM_QUESTIONS)
+        elif r < 0.95:
+            sender, text = "Guest via Airbnb <express@airbnb.com>", rnd.choice(TEMPLATE_QUESTIONS)
+        else:
+            sender, text = "Guest via Airbnb <express@airbnb.com>", rnd.choice(SENSITIVE_QUESTIONS)
+        t = i // burst
+        mailbox.add(make_message(f"{host_id}-m{i:05d}", f"{host_id}-t{t:05d}", sender,
+                                 f"Reservation {t}", text, internal_date=i))
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_round(label: str, server: FakeGmailServer, store: CountingStorage, llm: FakeLLM, args) -> Dict:
+    from app.poller import poll_active, poll_active_aio
+    server.reset_counts()
+    store.calls.clear()
+    llm.calls = 0
+    t0 = time.perf_counter()
+    opts = dict(approve_mode=args.approve_mode, host_budget_s=600, page_size=args.page_size,
+                budget_s=3600, cursor="", force=True)
+    if args.aio:
+        out = asyncio.run(poll_active_aio(concurrency=args.concurrency, **opts))
+    else:
+        out = poll_active(workers=args.workers, **opts)
+    elapsed = time.perf_counter() - t0
+    msgs = sum(r.get("messages", 0) for r in out["results"])
+    latencies = list(out["timings"].values())
+    return {
+        "round": label,
+        "hosts": len(out["results"]),
+        "errors": sum(1 for r in out["results"] if "error" in r),
+        "messages": msgs,
+        "replies": sum(r.get("handled", 0) + r.get("drafted", 0) for r in out["results"]),
+        "seconds": round(elapsed, 3),
+        "msgsPerSec": round(msgs / elapsed, 1) if elapsed else 0.0,
+        "hostP50Ms": percentile(latencies, 50),
+        "hostP99Ms": percentile(latencies, 99),
+        "gmail": dict(sorted(server.calls.items())),
+        "storage": dict(sorted(store.calls.items())),
+        "vertex": {"generate_content": llm.calls},
+    }
+
+def print_round(r: Dict):
+    print(f"== {r['round']}: {r['hosts']} hosts, {r['messages']} messages ({r['replies']} replies) "
+          f"in {r['seconds']}s ({r['errors']} errors)")
+    print(f"   throughput   {r['msgsPerSec']:,.1f} msg/s")
+    print(f"   host latency p50 {r['hostP50Ms']} ms, p99 {r['hostP99Ms']} ms")
+    for backend in ("gmail", "storage", "vertex"):
+        calls = dict(r[backend])
+        trips = calls.pop("http", None)  # Gmail: HTTP requests, batches counted once
+        print(f"   {backend:<8} {sum(calls.values()):>6} calls  " +
+              ", ".join(f"{k}={v}" for k, v in calls.items()) +
+              (f"  ({trips} HTTP round trips)" if trips is not None else ""))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tenants", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=20, help="guest emails per mailbox before the first poll")
+    ap.add_argument("--new", type=int, default=5, help="emails per mailbox arriving before the second poll")
+    ap.add_argument("--llm-ms", type=float, default=300, help="mean fake Vertex latency")
+    ap.add_argument("--llm-share", type=float, default=0.4, help="share of messages the router can't answer")
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--aio", action="store_true", help="poll through the async path")
+    ap.add_argument("--concurrency", type=int, default=64, help="hosts polled at once with --aio")
+    ap.add_argument("--page-size", type=int, default=200)
+    ap.add_argument("--approve-mode", action="store_true", help="auto-send template replies")
+    ap.add_argument("--gmail-quota", type=float, default=0,
+                    help="quota units/s per mailbox the fake Gmail enforces with 429s (0: unlimited)")
+    ap.add_argument("--gmail-ms", type=float, default=0, help="latency the fake Gmail adds to each HTTP request")
+    ap.add_argument("--burst", type=int, default=1, help="consecutive emails per thread")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    import app.gmail_async as gmail_async
+    import app.gmail_io as gmail_io
+    import app.reply_cache as reply_cache
+    import app.vertex_reply as vertex_reply
+    from app.token_store import save_gmail_creds
+    from googleapiclient.discovery import build_from_document
+
+    store = CountingStorage(SQLiteStorage(":memory:"))
+    set_storage(store)
+    llm = FakeLLM(args.llm_ms / 1000)
+    vertex_reply.llm_reply = llm
+    reply_cache.llm_reply = llm
+    vertex_reply.llm_reply_aio = llm.aio
+    reply_cache.llm_reply_aio = llm.aio
+    rnd = random.Random(args.seed)
+
+    with FakeGmailServer(user_quota_per_s=args.gmail_quota, latency_s=args.gmail_ms / 1000) as server:
+        # Real credential manager and service pool; only the endpoint is local
+        def gmail_service(creds):
+            host_id = creds.refresh_token.split(":", 1)[1]
+            return build_from_document(gmail_io._gmail_discovery_doc(), credentials=creds,
+                                       client_options={"api_endpoint": server.endpoint(host_id)})
+        gmail_io.gmail_service = gmail_service
+        gmail_async.api_base = server.endpoint
+
+        hosts = [f"host-{i:05d}" for i in range(args.tenants)]
+        for h in hosts:
+            mailbox = server.mailbox_for(h)
+            store.inner.set_tenant(h, {"hostEmail": f"{h}@example.com", "active": True,
+                                       "gmailHistoryId": str(mailbox.history_id)})
+            save_gmail_creds(h, {"token": "bench", "refresh_token": f"bench:{h}", "client_id": "bench",
+                                 "client_secret": "bench", "token_uri": "https://oauth2.googleapis.com/token",
+                                 "scopes": gmail_io.SCOPES,
+                                 "expiry": dt.datetime.utcnow() + dt.timedelta(days=1)})
+            seed_mailbox(mailbox, h, 0, args.messages, rnd, args.llm_share, args.burst)
+
+        rounds = [run_round("initial", server, store, llm, args)]
+        for h in hosts:
+            seed_mailbox(server.mailbox_for(h), h, args.messages, args.new, rnd, args.llm_share, args.burst)
+        rounds.append(run_round("incremental", server, store, llm, args))
+
+    for r in rounds:
+        if args.json:
+            print(json.dumps(r))
+        else:
+            print_round(r)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse, base64, itertools, json, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.request import Request, urlopen
+
+# A local stand-in for a Pub/Sub topic with one push subscription. Messages
+# published to it (via publish() or the REST ":publish" call) are delivered to
+# the push endpoint in Pub/Sub's push format, e.g. the app's
+# /push/gmail/{hostId}?token=... route.
+#   python -m bench.pubsub_push --endpoint "http://localhost:8000/push/gmail/host-you?token=x" \
+#       --email host@example.com --history-id 12345
+
+class PubSubStandIn:
+    def __init__(self, push_endpoint: str, subscription="projects/local/subscriptions/gmail-push"):
+        self.push_endpoint = push_endpoint
+        self.subscription = subscription
+        self.deliveries: List[Dict] = []
+        self._ids = itertools.count(1)
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if not re.fullmatch(r"/v1/projects/[^/]+/topics/[^/:]+:publish", self.path):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                req = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                ids = [stand_in.push_raw(m.get("data", ""), m.get("attributes") or {})["messageId"]
+                       for m in req.get("messages", [])]
+                body = json.dumps({"messageIds": ids}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_raw(self, data_b64: str, attributes: Dict) -> Dict:
+        message_id = str(next(self._ids))
+        envelope = {
+            "message": {
+                "data": data_b64,
+                "attributes": attributes,
+                "messageId": message_id,
+                "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            },
+            "subscription": self.subscription,
+        }
+        req = Request(self.push_endpoint, data=json.dumps(envelope).encode(),
+                      headers={"Content-Type": "application/json"}, method="POST")
+        with urlopen(req, timeout=120) as resp:
+            delivery = {"messageId": message_id, "status": resp.status, "body": json.loads(resp.read() or b"null")}
+        self.deliveries.append(delivery)
+        return delivery
+
+    def publish(self, data: Dict, attributes: Dict | None = None) -> Dict:
+        return self.push_raw(base64.b64encode(json.dumps(data).encode()).decode(), attributes or {})
+
+    def publish_gmail_change(self, email_address: str, history_id: int | str) -> Dict:
+        # What Gmail publishes to the watch topic
+        return self.publish({"emailAddress": email_address, "historyId": int(history_id)})
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--endpoint", required=True)
+    ap.add_argument("--email", required=True)
+    ap.add_argument("--history-id", required=True)
+    args = ap.parse_args()
+    print(json.dumps(PubSubStandIn(args.endpoint).publish_gmail_change(args.email, args.history_id), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse, random, re, sys, time
+
+from app.router import propose_template, compiled_router
+from app.tenants import DEFAULT_LISTING_CONFIG
+
+# Messages per second through the router: the compiled single-pass matcher
+# against the previous rule loop (one regex search per rule, then the
+# sensitive-terms regex), reproduced below for comparison. Checks first that
+# blocked keywords are caught, also where they start with an intent word
+# (exits 1 if not).
+#   python -m bench.router_bench --messages 20000
+
+LEGACY_SAFE_RULES = [
+    (re.compile(r'\bcheck[\s-]?in|arrival|access\b', re.I), "Check-in is after 3pm."),
+    (re.compile(r'\bcheck[\s-]?out|departure\b', re.I), "Check-out is 11am."),
+    (re.compile(r'\bwi[-\s]?fi|internet\b', re.I), "Wi-Fi: Network “Home-Guest”."),
+    (re.compile(r'\bparking|car park\b', re.I), "Free on-street after 6pm."),
+]
+LEGACY_SENSITIVE_RX = re.compile(
+    r'\b(refund|discount|compensat|damage|exception|special offer|price match)\b', re.I)
+
+def legacy_propose_template(text: str, guest_name: str = "there"):
+    m = text or ""
+    for rx, templ in LEGACY_SAFE_RULES:
+        if rx.search(m):
+            return f"Hi {guest_name}! {templ}", True, 0.95
+    if LEGACY_SENSITIVE_RX.search(m):
+        return "flagged", False, 0.8
+    return "", False, 0.0
+
+SAMPLES = [
+    "Hi! What time can we check in on Friday? We land around noon.",
+    "Is there parking near the flat? We are driving down from Leeds.",
+    "What's the wifi password please?",
+    "Hello, the shower is not draining properly, could someone take a look?",
+    "Could we get a discount if we stay an extra two nights?",
+    "Thanks for a lovely stay, we left the keys on the table. Checkout was smooth.",
+    "Do you allow dogs? We have a small, very quiet spaniel.",
+    "Any recommendations for dinner nearby? Something not too expensive.",
+]
+
+# (message, listing blocked keywords, whether it may be auto-sent)
+BLOCKED_CASES = [
+    ("I got a parking fine, who pays?", ["parking fine"], False),
+    ("Is there a check-in late fee?", ["check-in late fee"], False),
+    ("There is an internet outage again", ["internet outage"], False),
+    ("Would an early check-in late fee apply?", ["check-in late fee"], False),
+    ("Could we get a refund for the last night?", [], False),
+    ("Is there parking near the flat?", ["parking fine"], True),
+    ("What time is check-in?", ["check-in late fee"], True),
+]
+
+def check_blocked() -> bool:
+    ok = True
+    for text, keywords, auto in BLOCKED_CASES:
+        cfg = dict(DEFAULT_LISTING_CONFIG, blocked_auto_send_keywords=keywords)
+        got = propose_template(text, "there", cfg)[1]
+        if got != auto:
+            print(f"FAIL auto_ok={got}, expected {auto}: {text!r} (blocked {keywords})")
+            ok = False
+    return ok
+
+def corpus(n: int, seed: int = 7):
+    rnd = random.Random(seed)
+    filler = "We are really looking forward to the trip and have a couple of questions. " * 3
+    return [filler + rnd.choice(SAMPLES) for _ in range(n)]
+
+def run(fn, msgs) -> float:
+    t0 = time.perf_counter()
+    for m in msgs:
+        fn(m)
+    return len(msgs) / (time.perf_counter() - t0)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=20000)
+    args = ap.parse_args()
+    if not check_blocked():
+        sys.exit(1)
+    msgs = corpus(args.messages)
+    cfg = dict(DEFAULT_LISTING_CONFIG)
+    compiled_router(cfg)  # compile outside the timed loop, as the cache would
+
+    legacy = run(legacy_propose_template, msgs)
+    compiled = run(lambda m: propose_template(m, "there", cfg), msgs)
+    scan_only = run(compiled_router(cfg).scan, msgs)
+    print(f"messages: {len(msgs)}")
+    print(f"legacy rule loop:          {legacy:,.0f} msg/s")
+    print(f"compiled propose_template: {compiled:,.0f} msg/s ({compiled / legacy:.2f}x)")
+    print(f"compiled scan only:        {scan_only:,.0f} msg/s ({scan_only / legacy:.2f}x)")
+
+if __name__ == "__main__":
+    main()
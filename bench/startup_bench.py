@@ -0,0 +1,122 @@
+import argparse, json, os, re, subprocess, sys
+from collections import Counter
+from typing import Dict, List, Tuple
+
+# Cold-start cost of the app, each run in a fresh interpreter:
+#   import   python -X importtime -c "import app.main": wall time, the app's own
+#            modules (cumulative, so including what each one pulls in) and
+#            self time summed per top-level package
+#   lazy     Google client libraries app.main must not import; any that are
+#            loaded anyway are listed (and the exit status is 1)
+#   warm-up  app.warmup.run_warmup() after the import: what a first request
+#            (or /warmup) pays per step
+# Times are the median of --runs.
+#   python -m bench.startup_bench --runs 5 --top 15
+
+LAZY_MODULES = [
+    "google.cloud.aiplatform",
+    "vertexai",
+    "google.cloud.firestore",
+    "googleapiclient.discovery",
+    "googleapiclient.http",
+    "google_auth_oauthlib",
+    "google.oauth2.credentials",
+    "google.auth.transport.requests",
+]
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import app.main
+ms = (time.perf_counter() - t0) * 1000
+lazy = %r
+out = {"importMs": ms, "eager": [m for m in lazy if m in sys.modules]}
+if %r:
+    from app.warmup import run_warmup
+    out["warmup"] = run_warmup()["steps"]
+print(json.dumps(out))
+"""
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    # [(module, self us, cumulative us)]
+    return [(m.group(4), int(m.group(1)), int(m.group(2))) for m in map(_LINE.match, stderr.splitlines()) if m]
+
+def run_once(warmup: bool) -> Dict:
+    env = dict(os.environ, PYTHONPATH=os.getcwd() + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", _PROBE % (LAZY_MODULES, warmup)],
+                          capture_output=True, text=True, env=env)
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr[-2000:])
+    out = json.loads(proc.stdout.strip().splitlines()[-1])
+    # run_warmup's imports show up in importtime too; only count up to app.main
+    rows = parse_importtime(proc.stderr)
+    end = next(i for i, (name, _, _) in enumerate(rows) if name == "app.main")
+    out["modules"] = rows[:end + 1]
+    return out
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+def summarize(runs: List[Dict], top: int) -> Dict:
+    app_mods: Dict[str, List[int]] = {}
+    packages: Dict[str, List[int]] = {}
+    for run in runs:
+        per_package: Counter = Counter()
+        for name, self_us, cum_us in run["modules"]:
+            if name.split(".")[0] == "app":
+                app_mods.setdefault(name, []).append(cum_us)
+            per_package[name.split(".")[0]] += self_us
+        for name, us in per_package.items():
+            packages.setdefault(name, []).append(us)
+    out = {
+        "runs": len(runs),
+        "importMs": round(median([r["importMs"] for r in runs]), 1),
+        "appModulesMs": {m: round(median(v) / 1000, 1)
+                         for m, v in sorted(app_mods.items(), key=lambda kv: -median(kv[1]))},
+        "packagesMs": {p: round(median(v) / 1000, 1)
+                       for p, v in sorted(packages.items(), key=lambda kv: -median(kv[1]))[:top]},
+        "eager": sorted({m for r in runs for m in r["eager"]}),
+    }
+    if "warmup" in runs[0]:
+        out["warmupMs"] = {step: median([r["warmup"][step]["ms"] for r in runs]) for step in runs[0]["warmup"]}
+        errors = {step: s["error"] for step, s in runs[0]["warmup"].items() if "error" in s}
+        if errors:
+            out["warmupErrors"] = errors
+    return out
+
+def print_summary(s: Dict):
+    print(f"== import app.main: {s['importMs']} ms (median of {s['runs']})")
+    print("   app modules (cumulative ms)")
+    for m, ms in s["appModulesMs"].items():
+        print(f"     {m:<28} {ms:>8.1f}")
+    print("   top packages (self ms)")
+    for p, ms in s["packagesMs"].items():
+        print(f"     {p:<28} {ms:>8.1f}")
+    print("   lazy libraries imported eagerly: " + (", ".join(s["eager"]) or "none"))
+    if "warmupMs" in s:
+        print("== warm-up after import: " + ", ".join(f"{k}={v} ms" for k, v in s["warmupMs"].items()) +
+              f" (total {sum(s['warmupMs'].values())} ms)")
+        for step, err in s.get("warmupErrors", {}).items():
+            print(f"   {step} failed: {err}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--top", type=int, default=12, help="packages to list by import time")
+    ap.add_argument("--no-warmup", action="store_true", help="only time the import")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    summary = summarize([run_once(not args.no_warmup) for _ in range(max(1, args.runs))], args.top)
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print_summary(summary)
+    if summary["eager"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()